@@ -1,17 +1,27 @@
 import argparse
 import os.path
+import signal
 import sys
+from contextlib import contextmanager
 
 sys.path.append(os.path.dirname(__file__))
 
 from config import Config
+from drop_folder_watcher import DropFolderWatcher
+from engine_verifier import EngineVerifier
 from form_1325_generator import Form1325CSVGenerator, Form1325PDFGenerator
-from logger import logger
+from logger import log_context, logger, new_job_id
+from position_index import PositionIndex
+from progress import Cancelled, CancellationToken, ProgressBar
 from utilities import Utilities
 
 
 class Main:
     EXTENSION_TO_CLASS_MAP = {Config.CSV: Form1325CSVGenerator, Config.PDF: Form1325PDFGenerator}
+    INPUT_EXTENSIONS = [Config.CSV, Config.XLSX]
+    WATCH = "watch"
+    VERIFY = "verify"
+    POSITIONS = "positions"
 
     @staticmethod
     def _parse_args():
@@ -21,23 +31,135 @@ class Main:
         """
         parser = argparse.ArgumentParser()
 
-        parser.add_argument("input_file", type=str, help="The CSV input file path")
+        parser.add_argument("input_file", type=str, help="The CSV or Excel (xlsx) input file path")
         parser.add_argument("output_file", type=str, help="The output file path")
+        parser.add_argument("--merge_files", type=str, nargs="+",
+                            help="More CSV or Excel input files to merge with the input file (e.g. exports of "
+                                 "overlapping date ranges). Orders found in more than one file are counted once")
         parser.add_argument("--name", type=str, help="The name (for PDF output only)")
         parser.add_argument("--file_number", type=str, help="The file number (for PDF output only)")
         parser.add_argument("--asset_abroad", type=str, help="Whether the asset is abroad (for PDF output only)")
+        parser.add_argument("--explanations_url", type=str,
+                            help="Link to the form's explanations at this URL instead of appending the explanations "
+                                 "pages (for PDF output only)")
+        parser.add_argument("--spill_dir", type=str,
+                            help="A directory for spilling the matched lots to disk, to keep the memory bounded")
+        parser.add_argument("--summary_file", type=str,
+                            help="A CSV file path for the totals summary (per symbol, per month and grand total)")
+        parser.add_argument("--subtotals", action="store_true",
+                            help="Add a subtotals section at the end of the output file (for CSV output only)")
+        parser.add_argument("--by_account", action="store_true",
+                            help="Generate a separate output file for each account. The output file path can contain "
+                                 "an {account} placeholder (otherwise the account is added to the file name)")
+        parser.add_argument("--accounts_file", type=str,
+                            help="A CSV file with the Account, Name and File Number columns (with --by_account)")
+        parser.add_argument("--workers", type=int, help="The number of worker processes (with --by_account)")
+        parser.add_argument("--consolidate_fills", action="store_true",
+                            help="Merge partial fills (same symbol, side, price and second) before matching")
+        parser.add_argument("--lineage_file", type=str,
+                            help="A CSV file path for the consolidated orders, with the input lines of each order")
+        parser.add_argument("--aggregate_rows", action="store_true",
+                            help="Combine the matched lots with the same symbol, buy date and sell date into one row")
+        parser.add_argument("--external_sort", action="store_true",
+                            help="Sort the input file on disk, in chunks, for input files that are too big to sort in "
+                                 "memory. The orders are matched one symbol at a time")
+        parser.add_argument("--chunk_size", type=int, help="The number of orders in a chunk (with --external_sort)")
+        parser.add_argument("--no_cache", action="store_true",
+                            help="Always generate the output, instead of copying it from the result cache when the "
+                                 "orders, options, rates and tool version are unchanged")
+        parser.add_argument("--cache_dir", type=str, help="The result cache directory")
+        parser.add_argument("--reference_engine", action="store_true",
+                            help="Use the frozen reference engine, to compare its output with the default engine's")
 
         return parser.parse_args()
 
+    @staticmethod
+    def _parse_watch_args(argv: list):
+        """
+        Parse the command-line arguments of the watch command
+        :param argv: The arguments after the command name
+        :return: A argparse.Namespace object
+        """
+        parser = argparse.ArgumentParser(prog=f"{os.path.basename(os.path.dirname(os.path.dirname(__file__)))} watch")
+
+        parser.add_argument("watch_dir", type=str,
+                            help="The folder to watch for new Colmex Pro orders CSV or Excel files")
+        parser.add_argument("--output_dir", type=str,
+                            help=f"The output folder (a {DropFolderWatcher.OUTPUT_FOLDER} folder in the watched "
+                                 f"folder by default)")
+        parser.add_argument("--output_format", type=str, default=Config.CSV, choices=[Config.CSV, Config.PDF],
+                            help="The output file format")
+        parser.add_argument("--name", type=str, help="The name (for PDF output only)")
+        parser.add_argument("--file_number", type=str, help="The file number (for PDF output only)")
+        parser.add_argument("--asset_abroad", type=str, help="Whether the asset is abroad (for PDF output only)")
+        parser.add_argument("--explanations_url", type=str,
+                            help="Link to the form's explanations at this URL instead of appending the explanations "
+                                 "pages (for PDF output only)")
+        parser.add_argument("--workers", type=int, help="The number of files processed at the same time")
+        parser.add_argument("--poll_interval", type=float, help="Seconds between scans of the watched folder")
+        parser.add_argument("--settle_time", type=float,
+                            help="Seconds a file must stay unchanged before it is processed (for files being written)")
+        parser.add_argument("--consolidate_fills", action="store_true",
+                            help="Merge partial fills (same symbol, side, price and second) before matching")
+        parser.add_argument("--aggregate_rows", action="store_true",
+                            help="Combine the matched lots with the same symbol, buy date and sell date into one row")
+        parser.add_argument("--no_cache", action="store_true", help="Don't use the result cache")
+
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def _parse_verify_args(argv: list):
+        """
+        Parse the command-line arguments of the verify command
+        :param argv: The arguments after the command name
+        :return: A argparse.Namespace object
+        """
+        parser = argparse.ArgumentParser(
+            prog=f"{os.path.basename(os.path.dirname(os.path.dirname(__file__)))} verify",
+            description="Run randomized orders histories through the reference engine and the engine, and compare "
+                        "their outputs row by row"
+        )
+
+        parser.add_argument("--rows", type=int, default=20_000, help="The number of orders in a history (about)")
+        parser.add_argument("--symbols", type=int, default=50, help="The number of symbols in a history")
+        parser.add_argument("--histories", type=int, default=1, help="The number of histories")
+        parser.add_argument("--seed", type=int, default=0, help="The random seed of the first history")
+        parser.add_argument("--aggregate_rows", action="store_true", help="Aggregate the matched lots")
+
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def _parse_positions_args(argv: list):
+        """
+        Parse the command-line arguments of the positions command
+        :param argv: The arguments after the command name
+        :return: A argparse.Namespace object
+        """
+        parser = argparse.ArgumentParser(
+            prog=f"{os.path.basename(os.path.dirname(os.path.dirname(__file__)))} positions",
+            description="Query the realized P&L, the totals and the open lots of an orders file, from its saved index "
+                        "(built on the first query)"
+        )
+
+        parser.add_argument("input_file", type=str, help="The CSV or Excel (xlsx) input file path")
+        parser.add_argument("--symbol", type=str, help="The symbol (all symbols by default)")
+        parser.add_argument("--start", type=str, help="The first sell date (YYYY-MM-DD, inclusive)")
+        parser.add_argument("--end", type=str, help="The last sell date (YYYY-MM-DD, inclusive)")
+        parser.add_argument("--open_lots", action="store_true", help="Also output the open lots")
+        parser.add_argument("--revalidate_rates", action="store_true",
+                            help="Fetch the BOI rates and rebuild the index if it was built with other rates")
+
+        return parser.parse_args(argv)
+
     @staticmethod
     def _validate_input_file(input_file: str):
         """
-        Validate the input file: Check if it exists and if its file extension is CSV
+        Validate the input file: Check if it exists and if its file extension is CSV or XLSX (the Excel export)
         """
         if not Utilities.file_exists(input_file):
             raise Exception(f"Input file not found: {input_file}")
         input_file_extension = Utilities.get_file_extension(input_file)
-        if input_file_extension != Config.CSV:
+        if input_file_extension.lower() not in Main.INPUT_EXTENSIONS:
             raise Exception(f"Unsupported input file extension: {input_file_extension}")
 
     @staticmethod
@@ -47,7 +169,8 @@ class Main:
          and warn when the optional arguments are passed, but not required
         """
         if output_file_extension == Config.PDF:
-            if args.name is None or args.file_number is None or args.asset_abroad is None:
+            from_accounts_file = args.by_account and args.accounts_file is not None  # Name & file number per account
+            if (args.name is None or args.file_number is None) and not from_accounts_file or args.asset_abroad is None:
                 raise Exception("--name, --file_number, --asset_abroad are required when using PDF output file")
         else:
             if not (args.name is None and args.file_number is None and args.asset_abroad is None):
@@ -67,7 +190,8 @@ class Main:
         """
         Make some validations
         """
-        Main._validate_input_file(args.input_file)
+        for input_file in [args.input_file, *(args.merge_files or [])]:
+            Main._validate_input_file(input_file)
         Main._validate_args(args, output_file_extension)
         if output_file_extension == Config.PDF:
             Main._validate_asset_abroad(args.asset_abroad)
@@ -82,25 +206,117 @@ class Main:
             raise Exception(f"Unsupported output file extension: {output_file_extension}")
         return cls
 
+    @staticmethod
+    @contextmanager
+    def _cancel_on_interrupt(token: CancellationToken):
+        """
+        Cancel the run cleanly on Ctrl+C, instead of interrupting it. A second Ctrl+C interrupts it
+        """
+        def handler(signum, frame):
+            if token.cancelled:
+                raise KeyboardInterrupt
+            logger.warning("Cancelling the run (press Ctrl+C again to stop immediately)")
+            token.cancel()
+
+        previous_handler = signal.signal(signal.SIGINT, handler)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
     @staticmethod
     def run() -> bool:
         """
         Run the app
         :return: True for success, False otherwise
         """
+        progress_bar = ProgressBar()  # Drawn only on a terminal
+        with log_context(job_id=new_job_id()):
+            try:
+                args = Main._parse_args()
+                output_file_extension = Utilities.get_file_extension(args.output_file)
+                Main._validate(args, output_file_extension)
+                cls = Main._get_generator(output_file_extension)
+                token = CancellationToken()
+                generator = cls(**args.__dict__, progress=progress_bar, cancel_token=token)
+                try:
+                    with Main._cancel_on_interrupt(token):
+                        generator.run()
+                finally:
+                    progress_bar.close()
+                if generator.OUTPUT_FILES and all(Utilities.file_exists(f) for f in generator.OUTPUT_FILES):
+                    logger.info(f"Output file ready at: {', '.join(generator.OUTPUT_FILES)}")
+                    return True
+            except Cancelled as e:
+                logger.warning(e)
+            except Exception as e:
+                logger.exception(e)
+        return False
+
+    @staticmethod
+    def watch() -> bool:
+        """
+        Run the watch command: Generate the outputs of the files dropped into a folder, until interrupted
+        :return: True for success, False otherwise
+        """
+        try:
+            args = Main._parse_watch_args(sys.argv[2:])
+            if not os.path.isdir(args.watch_dir):
+                raise Exception(f"Watch folder not found: {args.watch_dir}")
+            if args.output_format == Config.PDF:
+                if args.name is None or args.file_number is None or args.asset_abroad is None:
+                    raise Exception("--name, --file_number, --asset_abroad are required when using PDF output file")
+                Main._validate_asset_abroad(args.asset_abroad)
+            options = vars(args)
+            output_format = options.pop("output_format")
+            DropFolderWatcher(generator_class=Main._get_generator(output_format), output_extension=output_format,
+                              **options).run()
+            return True
+        except Exception as e:
+            logger.exception(e)
+        return False
+
+    @staticmethod
+    def verify() -> bool:
+        """
+        Run the verify command: Compare the engine's output with the reference engine's output on randomized orders
+        histories
+        :return: True if the outputs match, False otherwise
+        """
+        try:
+            args = Main._parse_verify_args(sys.argv[2:])
+            return EngineVerifier.verify(args.rows, args.symbols, args.histories, args.seed, args.aggregate_rows)
+        except Exception as e:
+            logger.exception(e)
+        return False
+
+    @staticmethod
+    def positions() -> bool:
+        """
+        Run the positions command: Write the totals of the lots sold in a date range (and the open lots) as CSV to
+        the standard output
+        :return: True for success, False otherwise
+        """
         try:
-            args = Main._parse_args()
-            output_file_extension = Utilities.get_file_extension(args.output_file)
-            Main._validate(args, output_file_extension)
-            cls = Main._get_generator(output_file_extension)
-            cls(**args.__dict__).run()
-            if Utilities.file_exists(args.output_file):
-                logger.info(f"Output file ready at: {args.output_file}")
-                return True
+            args = Main._parse_positions_args(sys.argv[2:])
+            Main._validate_input_file(args.input_file)
+            index = PositionIndex.open(args.input_file, revalidate_rates=args.revalidate_rates)
+            index.summary(args.symbol, args.start, args.end).to_csv(sys.stdout)
+            if args.open_lots:
+                sys.stdout.write("\n")
+                index.open_lots(args.symbol).to_csv(sys.stdout, index=False)
+            return True
         except Exception as e:
             logger.exception(e)
         return False
 
 
 if __name__ == '__main__':
-    Main.run()
+    if sys.argv[1:2] == [Main.WATCH]:
+        sys.exit(0 if Main.watch() else 1)
+    elif sys.argv[1:2] == [Main.VERIFY]:
+        sys.exit(0 if Main.verify() else 1)  # Mismatches fail the run (and CI)
+    elif sys.argv[1:2] == [Main.POSITIONS]:
+        sys.exit(0 if Main.positions() else 1)
+    else:
+        Main.run()
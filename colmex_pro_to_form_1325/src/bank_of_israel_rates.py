@@ -1,17 +1,49 @@
 import csv
+import hashlib
+import json
+import os.path
+import threading
 from datetime import datetime, timedelta
-from io import StringIO
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from config import Config
+from utilities import Utilities
 
 
 class BankOfIsraelRates:
+    """
+    The BOI exchange rates. A fetched series is cached in memory and in a private per-user folder with its ETag and
+    Last-Modified headers, so later runs send a conditional request and an unchanged series is not downloaded again
+    """
+    CACHE_FOLDER = os.path.join(Utilities.USER_CACHE_FOLDER, "rates")
     _BASE_URL = "https://edge.boi.gov.il/FusionEdgeServer/sdmx/v2/data/dataflow/BOI.STATISTICS/EXR/1.0/"
     _DATETIME = "Time Period"
     _RATE = "RER_USD_ILS:D:USD:ILS:ILS:OF00"
+    _TIMEOUT = 30  # Seconds
+    _HEADERS = {"Accept-Encoding": "gzip, deflate", "Accept": "text/csv"}
+
+    _session = None
+    _cache = {}  # {url: (etag, last_modified, rates)}, the series fetched or loaded from the cache folder
+    _lock = threading.Lock()  # Guards the session and the cache, as the rates may be fetched from several threads
+
+    @classmethod
+    def _get_session(cls) -> requests.Session:
+        """
+        Get the shared HTTP session, so the connections to the BOI server are pooled and reused between requests
+        :return: A requests.Session object
+        """
+        with cls._lock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(cls._HEADERS)
+                cls._session = session
+            return cls._session
 
     @staticmethod
     def _get_params(start_date: str, end_date: str, symbol: str) -> dict:
@@ -78,24 +110,120 @@ class BankOfIsraelRates:
         return cls._get_rate_of_date(rates, previous_date, end_date)
 
     @classmethod
-    def get_rates(cls, year: int, symbol: str) -> dict:
+    def _parse_response(cls, response: requests.Response) -> dict:
         """
-        :param year: The year to get the rates for
-        :param symbol: The symbol to get the rates for (Usually USD)
+        Parse the SDMX CSV response line by line, without holding the whole body in memory
+        :param response: A streamed response
         :return: A dictionary with {date: rate} format
         """
+        if response.encoding is None:
+            response.encoding = "utf-8-sig"
         rates = {}
-        dates_list = cls._get_dates_list(year)
+        reader = csv.DictReader(response.iter_lines(decode_unicode=True))
+        for row in reader:
+            rates[row[cls._DATETIME]] = float(row[cls._RATE])
+        return rates
 
-        url = cls._get_url(dates_list[0], dates_list[-1], symbol)
-        response = requests.get(url)
-        if response.status_code == 200:
-            reader = csv.DictReader(StringIO(response.text))
-            for row in reader:
-                rates[row[cls._DATETIME]] = float(row[cls._RATE])
+    @classmethod
+    def _get_cache_path(cls, url: str) -> str:
+        """
+        :param url: The series URL
+        :return: The path of the series' cache file
+        """
+        return os.path.join(cls.CACHE_FOLDER, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json")
+
+    @classmethod
+    def _load_cached(cls, url: str) -> tuple:
+        """
+        Get a series from the memory cache, or from its cache file
+        :param url: The series URL
+        :return: A (etag, last_modified, rates) tuple, with None values if the series isn't cached
+        """
+        with cls._lock:
+            cached = cls._cache.get(url)
+        if cached is not None:
+            return cached
+        try:
+            with open(cls._get_cache_path(url), encoding="utf-8") as f:
+                data = json.load(f)
+            if data["url"] != url:
+                return None, None, None
+            cached = data["etag"], data["last_modified"], {date: float(rate) for date, rate in data["rates"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None, None, None  # Not cached, or a corrupt cache file that is fetched again
+        with cls._lock:
+            cls._cache[url] = cached
+        return cached
 
-        # Add missing dates based on the previous trading day's rate
+    @classmethod
+    def _save_cached(cls, url: str, etag: str, last_modified: str, rates: dict):
+        """
+        Cache a series in memory and in its cache file
+        :param url: The series URL
+        :param etag: The ETag header of the response
+        :param last_modified: The Last-Modified header of the response
+        :param rates: The rates dictionary
+        """
+        with cls._lock:
+            cls._cache[url] = (etag, last_modified, rates)
+        Utilities.make_private_folder(cls.CACHE_FOLDER)
+        cache_path = cls._get_cache_path(url)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with Utilities.open_private_file(temp_path, "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "rates": rates}, f)
+        os.replace(temp_path, cache_path)  # Replace atomically, so a concurrent reader never sees a partial file
+
+    @classmethod
+    def _fetch_rates(cls, url: str) -> dict:
+        """
+        Fetch the rates series from the BOI server. A conditional request is sent when the series was already fetched
+        (by this run or an earlier one), so an unchanged series is answered with 304 Not Modified and served from the
+        cache
+        :param url: The series URL
+        :return: A dictionary with {date: rate} format
+        """
+        etag, last_modified, cached_rates = cls._load_cached(url)
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+
+        with cls._get_session().get(url, headers=headers, timeout=cls._TIMEOUT, stream=True) as response:
+            if response.status_code == 304 and cached_rates is not None:
+                return cached_rates
+            if response.status_code != 200:
+                raise Exception(f"Failed to get the BOI rates: HTTP status {response.status_code} ({url})")
+            rates = cls._parse_response(response)
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+        if etag is not None or last_modified is not None:
+            cls._save_cached(url, etag, last_modified, rates)
+        return rates
+
+    @classmethod
+    def fill_missing_dates(cls, rates: dict, year: int) -> dict:
+        """
+        Add the dates without a published rate (weekends and holidays), with the previous trading day's rate
+        :param rates: The published rates, in {date: rate} format
+        :param year: The year
+        :return: A dictionary with {date: rate} format, with all the dates of the year
+        """
+        dates_list = cls._get_dates_list(year)
+        rates = dict(rates)
         for date in dates_list:
             if rates.get(date) is None:
                 rates[date] = cls._get_rate_of_date(rates, date, dates_list[0])
         return rates
+
+    @classmethod
+    def get_rates(cls, year: int, symbol: str) -> dict:
+        """
+        :param year: The year to get the rates for
+        :param symbol: The symbol to get the rates for (Usually USD)
+        :return: A dictionary with {date: rate} format
+        """
+        dates_list = cls._get_dates_list(year)
+
+        url = cls._get_url(dates_list[0], dates_list[-1], symbol)
+        return cls.fill_missing_dates(cls._fetch_rates(url), year)
@@ -24,3 +24,5 @@ class ColmexProOrdersCSVColumns:
     POSITION = "Position"
     QUANTITY = "Quantity"
     AMOUNT = "Amount"
+    LINEAGE = "Lineage"
+    TRADE_ID = "Trade ID"
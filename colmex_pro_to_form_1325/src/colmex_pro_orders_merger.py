@@ -0,0 +1,150 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from config import Config
+from logger import logger
+
+
+class ColmexProOrdersMerger:
+    """
+    Merge several Colmex Pro orders exports, which may cover overlapping date ranges, into one orders DataFrame.
+    The rows are hashed to find the orders that appear in more than one export, so they are counted only once.
+    On a date covered by two exports, the orders of one export may be a subset of the other's (e.g. an export taken
+    during the trading day), but exports that each have orders the other doesn't have on the same date are
+    inconsistent, and they are not merged.
+    """
+    # Row key columns
+    _HASH = "Hash"
+    _OCCURRENCE = "Occurrence"
+    _FILE = "File"
+
+    @staticmethod
+    def get_sort_keys(df: pd.DataFrame) -> np.ndarray:
+        """
+        :param df: The Colmex Pro orders DataFrame
+        :return: An int64 array with the execution date and time of each order
+        """
+        fmt = f"{Config.COLMEX_PRO_MTS_DATE_FORMAT} {Config.TIME_FORMAT}"
+        datetimes = pd.to_datetime(df[Columns.TRADE_DATE] + " " + df[Columns.EXEC_TIME], format=fmt)
+        return datetimes.to_numpy().astype(np.int64)
+
+    @staticmethod
+    def is_sorted(keys: np.ndarray) -> bool:
+        """
+        :param keys: An array of sort keys
+        :return: True if the keys are sorted in ascending order
+        """
+        return bool(np.all(keys[1:] >= keys[:-1]))
+
+    @classmethod
+    def _get_merge_order(cls, keys: np.ndarray, file_ids: np.ndarray, files: int) -> np.ndarray:
+        """
+        Get the order of the merged rows. Each file is a sorted run (an unsorted file is sorted on its own), and the
+        runs are concatenated if they don't interleave, or k-way merged otherwise
+        :param keys: The sort keys of the concatenated files
+        :param file_ids: The file index of each row
+        :param files: The number of files
+        :return: An array with the positions of the rows in the merged order
+        """
+        runs = []
+        for file_id in range(files):
+            positions = np.flatnonzero(file_ids == file_id)
+            run_keys = keys[positions]
+            if not cls.is_sorted(run_keys):
+                order = np.argsort(run_keys, kind="stable")
+                positions, run_keys = positions[order], run_keys[order]
+            if len(positions):
+                runs.append((run_keys, positions))
+
+        runs.sort(key=lambda run: run[0][0])
+        if all(previous[0][-1] <= run[0][0] for previous, run in zip(runs, runs[1:])):
+            return np.concatenate([positions for _, positions in runs]) if runs else np.array([], dtype=np.int64)
+        merged = heapq.merge(*(zip(run_keys.tolist(), positions.tolist()) for run_keys, positions in runs))
+        return np.fromiter((position for _, position in merged), dtype=np.int64, count=len(keys))
+
+    @classmethod
+    def _check_conflicts(
+            cls, rows_df: pd.DataFrame, trade_dates: np.ndarray, accounts: np.ndarray, input_files: list,
+            lines: np.ndarray
+    ):
+        """
+        Check that there are no dates of an account that are covered by two files, where each file has orders that
+        the other doesn't have. Keeping the orders of both files would count the same position twice. A date where
+        one file's orders are a subset of the other's is merged into the other file's orders
+        :param rows_df: A DataFrame with the hash, occurrence and file index of each row
+        :param trade_dates: The trade date of each row
+        :param accounts: The account of each row
+        :param input_files: The input file paths
+        :param lines: The "file:line" of each row
+        """
+        errors = []
+        file_ids = rows_df[cls._FILE].to_numpy()
+        for account in pd.unique(accounts):
+            in_account = accounts == account
+            ranges = [  # The date range of the account's orders in each file (None if there are none)
+                (trade_dates[rows].min(), trade_dates[rows].max()) if np.any(rows) else None
+                for rows in (in_account & (file_ids == i) for i in range(len(input_files)))
+            ]
+            for i, j in ((i, j) for i in range(len(ranges)) for j in range(i + 1, len(ranges))):
+                if ranges[i] is None or ranges[j] is None:
+                    continue
+                start, end = max(ranges[i][0], ranges[j][0]), min(ranges[i][1], ranges[j][1])
+                if start > end:
+                    continue
+                overlap = in_account & np.isin(file_ids, (i, j)) & (trade_dates >= start) & (trade_dates <= end)
+                files = rows_df[overlap].groupby([cls._HASH, cls._OCCURRENCE])[cls._FILE].transform("size")
+                single_rows = np.flatnonzero(overlap)[files.to_numpy() < 2]  # Rows found in one file only
+                single_files, single_dates = file_ids[single_rows], trade_dates[single_rows]
+                conflict_dates = np.intersect1d(single_dates[single_files == i], single_dates[single_files == j])
+                conflicts = single_rows[np.isin(single_dates, conflict_dates)]
+                if len(conflicts):
+                    dates = ", ".join(pd.to_datetime(np.unique(trade_dates[conflicts])).strftime(Config.DATE_FORMAT))
+                    errors.append(f"Conflicting orders in the overlapping input files {input_files[i]} and "
+                                  f"{input_files[j]} on {dates}: lines {', '.join(lines[conflicts])}")
+        if errors:
+            raise Exception("\n".join(errors))
+
+    @classmethod
+    def merge(cls, dfs: list[pd.DataFrame], input_files: list[str], return_lines: bool = False):
+        """
+        Merge the orders of several exports: Orders that appear in more than one export are kept once, and the merged
+        orders are sorted by their symbol and then by their execution time (the orders at the same time keep the
+        order of the input files). Raises an exception if overlapping exports have conflicting orders
+        :param dfs: The Colmex Pro orders DataFrames
+        :param input_files: The input file paths of the DataFrames
+        :param return_lines: Whether to also return the input file and line of each merged order
+        :return: The merged orders DataFrame, and a string array with the "file:line" of each order if return_lines
+        """
+        columns = list(dfs[0].columns)
+        for df, input_file in zip(dfs[1:], input_files[1:]):
+            if list(df.columns) != columns:
+                raise Exception(f"The columns of {input_file} don't match the columns of {input_files[0]}")
+
+        df = pd.concat(dfs, ignore_index=True)  # Concatenate first, so the dtypes (and the hashes) are unified
+        file_ids = np.repeat(np.arange(len(dfs)), [len(file_df) for file_df in dfs])
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        rows_df = pd.DataFrame({cls._HASH: hashes, cls._FILE: file_ids})
+        # Identical rows of the same export are separate fills. The n-th of them matches the n-th in another export
+        rows_df[cls._OCCURRENCE] = rows_df.groupby([cls._FILE, cls._HASH]).cumcount()
+
+        lines = np.concatenate([
+            np.char.add(f"{input_file}:", (file_df.index.to_numpy() + 2).astype(str))  # The header is line 1
+            for file_df, input_file in zip(dfs, input_files)
+        ])
+        trade_dates = pd.to_datetime(df[Columns.TRADE_DATE], format=Config.COLMEX_PRO_MTS_DATE_FORMAT).to_numpy()
+        accounts = df[Columns.ACCOUNT].to_numpy() if Columns.ACCOUNT in df.columns else np.zeros(len(df))
+        cls._check_conflicts(rows_df, trade_dates, accounts, input_files, lines)
+
+        order = cls._get_merge_order(cls.get_sort_keys(df), file_ids, len(dfs))
+        order = order[np.argsort(df[Columns.SYMBOL].to_numpy(dtype=str)[order], kind="stable")]  # By symbol
+        df, rows_df = df.iloc[order], rows_df.iloc[order]
+        duplicated = rows_df.duplicated(subset=[cls._HASH, cls._OCCURRENCE]).to_numpy()
+        logger.info(f"Merged {len(dfs)} input files: {len(df) - duplicated.sum()} orders, "
+                    f"{duplicated.sum()} duplicate orders dropped")
+        merged_df = df[~duplicated].reset_index(drop=True)
+        if not return_lines:
+            return merged_df
+        return merged_df, lines[order][~duplicated]
@@ -1,17 +1,27 @@
-import math
+from typing import Iterable, Iterator
 
+import numpy as np
 import pandas as pd
 
 from config import Config
 from bank_of_israel_rates import BankOfIsraelRates
 from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from fixed_point import FixedPoint
 from form_1325_hebrew_text import Form1325HebrewText as Heb
+from form_1325_totals import Form1325Totals
+from logger import logger
+from matched_lots_store import MatchedLotsStore
+from progress import Progress
 
 
 class ColmexProOrdersToForm1325DF:
     COIN = "USD"
     BUY = "B"
     SELL = "S"
+    FEES = [
+        Columns.COMMISSION, Columns.SEC_FEE, Columns.TAF_FEE, Columns.ECN_FEE, Columns.ROUTING_FEE, Columns.NSCC_FEE
+    ]
+    BATCH_ORDERS = 100_000  # The orders matched at once (whole symbols)
 
     @classmethod
     def get_shares(cls, row) -> int:
@@ -25,150 +35,350 @@ class ColmexProOrdersToForm1325DF:
         else:
             return -1 * int(row[Columns.SHARES])
 
-    @staticmethod
-    def _symbol_df_to_trade_dfs(df: pd.DataFrame) -> list[pd.DataFrame]:
+    @classmethod
+    def split_trades(cls, df: pd.DataFrame) -> pd.DataFrame:
         """
-        Split the symbol DataFrame to trade DataFrames
-        :param df: A DataFrame for a certain symbol
-        :return: A list of DataFrames, split to trade DataFrames based on the Position column
+        Split the sorted orders to trades: The orders are grouped by symbol (in the order of the symbols' first
+        orders), the Position column is the symbol's running position (sell orders are positive, buy orders are
+        negative), and a trade is closed when the position is 0
+        :param df: The sorted Colmex Pro orders DataFrame, with a DateTime column (not empty)
+        :return: The orders grouped by symbol, with the Position and Trade ID columns (the trades are numbered in
+        order)
         """
-        dfs = []
-        temp_df = pd.DataFrame(columns=df.columns)  # Create an empty temp DataFrame
+        symbol_ids = pd.factorize(df[Columns.SYMBOL])[0]
+        df = df.iloc[np.argsort(symbol_ids, kind="stable")].reset_index(drop=True)
+        symbol_ids = np.sort(symbol_ids, kind="stable")
 
-        for index, row in df.iterrows():
-            temp_df = pd.concat([temp_df, row.to_frame().T], ignore_index=True)  # Add the current row to temp_df
-            if row[Columns.POSITION] == 0:  # If the Position value is 0, it means the trade is closed
-                dfs.append(temp_df.copy())  # Save the trade df to dfs
-                temp_df = pd.DataFrame(columns=df.columns)  # Reset the temp DataFrame
+        shares = df[Columns.SHARES].to_numpy(dtype=np.int64)
+        cumulative = np.cumsum(np.where(df[Columns.SIDE].to_numpy() == cls.SELL, shares, -shares))
+        symbol_starts = np.flatnonzero(np.r_[True, symbol_ids[1:] != symbol_ids[:-1]])
+        symbol_counts = np.diff(np.r_[symbol_starts, len(df)])
+        df[Columns.POSITION] = cumulative - np.repeat(np.r_[0, cumulative][symbol_starts], symbol_counts)
 
-        # Append remaining rows if last Position != 0
-        if not temp_df.empty:
-            dfs.append(temp_df)
+        # A trade starts with the symbol's first order, and after each order that closes a trade
+        trade_starts = np.zeros(len(df), dtype=bool)
+        trade_starts[symbol_starts] = True
+        trade_starts[1:] |= df[Columns.POSITION].to_numpy()[:-1] == 0
+        df[Columns.TRADE_ID] = np.cumsum(trade_starts) - 1
+        return df
 
-        return dfs
+    @staticmethod
+    def _get_fixed_rates(df: pd.DataFrame, rates: dict) -> np.ndarray:
+        """
+        Get the rate of each order's date. Each date is looked up once
+        :param df: The orders DataFrame, with a DateTime column
+        :param rates: The rates dictionary
+        :return: An int64 array of fixed-point rates (0 for dates without a rate)
+        """
+        days, day_ids = np.unique(pd.to_datetime(df[Columns.DATETIME]).to_numpy().astype("datetime64[D]"),
+                                  return_inverse=True)
+        day_rates = [rates.get(day, 0) for day in np.datetime_as_string(days)]  # ISO dates (Config.DATE_FORMAT)
+        return FixedPoint.to_fixed(day_rates, FixedPoint.RATE_SCALE)[day_ids.reshape(-1)]
 
-    @classmethod
-    def _get_trade_dfs(cls, df: pd.DataFrame) -> list[pd.DataFrame]:
+    @staticmethod
+    def _get_slice_amounts(
+            amounts: np.ndarray, shares: np.ndarray, ends: np.ndarray, sliced_shares: np.ndarray, rates: np.ndarray
+    ) -> np.ndarray:
         """
-        Split the DataFrame to symbol DataFrames, and then to trade DataFrames
-        :param df: The DataFrame
-        :return: A list of trade DataFrames
+        Get the ILS amounts (ILS_FINE_SCALE) of slices of orders: A slice's amount is the difference of the order's
+        rounded cumulative amounts at the slice's end and start, so the slices of an order add up to the order's whole
+        amount exactly (like when they are aggregated). The products can exceed int64 for large notionals, so they are
+        calculated without being formed (mul_div_mul_round)
+        :param amounts: The USD amounts of the orders (USD_SCALE)
+        :param shares: The shares of the orders
+        :param ends: The end of each slice within its order (in shares)
+        :param sliced_shares: The shares of each slice
+        :param rates: The rate of each slice (RATE_SCALE)
+        :return: An int64 array with the ILS amounts of the slices
         """
-        symbol_dfs = df.groupby([Columns.SYMBOL], sort=False)  # Split to DataFrames based on the symbol
-        trade_dfs = []
-        for key, symbol_df in symbol_dfs:
-            symbol_df[Columns.POSITION] = symbol_df.apply(cls.get_shares, axis=1).cumsum()  # Update Position column
-            trade_dfs.extend(cls._symbol_df_to_trade_dfs(symbol_df))  # Save the symbol's trade dfs to a list
-        return trade_dfs
+        return FixedPoint.mul_div_mul_round(amounts, ends, shares, rates) - \
+            FixedPoint.mul_div_mul_round(amounts, ends - sliced_shares, shares, rates)
 
     @classmethod
-    def _trade_df_to_form1325_rows(cls, df: pd.DataFrame, rates: dict) -> list[dict]:
+    def match_trades(cls, df: pd.DataFrame, rates: dict) -> pd.DataFrame:
         """
-        Transform the trade DataFrame to a list of rows in form 1325 format
-        :param df: The trade DataFrame
+        Match the sell orders of each trade with its buy orders FIFO (the oldest buy order first), for all the trades
+        at once: Each trade gets its own range of a global shares axis, so the cumulative bought and sold shares of all
+        the trades are increasing, and each matched lot lies between two consecutive points of them. All the amounts
+        are calculated in fixed-point integers
+        :param df: The orders split to trades (see split_trades)
         :param rates: The rates dictionary
-        :return: A list of form 1325 dictionary rows
-        """
-        results = []
-
-        # Calculate total commissions and fees
-        commissions_and_fees = df[Columns.COMMISSION].astype(float) + df[Columns.SEC_FEE].astype(float) + \
-            df[Columns.TAF_FEE].astype(float) + df[Columns.ECN_FEE].astype(float) + \
-            df[Columns.ROUTING_FEE].astype(float) + df[Columns.NSCC_FEE].astype(float)
-
-        # Create a copy of the Shares column, for changing the value during iteration & also keeping the original number
-        df[Columns.SHARES] = df[Columns.SHARES].astype(int)
-        df[Columns.QUANTITY] = df[Columns.SHARES]
-
-        # Separate Buy and Sell transactions
-        buys = df[df[Columns.SIDE] == cls.BUY].copy()
-        sells = df[df[Columns.SIDE] == cls.SELL].copy()
-
-        # Calculate amount including commissions
-        buys[Columns.AMOUNT] = buys[Columns.QUANTITY] * buys[Columns.PRICE].astype(float) + commissions_and_fees
-        sells[Columns.AMOUNT] = sells[Columns.QUANTITY] * sells[Columns.PRICE].astype(float) - commissions_and_fees
-
-        # Iterate over sell orders
-        for sell_index, sell in sells.iterrows():
-            shares_to_sell = sell[Columns.QUANTITY]
-
-            # Iterate over buy orders
-            while shares_to_sell > 0:
-                buy = buys[buys[Columns.QUANTITY] > 0].iloc[0]  # Find the oldest relevant buy order
-                buy_index = buy.name
-                buy_rate = rates.get(buy[Columns.DATETIME].strftime(Config.DATE_FORMAT), 0)
-                sell_rate = rates.get(sell[Columns.DATETIME].strftime(Config.DATE_FORMAT), 0)
-
-                # Determine the shares and price for this transaction
-                if buy[Columns.QUANTITY] <= shares_to_sell:  # There are more or same amount of shares bought as to sell
-                    shares_sold = buy[Columns.QUANTITY]
-                    shares_to_sell -= buy[Columns.QUANTITY]
-                    buys.at[buy_index, Columns.QUANTITY] = 0  # All of this buy order is used up
-                else:  # There are more buy shares than sell shares, meaning the sell order is complete
-                    shares_sold = shares_to_sell
-                    buys.at[buy_index, Columns.QUANTITY] -= shares_to_sell
-                    shares_to_sell = 0  #
-
-                rate_change = 1 + ((sell_rate - buy_rate) / buy_rate)  # Calculate the currency rate change
-                # Calculate the amounts, the profit and the loss
-                amount_sell = sell[Columns.AMOUNT] * (shares_sold / sell[Columns.SHARES]) * sell_rate
-                amount_buy = buy[Columns.AMOUNT] * (shares_sold / buy[Columns.SHARES]) * buy_rate
-                amount_buy_adjusted = amount_buy * rate_change
-                profit_loss = cls._get_profit_loss(amount_buy, amount_buy_adjusted, amount_sell)
-
-                # Create a dictionary row in form 1325 format. Use Hebrew column headers
-                row = {
-                    Heb.SYMBOL: sell[Columns.SYMBOL],
-                    Heb.BOUGHT_DURING_PRE_MARKET: "",
-                    Heb.SHARES: shares_sold,
-                    Heb.BUY_DATE: buy[Columns.TRADE_DATE],
-                    Heb.BUY_AMOUNT: amount_buy,
-                    Heb.RATE_CHANGE: rate_change,
-                    Heb.BUY_AMOUNT_ADJUSTED: amount_buy_adjusted,
-                    Heb.SELL_DATE: sell[Columns.TRADE_DATE],
-                    Heb.SELL_AMOUNT: amount_sell,
-                    Heb.PROFIT: "" if profit_loss <= 0 else profit_loss,
-                    Heb.LOSS: "" if profit_loss >= 0 else profit_loss,
-                }
-                results.append(row)
-        return results
+        :return: A DataFrame of the matched lots in form 1325 format, without the profit and the loss, with the ILS
+        amounts before rounding (ILS_FINE_SCALE, see round_lots), and the Trade ID column
+        """
+        # Calculate amount including commissions and fees
+        shares = df[Columns.SHARES].to_numpy(dtype=np.int64)
+        is_buy = (df[Columns.SIDE] == cls.BUY).to_numpy()
+        is_sell = (df[Columns.SIDE] == cls.SELL).to_numpy()
+        commissions_and_fees = FixedPoint.to_fixed(df[cls.FEES].astype(float).sum(axis=1), FixedPoint.USD_SCALE)
+        amounts = FixedPoint.multiply(shares, FixedPoint.to_fixed(df[Columns.PRICE], FixedPoint.USD_SCALE))
+        amounts = np.where(is_buy, amounts + commissions_and_fees, amounts - commissions_and_fees)
+        fixed_rates = cls._get_fixed_rates(df, rates)
+
+        # The bought and sold shares of each trade
+        trade_ids = df[Columns.TRADE_ID].to_numpy()
+        trade_starts = np.flatnonzero(np.r_[True, trade_ids[1:] != trade_ids[:-1]])
+        bought = np.add.reduceat(np.where(is_buy, shares, 0), trade_starts)
+        sold = np.add.reduceat(np.where(is_sell, shares, 0), trade_starts)
+        if (sold > bought).any():
+            symbol = df[Columns.SYMBOL].iloc[trade_starts[np.argmax(sold > bought)]]
+            raise Exception(f"Not enough bought shares of {symbol} to match the sell orders")
+
+        # Place each trade's cumulative shares in the trade's range of the global axis
+        offsets = np.r_[0, np.cumsum(bought)[:-1]]  # A trade's range is its bought shares (at least the sold ones)
+        buys, sells = np.flatnonzero(is_buy), np.flatnonzero(is_sell)
+        cumulative_bought = np.cumsum(shares[buys]) - (np.cumsum(bought) - bought - offsets)[trade_ids[buys]]
+        cumulative_sold = np.cumsum(shares[sells]) - (np.cumsum(sold) - sold - offsets)[trade_ids[sells]]
+
+        # Match FIFO: The lots between the points of the bought and sold shares, within the sold part of each range
+        ends = np.union1d(cumulative_bought, cumulative_sold)
+        starts = np.r_[0, ends][:-1]
+        buy_positions = np.searchsorted(cumulative_bought, starts, side="right")
+        sell_positions = np.searchsorted(cumulative_sold, starts, side="right")
+        matched = sell_positions < len(sells)
+        matched[matched] = trade_ids[sells[sell_positions[matched]]] == trade_ids[buys[buy_positions[matched]]]
+        buy_rows, sell_rows = buys[buy_positions[matched]], sells[sell_positions[matched]]
+        shares_sold = (ends - starts)[matched]
+        # The end of each lot within its buy order and within its sell order (in shares)
+        buy_ends = ends[matched] - cumulative_bought[buy_positions[matched]] + shares[buy_rows]
+        sell_ends = ends[matched] - cumulative_sold[sell_positions[matched]] + shares[sell_rows]
+
+        buy_rates, sell_rates = fixed_rates[buy_rows], fixed_rates[sell_rows]
+        if (buy_rates == 0).any():
+            dates = pd.unique(df[Columns.TRADE_DATE].to_numpy()[buy_rows[buy_rates == 0]])
+            raise Exception(f"Missing currency rates for the buy dates: {', '.join(dates)}")
+
+        # Calculate the ILS amounts of the USD slices (ILS_FINE_SCALE)
+        amount_sell = cls._get_slice_amounts(amounts[sell_rows], shares[sell_rows], sell_ends, shares_sold, sell_rates)
+        amount_buy = cls._get_slice_amounts(amounts[buy_rows], shares[buy_rows], buy_ends, shares_sold, buy_rates)
+        # The buy amount times the rate change (sell rate / buy rate) is the USD buy amount at the sell rate
+        amount_buy_adjusted = cls._get_slice_amounts(
+            amounts[buy_rows], shares[buy_rows], buy_ends, shares_sold, sell_rates
+        )
+
+        # The currency rate change, calculated from the float rates like in the reference engine
+        buy_float_rates, sell_float_rates = (FixedPoint.to_float(fixed, FixedPoint.RATE_SCALE)
+                                             for fixed in (buy_rates, sell_rates))
+        rate_changes = 1 + (sell_float_rates - buy_float_rates) / buy_float_rates
+
+        # Create the matched lots in form 1325 format. Use Hebrew column headers
+        trade_dates = df[Columns.TRADE_DATE].to_numpy()
+        return pd.DataFrame({
+            Heb.SYMBOL: df[Columns.SYMBOL].to_numpy()[sell_rows],
+            Heb.BOUGHT_DURING_PRE_MARKET: "",
+            Heb.SHARES: shares_sold,
+            Heb.BUY_DATE: trade_dates[buy_rows],
+            Heb.BUY_AMOUNT: amount_buy,
+            Heb.RATE_CHANGE: rate_changes,
+            Heb.BUY_AMOUNT_ADJUSTED: amount_buy_adjusted,
+            Heb.SELL_DATE: trade_dates[sell_rows],
+            Heb.SELL_AMOUNT: amount_sell,
+            Columns.TRADE_ID: trade_ids[sell_rows],
+        })
 
     @staticmethod
-    def _get_profit_loss(amount_buy: float, amount_buy_adjusted: float, amount_sell: float) -> float:
+    def _get_profit_loss(
+            amount_buy: np.ndarray, amount_buy_adjusted: np.ndarray, amount_sell: np.ndarray
+    ) -> np.ndarray:
         """
         The profit and loss can be calculated based on the buy amount and also based on the adjusted buy amount, so
         according to Israeli law, the calculation should be the value closer to 0 (positive or negative) between both
         of the options. If one of them is positive and one is negative, there is 0 profit and 0 loss
-        :param amount_buy: The amount bought
-        :param amount_buy_adjusted: The amount bought, adjusted by the rate change
-        :param amount_sell: The amount sold
-        :return: A float representing the profit or loss
+        :param amount_buy: The amounts bought
+        :param amount_buy_adjusted: The amounts bought, adjusted by the rate change
+        :param amount_sell: The amounts sold
+        :return: An array with the profit (positive) or loss (negative) of each amount
         """
-        if math.copysign(1, amount_sell - amount_buy_adjusted) != math.copysign(1, amount_sell - amount_buy):
-            return 0
-        sign = math.copysign(1, amount_sell - amount_buy_adjusted)
-        return sign * min(abs(amount_sell - amount_buy_adjusted), abs(amount_sell - amount_buy))
+        difference, adjusted_difference = amount_sell - amount_buy, amount_sell - amount_buy_adjusted
+        is_profit = adjusted_difference >= 0
+        profit_loss = np.minimum(np.abs(adjusted_difference), np.abs(difference))
+        return np.where(is_profit != (difference >= 0), 0, np.where(is_profit, profit_loss, -profit_loss))
 
     @classmethod
-    def transform(cls, df: pd.DataFrame, rates: dict) -> pd.DataFrame:
+    def _aggregate_lots(cls, lots: pd.DataFrame) -> pd.DataFrame:
         """
-        Transform the Colmex Pro orders DataFrame to form 1325 DataFrame
+        Combine the matched lots with the same symbol, buy date and sell date into one row. The shares and the amounts
+        (before rounding) are summed
+        :param lots: The matched lots (see match_trades)
+        :return: The aggregated rows, in the order of their first matched lot
+        """
+        keys = [Heb.SYMBOL, Heb.BUY_DATE, Heb.SELL_DATE]
+        amounts = [Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT]
+        float_sums = lots[amounts].abs().astype(float).groupby([lots[key] for key in keys]).sum()
+        if (float_sums.to_numpy() >= FixedPoint.MAX).any():  # The int64 sums would overflow
+            raise Exception("The amounts are too large for the fixed-point int64 arithmetic")
+        # The rate change is the same for the same buy and sell dates
+        aggregations = {column: "sum" if column in [Heb.SHARES] + amounts else "first"
+                        for column in lots.columns if column not in keys}
+        return lots.groupby(keys, sort=False).agg(aggregations).reset_index()[lots.columns]
+
+    @classmethod
+    def round_lots(cls, lots: pd.DataFrame) -> pd.DataFrame:
+        """
+        Round the ILS amounts of the matched lots (or of the aggregated rows) to the agora, once, half away from zero,
+        and calculate the profit or loss from the rounded amounts
+        :param lots: The matched lots (see match_trades)
+        :return: The rows with the ILS amounts in agorot, and the profit and loss columns (0 when there is none)
+        """
+        lots = lots.copy()
+        for column in Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT:
+            lots[column] = FixedPoint.div_round(lots[column], FixedPoint.ILS_FINE_SCALE // FixedPoint.ILS_SCALE)
+        profit_loss = cls._get_profit_loss(
+            *(lots[column].to_numpy() for column in (Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT))
+        )
+        position = lots.columns.get_loc(Heb.SELL_AMOUNT) + 1
+        lots.insert(position, Heb.PROFIT, np.maximum(profit_loss, 0))
+        lots.insert(position + 1, Heb.LOSS, np.minimum(profit_loss, 0))
+        return lots
+
+    @classmethod
+    def consolidate_fills(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Consolidate partial fills: Fills of the same account, symbol and side, with the same price and at the same
+        second, are merged into one order with the total shares and fees
         :param df: The Colmex Pro orders DataFrame
-        :param rates: The rates dictionary
-        :return: A DataFrame with rows in form 1325 format
+        :return: The consolidated orders DataFrame. The Lineage column has the input file line numbers of the fills
+        that were merged into each order
+        """
+        keys = [column for column in (Columns.ACCOUNT, Columns.TRADE_DATE, Columns.EXEC_TIME, Columns.SYMBOL,
+                                      Columns.SIDE, Columns.PRICE) if column in df.columns]
+        df = df.astype({Columns.SHARES: np.int64, **{fee: float for fee in cls.FEES}})
+        line_numbers = pd.Series(df.index + 2, index=df.index).astype(str)  # The header is line 1
+
+        groups = df.groupby(keys, sort=False, dropna=False)
+        aggregations = {column: "first" for column in df.columns if column not in keys}
+        aggregations.update({column: "sum" for column in [Columns.SHARES] + cls.FEES})
+        consolidated_df = groups.agg(aggregations).reset_index()[df.columns]
+        consolidated_df[Columns.LINEAGE] = line_numbers.groupby([df[key] for key in keys], sort=False, dropna=False).\
+            agg(";".join).to_numpy()
+        return consolidated_df
+
+    @staticmethod
+    def is_sorted(df: pd.DataFrame) -> bool:
+        """
+        Check in a single pass whether the DataFrame is sorted by the DateTime column, then by symbol and then by price
+        :param df: The Colmex Pro orders DataFrame, with a DateTime column
+        :return: True if the DataFrame is sorted
+        """
+        datetimes, symbols, prices = (df[column].to_numpy() for column in (Columns.DATETIME, Columns.SYMBOL,
+                                                                           Columns.PRICE))
+        same_datetime = datetimes[1:] == datetimes[:-1]
+        same_symbol = same_datetime & (symbols[1:] == symbols[:-1])
+        return bool(
+            np.all(datetimes[1:] >= datetimes[:-1])
+            and np.all(~same_datetime | (symbols[1:] >= symbols[:-1]))
+            and np.all(~same_symbol | (prices[1:] >= prices[:-1]))
+        )
+
+    @classmethod
+    def sort(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Create a DateTime column and sort by it, then by symbol and then by price. Already sorted orders (like exports
+        in execution order) are not sorted again
+        :param df: The Colmex Pro orders DataFrame
+        :return: The sorted DataFrame, with a DateTime column
         """
-        # Create a DateTime column and sort by it, then by symbol and then by price
         fmt = f"{Config.COLMEX_PRO_MTS_DATE_FORMAT} {Config.TIME_FORMAT}"
         df[Columns.DATETIME] = pd.to_datetime(df[Columns.TRADE_DATE] + " " + df[Columns.EXEC_TIME], format=fmt)
-        df = df.sort_values(by=[Columns.DATETIME, Columns.SYMBOL, Columns.PRICE])
+        if cls.is_sorted(df):
+            return df
+        return df.sort_values(by=[Columns.DATETIME, Columns.SYMBOL, Columns.PRICE])
+
+    @classmethod
+    def _get_batches(cls, dfs: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        Split the sorted orders DataFrames to batches of whole symbols, of up to about BATCH_ORDERS orders, so the
+        matched lots of a batch are written to the store before the next batch is matched
+        :param dfs: An iterable of sorted Colmex Pro orders DataFrames
+        :return: A generator of the sorted batch DataFrames
+        """
+        for df in dfs:
+            if len(df) <= cls.BATCH_ORDERS:
+                if len(df):
+                    yield df
+                continue
+            symbol_ids, symbols = pd.factorize(df[Columns.SYMBOL])
+            symbol_orders = np.bincount(symbol_ids, minlength=len(symbols))
+            symbol_batches = (np.cumsum(symbol_orders) - symbol_orders) // cls.BATCH_ORDERS
+            batch_ids = symbol_batches[symbol_ids]
+            for batch_id in np.unique(batch_ids):
+                yield df[batch_ids == batch_id]
+
+    @classmethod
+    def transform(
+            cls, df: pd.DataFrame, rates: dict, store: MatchedLotsStore = None, totals: Form1325Totals = None,
+            aggregate: bool = False, progress: Progress = None
+    ) -> pd.DataFrame:
+        """
+        Transform the Colmex Pro orders DataFrame to form 1325 DataFrame
+        :param df: The Colmex Pro orders DataFrame
+        :param rates: The rates dictionary
+        :param store: A matched lots store. If passed, the rows are written to the store as they are matched, instead
+        of being collected into a DataFrame
+        :param totals: Running totals to add the rows to as they are matched
+        :param aggregate: Whether to combine the matched lots with the same symbol, buy date and sell date into one row
+        :param progress: Reports the matched symbols, and stops the matching when the run is cancelled
+        :return: A DataFrame with rows in form 1325 format, or None when the rows are written to the store
+        """
+        symbols = df[Columns.SYMBOL].nunique() if progress is not None else None
+        return cls.transform_sorted([cls.sort(df)], rates, store, totals, aggregate, progress, symbols)
+
+    @classmethod
+    def transform_sorted(
+            cls, dfs: Iterable[pd.DataFrame], rates: dict, store: MatchedLotsStore = None,
+            totals: Form1325Totals = None, aggregate: bool = False, progress: Progress = None, symbols: int = None
+    ) -> pd.DataFrame:
+        """
+        Transform sorted Colmex Pro orders DataFrames to form 1325 DataFrame. All the orders of a symbol must be in
+        the same DataFrame, so the DataFrames can be streamed one symbol at a time (see ExternalSort)
+        :param dfs: An iterable of sorted Colmex Pro orders DataFrames, with a DateTime column
+        :param rates: The rates dictionary
+        :param store: A matched lots store. If passed, the rows are written to the store as they are matched, instead
+        of being collected into a DataFrame
+        :param totals: Running totals to add the rows to as they are matched
+        :param aggregate: Whether to combine the matched lots with the same symbol, buy date and sell date into one row
+        :param progress: Reports the matched symbols, and stops the matching when the run is cancelled
+        :param symbols: The number of symbols, for the progress (None if unknown)
+        :return: A DataFrame with rows in form 1325 format, or None when the rows are written to the store
+        """
+        lots_dfs = []
+        matched_lots = output_rows = matched_symbols = 0
+        for batch_df in cls._get_batches(dfs):
+            lots = cls.match_trades(cls.split_trades(batch_df), rates).drop(columns=Columns.TRADE_ID)
+            matched_lots += len(lots)
+            if aggregate:
+                lots = cls._aggregate_lots(lots)
+            lots = cls.round_lots(lots)
+            output_rows += len(lots)
+            if totals is not None or store is not None:
+                rows = lots.to_dict(orient="records")
+                if totals is not None:
+                    totals.add(rows)
+                if store is not None:
+                    store.append(rows)
+            if store is None:
+                lots_dfs.append(lots)
+            matched_symbols += batch_df[Columns.SYMBOL].nunique()
+            if progress is not None:
+                progress.update(Progress.MATCH, matched_symbols, symbols)
+
+        if aggregate:
+            reduction = 100 * (1 - output_rows / matched_lots) if matched_lots else 0
+            logger.info(f"Aggregated {matched_lots} matched lots into {output_rows} rows ({reduction:.1f}% fewer rows)")
+
+        if store is not None:
+            store.close()
+            return None
 
-        trade_dfs = cls._get_trade_dfs(df)  # Get a list of trade DataFrames
-        form1325_rows = []
-        for trade_df in trade_dfs:
-            trade_1325_rows = cls._trade_df_to_form1325_rows(trade_df, rates)  # Get the form 1325 rows
-            form1325_rows.extend(trade_1325_rows)
+        transformed_df = pd.concat(lots_dfs, ignore_index=True) if lots_dfs else pd.DataFrame()
 
-        transformed_df = pd.DataFrame(form1325_rows)
+        # Convert the amounts from agorot to ILS. There is no profit or loss in the rows of the other one
+        for column in Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT:
+            transformed_df[column] = FixedPoint.to_float(transformed_df[column], FixedPoint.ILS_SCALE)
+        for column in Heb.PROFIT, Heb.LOSS:
+            values = transformed_df[column]
+            transformed_df[column] = FixedPoint.to_float(values, FixedPoint.ILS_SCALE).astype(object).\
+                mask(values == 0, "")
 
         # Add a Row Number column and move it to the beginning
         transformed_df[Columns.ROW_NUMBER] = transformed_df.reset_index().index + 1
@@ -182,11 +392,15 @@ class ColmexProOrdersToForm1325DF:
         return transformed_df
 
     @classmethod
-    def run(cls, df: pd.DataFrame, year: int) -> pd.DataFrame:
+    def run(
+            cls, df: pd.DataFrame, year: int, store: MatchedLotsStore = None, totals: Form1325Totals = None,
+            rates: dict = None, aggregate: bool = False, progress: Progress = None
+    ) -> pd.DataFrame:
         """
         Get a form 1325 rows DataFrame from a csv with Colmex Pro orders data
-        :return: A DataFrame with the form 1325 rows data
+        :return: A DataFrame with the form 1325 rows data (None when the rows are written to the store)
         """
-        rates = BankOfIsraelRates.get_rates(year, cls.COIN)  # Get the currency rates
-        transformed_df = cls.transform(df, rates)
+        if rates is None:
+            rates = BankOfIsraelRates.get_rates(year, cls.COIN)  # Get the currency rates
+        transformed_df = cls.transform(df, rates, store, totals, aggregate, progress)
         return transformed_df
@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from config import Config
+
+
+class ColmexProOrdersValidator:
+    """
+    Validate the Colmex Pro orders right after they are read, before the expensive steps. All the checks are
+    vectorized, and every offending line of the input file is reported in a single exception, instead of failing on
+    the first bad order deep in the pipeline.
+    """
+    SIDES = [ColmexProOrdersToForm1325DF.BUY, ColmexProOrdersToForm1325DF.SELL]
+    REQUIRED_COLUMNS = [
+        Columns.TRADE_DATE, Columns.EXEC_TIME, Columns.SIDE, Columns.SYMBOL, Columns.SHARES, Columns.PRICE,
+        *ColmexProOrdersToForm1325DF.FEES
+    ]
+    NOT_EMPTY_COLUMNS = [  # The fees can be empty
+        Columns.TRADE_DATE, Columns.EXEC_TIME, Columns.SIDE, Columns.SYMBOL, Columns.SHARES, Columns.PRICE
+    ]
+
+    @staticmethod
+    def get_lines(df: pd.DataFrame) -> np.ndarray:
+        """
+        :param df: The Colmex Pro orders DataFrame, as read from the input file
+        :return: An array with the input file line number of each order (the header is line 1)
+        """
+        return df.index.to_numpy() + 2
+
+    @staticmethod
+    def _get_error(message: str, lines: np.ndarray, mask) -> list[tuple]:
+        """
+        :param message: The error message
+        :param lines: The line of each order
+        :param mask: A boolean array of the offending orders
+        :return: A list with the error message and the offending lines, or an empty list if there are none
+        """
+        offending_lines = lines[np.asarray(mask, dtype=bool)]
+        if not len(offending_lines):
+            return []
+        return [(message, offending_lines)]
+
+    @staticmethod
+    def _to_numeric(series: pd.Series) -> pd.Series:
+        """
+        :param series: A column
+        :return: The column as numbers, with NaN for the values that are not numbers
+        """
+        if pd.api.types.is_numeric_dtype(series):
+            return series.astype(float)
+        return pd.to_numeric(series, errors="coerce")
+
+    @staticmethod
+    def _parse(series: pd.Series, fmt: str) -> pd.Series:
+        """
+        Parse a dates or times column. Each distinct value is parsed once, as there are few of them
+        :param series: The column
+        :param fmt: The format
+        :return: The parsed values (NaT for empty or invalid values)
+        """
+        codes, uniques = pd.factorize(series)
+        parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format=fmt, errors="coerce").to_numpy()
+        return pd.Series(np.where(codes >= 0, parsed[codes], np.datetime64("NaT")), index=series.index)
+
+    @classmethod
+    def _check_rows(cls, df: pd.DataFrame, lines: np.ndarray, dates: pd.Series, times: pd.Series) -> list[tuple]:
+        """
+        Check the values of each order: Missing values, sides, dtypes, non-negative shares and fees, and dates
+        :return: A list of errors
+        """
+        errors = []
+        empty = df[cls.NOT_EMPTY_COLUMNS].isna()
+        for column in cls.NOT_EMPTY_COLUMNS:
+            errors += cls._get_error(f"Missing {column}", lines, empty[column])
+
+        errors += cls._get_error(
+            f"Unknown {Columns.SIDE} (must be {' or '.join(cls.SIDES)})", lines,
+            ~df[Columns.SIDE].isin(cls.SIDES) & ~empty[Columns.SIDE]
+        )
+        shares = cls._to_numeric(df[Columns.SHARES])
+        errors += cls._get_error(
+            f"{Columns.SHARES} must be a non-negative whole number", lines,
+            ~empty[Columns.SHARES] & ~((shares >= 0) & (shares % 1 == 0))
+        )
+        price = cls._to_numeric(df[Columns.PRICE])
+        errors += cls._get_error(f"{Columns.PRICE} must be a positive number", lines,
+                                    ~empty[Columns.PRICE] & ~(price > 0))
+        for fee in ColmexProOrdersToForm1325DF.FEES:
+            errors += cls._get_error(f"{fee} must be a non-negative number", lines,
+                                        df[fee].notna() & ~(cls._to_numeric(df[fee]) >= 0))
+
+        errors += cls._get_error(f"Invalid {Columns.TRADE_DATE} (must be MM/DD/YYYY)", lines,
+                                    ~empty[Columns.TRADE_DATE] & dates.isna())
+        errors += cls._get_error(f"Invalid {Columns.EXEC_TIME} (must be HH:MM:SS)", lines,
+                                    ~empty[Columns.EXEC_TIME] & times.isna())
+        return errors
+
+    @classmethod
+    def _check_year(cls, dates: pd.Series, lines: np.ndarray, year: int = None) -> list[tuple]:
+        """
+        Check that all the orders are from the same year (the year of most of the orders, if not passed)
+        :return: A list of errors
+        """
+        years = dates.dt.year.to_numpy()
+        if not len(years):
+            return []
+        if year is None:
+            values, counts = np.unique(years, return_counts=True)
+            year = values[np.argmax(counts)]
+        return cls._get_error(f"Only orders from one year are supported, these orders are not from {year}", lines,
+                                 years != year)
+
+    @classmethod
+    def _check_positions(cls, df: pd.DataFrame, datetimes: pd.Series, lines: np.ndarray, by_account: bool) -> \
+            list[tuple]:
+        """
+        Check the position feasibility: The sold shares of each symbol must not exceed the bought shares when the
+        orders are matched, so there must be no open short position after the last order of a symbol
+        :return: A list of errors
+        """
+        keys = [Columns.ACCOUNT, Columns.SYMBOL] if by_account else [Columns.SYMBOL]
+        group_ids = df.groupby(keys, sort=False).ngroup().to_numpy()
+        # The orders of each symbol in the order they are matched in: By execution time and then by price
+        order = np.lexsort((cls._to_numeric(df[Columns.PRICE]).to_numpy(), datetimes.to_numpy(), group_ids))
+        group_ids = group_ids[order]
+        is_sell = (df[Columns.SIDE] == ColmexProOrdersToForm1325DF.SELL).to_numpy()[order]
+        shares = cls._to_numeric(df[Columns.SHARES]).to_numpy().astype(np.int64)[order]
+        positions = pd.Series(np.where(is_sell, shares, -shares)).groupby(group_ids)
+        position = positions.cumsum().to_numpy()
+        final_position = positions.transform("sum").to_numpy()
+
+        # The orders after the last closed trade of each symbol are its open trade
+        closed = pd.Series(position == 0).groupby(group_ids)
+        is_open_trade = (closed.cumsum() == closed.transform("sum")).to_numpy() & (position != 0)
+        infeasible = is_sell & is_open_trade & (final_position > 0)
+
+        errors = []
+        symbols = df[Columns.SYMBOL].to_numpy()[order]
+        for symbol in pd.unique(symbols[infeasible]):
+            mask = np.zeros(len(df), dtype=bool)
+            mask[order[infeasible & (symbols == symbol)]] = True
+            errors += cls._get_error(f"More shares of {symbol} are sold than bought", lines, mask)
+        return errors
+
+    @classmethod
+    def validate(cls, df: pd.DataFrame, lines: np.ndarray = None, by_account: bool = False, input_file=None,
+                 check_orders: bool = True):
+        """
+        Validate the orders: The schema, the dtypes, the sides, non-negative shares and fees, the dates and the year
+        and the position feasibility of each symbol
+        :param df: The Colmex Pro orders DataFrame
+        :param lines: The line of each order (the input file line numbers if not passed)
+        :param by_account: Whether the positions are matched per account
+        :param input_file: The input file path, for the error message
+        :param check_orders: Whether to check the year and the positions, which depend on all the orders together
+        """
+        lines = cls.get_lines(df) if lines is None else lines
+        missing_columns = [column for column in cls.REQUIRED_COLUMNS if column not in df.columns]
+        if by_account and Columns.ACCOUNT not in df.columns:
+            missing_columns.append(Columns.ACCOUNT)
+        if missing_columns:
+            cls.raise_errors([(f"Missing columns: {', '.join(missing_columns)}", None)], input_file)
+
+        dates = cls._parse(df[Columns.TRADE_DATE], Config.COLMEX_PRO_MTS_DATE_FORMAT)
+        times = cls._parse(df[Columns.EXEC_TIME], Config.TIME_FORMAT)
+        errors = cls._check_rows(df, lines, dates, times)
+        if check_orders and not errors:  # The checks below need valid values
+            errors = cls._check_orders(df, lines, by_account, dates=dates, times=times)
+        cls.raise_errors(errors, input_file)
+
+    @classmethod
+    def _check_orders(cls, df: pd.DataFrame, lines: np.ndarray, by_account: bool = False, year: int = None,
+                      dates: pd.Series = None, times: pd.Series = None) -> list[tuple]:
+        """
+        Check the orders that depend on each other: The year and the position feasibility of each symbol
+        :return: A list of errors
+        """
+        if dates is None:
+            dates = cls._parse(df[Columns.TRADE_DATE], Config.COLMEX_PRO_MTS_DATE_FORMAT)
+            times = cls._parse(df[Columns.EXEC_TIME], Config.TIME_FORMAT)
+        datetimes = dates + (times - times.dt.normalize())
+        return cls._check_year(dates, lines, year) + cls._check_positions(df, datetimes, lines, by_account)
+
+    @classmethod
+    def check_symbol(cls, df: pd.DataFrame, year: int, rates: dict) -> list[tuple]:
+        """
+        Check the orders of one symbol, whose rows were already validated (see validate with check_orders=False):
+        The year, the position feasibility and the rate coverage. Used when the orders are validated one symbol at a
+        time, and the errors of all the symbols are raised together with raise_errors
+        :param df: The Colmex Pro orders DataFrame of a symbol, indexed like the input file
+        :param year: The year of the orders
+        :param rates: The rates dictionary
+        :return: A list of errors
+        """
+        lines = cls.get_lines(df)
+        return cls._check_orders(df, lines, year=year) + cls._check_rates(df, rates, lines)
+
+    @classmethod
+    def _check_rates(cls, df: pd.DataFrame, rates: dict, lines: np.ndarray) -> list[tuple]:
+        """
+        Check the rate coverage: Every trade date must have a currency rate
+        :return: A list of errors
+        """
+        codes, trade_dates = pd.factorize(df[Columns.TRADE_DATE])
+        dates = pd.to_datetime(pd.Series(trade_dates), format=Config.COLMEX_PRO_MTS_DATE_FORMAT).\
+            dt.strftime(Config.DATE_FORMAT)
+        errors = []
+        for i in np.flatnonzero(~(dates.map(rates).fillna(0) > 0).to_numpy()):
+            errors += cls._get_error(f"Missing currency rate for {dates[i]}", lines, codes == i)
+        return errors
+
+    @classmethod
+    def validate_rates(cls, df: pd.DataFrame, rates: dict, lines: np.ndarray = None, input_file=None):
+        """
+        Validate the rate coverage: Every trade date must have a currency rate
+        :param df: The Colmex Pro orders DataFrame
+        :param rates: The rates dictionary
+        :param lines: The line of each order (the input file line numbers if not passed)
+        :param input_file: The input file path, for the error message
+        """
+        lines = cls.get_lines(df) if lines is None else lines
+        cls.raise_errors(cls._check_rates(df, rates, lines), input_file)
+
+    @staticmethod
+    def raise_errors(errors: list[tuple], input_file=None):
+        """
+        Raise an exception with all the errors, if there are any. The lines of the same error message (found in
+        different parts of the orders, like different symbols) are listed together
+        :param errors: A list of the error messages and their offending lines (None for an error without lines)
+        :param input_file: The input file path, for the error message
+        """
+        if not errors:
+            return
+        messages = {}
+        for message, lines in errors:
+            messages.setdefault(message, []).append(lines)
+        formatted_errors = []
+        for message, parts in messages.items():
+            if parts[0] is None:
+                formatted_errors.append(message)
+                continue
+            lines = parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+            formatted_errors.append(f"{message}: line{'s' if len(lines) > 1 else ''} {', '.join(map(str, lines))}")
+        source = f" in {input_file}" if isinstance(input_file, str) else ""
+        raise Exception(f"Invalid orders{source}:\n" + "\n".join(formatted_errors))
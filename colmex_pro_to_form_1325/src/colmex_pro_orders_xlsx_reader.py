@@ -0,0 +1,120 @@
+from datetime import date, datetime, time
+from itertools import islice
+
+import pandas as pd
+
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from config import Config
+
+
+class ColmexProOrdersXLSXReader:
+    """
+    Read the Colmex Pro orders Excel export directly, without converting it to CSV first. The workbook is opened in
+    read-only mode, so its rows are streamed from the file instead of loading the whole workbook into memory, and
+    they are turned into the same columns (and values) as the CSV export.
+    """
+    CHUNK_SIZE = 100_000
+
+    # The columns of the CSV export, by their stripped names (the Excel headers may differ in their spaces)
+    _COLUMNS = {value.strip(): value for key, value in vars(Columns).items() if key.isupper()}
+    # The date and time cells are written as text, like in the CSV export (the Exec Time's hour isn't zero-padded)
+    _FORMATS = {Columns.TRADE_DATE: Config.COLMEX_PRO_MTS_DATE_FORMAT, Columns.EXEC_TIME: Config.TIME_FORMAT}
+    _UNPADDED_HOUR = {Columns.EXEC_TIME}
+
+    @classmethod
+    def _get_columns(cls, header: tuple) -> list:
+        """
+        :param header: The header row's values
+        :return: The column names, with the CSV export's names
+        """
+        columns = []
+        for value in header:
+            name = "" if value is None else str(value).strip()
+            columns.append(cls._COLUMNS.get(name, name))
+        return columns
+
+    @staticmethod
+    def _to_text(value, fmt: str, unpadded_hour: bool = False):
+        """
+        :param value: A cell value
+        :param fmt: The format of the column's text
+        :param unpadded_hour: Whether to remove the leading zero of the hour (e.g. "9:42:42", like the CSV export)
+        :return: The date or time cell as text, or the value itself
+        """
+        if isinstance(value, (datetime, date, time)):
+            text = value.strftime(fmt)
+            if unpadded_hour and len(text) > 1 and text[0] == "0" and text[1].isdigit():
+                text = text[1:]
+            return text
+        return value
+
+    @classmethod
+    def _to_df(cls, rows: list, columns: list, line_numbers: list) -> pd.DataFrame:
+        """
+        :param rows: The rows' values
+        :param columns: The column names
+        :param line_numbers: The row number of each row in the sheet
+        :return: A DataFrame of the rows, indexed like the CSV export (the line number minus 2)
+        """
+        df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        empty_columns = df.columns[df.isna().all().to_numpy()]
+        df[empty_columns] = df[empty_columns].astype(float)  # Empty columns are read from CSV as NaN
+        for column, fmt in cls._FORMATS.items():
+            if column in df.columns:
+                unpadded_hour = column in cls._UNPADDED_HOUR
+                df[column] = [cls._to_text(value, fmt, unpadded_hour) for value in df[column]]
+        df.index = pd.Index(line_numbers) - 2
+        return df
+
+    @classmethod
+    def iter_chunks(cls, input_file, chunk_size: int = None):
+        """
+        Stream the orders of the first sheet in chunks, so only a chunk's orders are in memory at a time. Empty rows
+        are skipped
+        :param input_file: The Excel file path, or a binary file-like object
+        :param chunk_size: The number of orders in a chunk
+        :return: A generator of Colmex Pro orders DataFrames
+        """
+        return cls._iter_chunks(input_file, chunk_size or cls.CHUNK_SIZE)
+
+    @classmethod
+    def _iter_chunks(cls, input_file, chunk_size: int = None):
+        """
+        Read the rows of the first sheet from the file in chunks. Empty rows are skipped
+        :param input_file: The Excel file path, or a binary file-like object
+        :param chunk_size: The number of orders in a chunk (all the orders in a single chunk if None)
+        :return: A generator of Colmex Pro orders DataFrames
+        """
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise Exception("Reading Excel files requires openpyxl (pip install openpyxl)")
+
+        workbook = load_workbook(input_file, read_only=True, data_only=True)
+        try:
+            rows = enumerate(workbook.worksheets[0].iter_rows(values_only=True), start=1)
+            header = next(rows, (1, ()))[1]
+            columns = cls._get_columns(header)
+            non_empty_rows = ((line, row) for line, row in rows if any(value is not None for value in row))
+            while True:
+                chunk = list(islice(non_empty_rows, chunk_size))
+                if not chunk:
+                    break
+                values = [row[:len(columns)] + (None,) * (len(columns) - len(row)) for _, row in chunk]
+                yield cls._to_df(values, columns, [line for line, _ in chunk])
+        finally:
+            workbook.close()
+
+    @classmethod
+    def read(cls, input_file) -> pd.DataFrame:
+        """
+        Read all the orders of the first sheet into one DataFrame, for the callers that need them all in memory. The
+        rows are still streamed from the file, but they are not split to chunks and concatenated again. To process
+        the orders a chunk at a time, use iter_chunks
+        :param input_file: The Excel file path, or a binary file-like object
+        :return: A DataFrame with the Colmex Pro orders data
+        """
+        chunks = list(cls._iter_chunks(input_file))
+        if not chunks:
+            raise Exception("No orders found in the Excel file")
+        return chunks[0]
@@ -7,4 +7,5 @@ class Config:
 
     # File extensions
     CSV = "csv"
+    XLSX = "xlsx"
     PDF = "pdf"
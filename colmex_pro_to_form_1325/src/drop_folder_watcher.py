@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from config import Config
+from logger import log_context, logger, new_job_id
+
+
+class DropFolderWatcher:
+    """
+    Watch a drop folder for new or changed Colmex Pro orders CSV or Excel files, and generate their form 1325
+    outputs. The folder is polled, and a file is processed only after its size and modification time stop changing,
+    so partially written files are skipped. The files are processed by a bounded worker pool, a file is never
+    processed twice at the same time, and the rates are fetched once per year and reused.
+    """
+    OUTPUT_FOLDER = "form_1325"
+    INPUT_EXTENSIONS = [Config.CSV, Config.XLSX]
+    POLL_INTERVAL = 2  # Seconds
+    SETTLE_TIME = 5  # Seconds without changes before a file is processed
+    RATES_TTL = 60 * 60  # Seconds before the rates are fetched again (today's rate is published daily)
+
+    def __init__(self, watch_dir: str, generator_class: type, output_extension: str, output_dir: str = None,
+                 workers: int = None, poll_interval: float = None, settle_time: float = None, **kwargs):
+        self.WATCH_DIR = watch_dir
+        self.GENERATOR_CLASS = generator_class
+        self.OUTPUT_EXTENSION = output_extension
+        self.OUTPUT_DIR = output_dir or os.path.join(watch_dir, self.OUTPUT_FOLDER)
+        self.WORKERS = workers or min(4, os.cpu_count() or 1)
+        self.POLL_INTERVAL = poll_interval or self.POLL_INTERVAL
+        self.SETTLE_TIME = self.SETTLE_TIME if settle_time is None else settle_time
+        self.GENERATOR_KWARGS = kwargs
+        self._executor = ThreadPoolExecutor(max_workers=self.WORKERS)
+        self._pending = {}  # {path: (signature, time of the last change)}
+        self._in_flight = {}  # {path: (future, signature)}
+        self._processed = {}  # {path: signature}
+        self._rates = {}  # {year: (fetch time, rates)}
+        self._rates_lock = threading.Lock()
+
+    def _get_output_file(self, input_file: str) -> str:
+        """
+        :param input_file: The input file path
+        :return: The output file path in the output folder, named after the input file with its extension (so the
+        CSV and the Excel exports of the same name have different outputs)
+        """
+        return os.path.join(self.OUTPUT_DIR, f"{os.path.basename(input_file)}.{self.OUTPUT_EXTENSION}")
+
+    def _get_rates(self, year: int) -> dict:
+        """
+        Get the rates of a year, fetched once and reused by all the workers until they expire
+        :param year: The year
+        :return: The rates dictionary
+        """
+        with self._rates_lock:  # The workers wait for a single fetch
+            fetched = self._rates.get(year)
+            if fetched is None or time.monotonic() - fetched[0] > self.RATES_TTL:
+                fetched = (time.monotonic(), BankOfIsraelRates.get_rates(year, ColmexProOrdersToForm1325DF.COIN))
+                self._rates[year] = fetched
+            return fetched[1]
+
+    def _process(self, input_file: str) -> str:
+        """
+        Generate the output of an input file. Runs in a worker thread
+        :param input_file: The input file path
+        :return: The output file path
+        """
+        with log_context(job_id=new_job_id()):
+            logger.info(f"Processing {input_file}")
+            os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+            generator = self.GENERATOR_CLASS(input_file, self._get_output_file(input_file), **self.GENERATOR_KWARGS)
+            generator.run(self._get_rates)
+            return generator.OUTPUT_FILE
+
+    def _is_up_to_date(self, input_file: str, mtime_ns: int) -> bool:
+        """
+        Check whether an input file's output is newer than the input file (e.g. generated before a restart)
+        """
+        output_file = self._get_output_file(input_file)
+        return os.path.exists(output_file) and os.stat(output_file).st_mtime_ns >= mtime_ns
+
+    def _collect_done(self):
+        """
+        Collect the results of the files that were processed
+        """
+        for input_file, (future, signature) in list(self._in_flight.items()):
+            if not future.done():
+                continue
+            del self._in_flight[input_file]
+            self._processed[input_file] = signature  # A failed file is retried only when it changes
+            try:
+                logger.info(f"Output file ready at: {future.result()}")
+            except Exception as e:
+                logger.error(f"Failed to process {input_file}: {e}")
+
+    def poll(self, now: float = None):
+        """
+        Scan the watch folder once: Queue the new or changed files that have settled, as long as there are free
+        workers
+        :param now: The current monotonic time (for tests)
+        """
+        now = time.monotonic() if now is None else now
+        self._collect_done()
+        for entry in sorted(os.scandir(self.WATCH_DIR), key=lambda e: e.name):
+            if not entry.is_file() or entry.name.startswith(".") or \
+                    os.path.splitext(entry.name)[1][1:].lower() not in self.INPUT_EXTENSIONS:
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._processed.get(entry.path) == signature:
+                continue
+            if entry.path not in self._processed and self._is_up_to_date(entry.path, stat.st_mtime_ns):
+                self._processed[entry.path] = signature
+                continue
+
+            pending = self._pending.get(entry.path)
+            if pending is None or pending[0] != signature:
+                self._pending[entry.path] = (signature, now)  # New or still being written: wait for it to settle
+                continue
+            if now - pending[1] < self.SETTLE_TIME or entry.path in self._in_flight or \
+                    len(self._in_flight) >= self.WORKERS:
+                continue
+            del self._pending[entry.path]
+            self._in_flight[entry.path] = (self._executor.submit(self._process, entry.path), signature)
+
+    def run(self):
+        """
+        Watch the folder until interrupted
+        """
+        logger.info(f"Watching {self.WATCH_DIR} for Colmex Pro orders files")
+        try:
+            while True:
+                self.poll()
+                time.sleep(self.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            self._executor.shutdown(wait=True)
+            self._collect_done()
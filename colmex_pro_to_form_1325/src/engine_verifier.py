@@ -0,0 +1,315 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from colmex_pro_orders_validator import ColmexProOrdersValidator
+from config import Config
+from fixed_point import FixedPoint
+from form_1325_df_to_pdf import Form1325DFToPDF
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+from logger import logger
+from reference_engine import ReferenceEngine
+
+
+class EngineVerifier:
+    """
+    Differential verification of the engine (ColmexProOrdersToForm1325DF and Form1325DFToPDF.parse_df) against the
+    frozen ReferenceEngine (the original float engine). Randomized order histories are generated, with short trades,
+    partial fills, weekdays without a BOI rate (holidays) and positions left open at the end of the year. Each history
+    is run through both engines, and their outputs are compared row by row, with the time each engine took.
+    The engine rounds each row's ILS amounts to the agora on purpose (see ColmexProOrdersToForm1325DF.round_lots), and
+    the reference engine doesn't round them, so the same rule is applied to the reference output before it's compared
+    (see round_reference). After that, the rows (and the formatted rows) must be equal.
+    """
+    YEAR = 2023
+    ACCOUNT = "COLH00000"
+    HOLIDAYS = 12  # Weekdays without a published BOI rate
+    SHORTS = 0.3  # The fraction of the trades that are short
+    OPEN_POSITIONS = 0.5  # The fraction of the symbols whose last (long) trade is left open
+    PARTIAL_FILLS = 0.1  # The fraction of the orders that are split into two fills at the same second and price
+    MAX_REPORTED = 20  # The number of mismatches reported per history
+    TOTALS_TOLERANCE = 0.01  # ILS, for the total sales, profit and loss
+
+    _MARKET_OPEN = 9 * 3600 + 30 * 60  # Seconds
+    _MARKET_SECONDS = 6 * 3600 + 30 * 60
+    _TOTALS = [Heb.SELL_AMOUNT, Heb.PROFIT, Heb.LOSS]
+
+    @classmethod
+    def generate_rates(cls, rng: np.random.Generator, year: int = None) -> dict:
+        """
+        Generate the USD rates of a year: A random walk published on weekdays, except for random holidays. The dates
+        without a rate get the previous rate, like the BOI rates
+        :param rng: The random generator
+        :param year: The year
+        :return: A dictionary with {date: rate} format
+        """
+        year = year or cls.YEAR
+        days = pd.date_range(f"{year - 1}-12-28", f"{year}-12-31")
+        weekdays = days[days.dayofweek < 5]
+        holidays = rng.choice(len(weekdays) - 1, cls.HOLIDAYS, replace=False) + 1  # The first rate is published
+        weekdays = weekdays.delete(holidays)
+        rates = np.round(3.6 * np.exp(np.cumsum(rng.normal(0, 0.004, len(weekdays)))), 3)
+        return BankOfIsraelRates.fill_missing_dates(dict(zip(weekdays.strftime(Config.DATE_FORMAT), rates)), year)
+
+    @classmethod
+    def _get_trade_orders(cls, rng: np.random.Generator, trades: int) -> tuple:
+        """
+        Generate the orders of the trades: 1-3 opening orders, and then 1-3 closing orders with the same total shares
+        :param rng: The random generator
+        :param trades: The number of trades
+        :return: The trade, whether it's a closing order, and the shares of each order, in the trades' order
+        """
+        open_counts, close_counts = rng.integers(1, 4, trades), rng.integers(1, 4, trades)
+        open_trades = np.repeat(np.arange(trades), open_counts)
+        open_shares = rng.integers(3, 1001, len(open_trades))
+        trade_shares = np.bincount(open_trades, weights=open_shares, minlength=trades).astype(np.int64)
+
+        # Each closing order gets 1 share, and the rest of the trade's shares are split at random weights
+        close_trades = np.repeat(np.arange(trades), close_counts)
+        weights = rng.uniform(0.1, 1, len(close_trades))
+        first_close = np.r_[0, np.cumsum(close_counts)[:-1]]
+        cumulative_weights = np.cumsum(weights)
+        cumulative_weights -= np.repeat(cumulative_weights[first_close] - weights[first_close], close_counts)
+        fractions = cumulative_weights / np.repeat(cumulative_weights[first_close + close_counts - 1], close_counts)
+        rest = np.repeat(trade_shares - close_counts, close_counts)
+        cuts = np.floor(rest * fractions).astype(np.int64)
+        cuts[first_close + close_counts - 1] = rest[first_close + close_counts - 1]  # The whole trade is closed
+        previous_cuts = np.r_[0, cuts[:-1]]
+        previous_cuts[first_close] = 0
+        close_shares = cuts - previous_cuts + 1
+
+        trade_ids = np.r_[open_trades, close_trades]
+        is_close = np.r_[np.zeros(len(open_trades), dtype=bool), np.ones(len(close_trades), dtype=bool)]
+        order = np.lexsort((is_close, trade_ids))
+        return trade_ids[order], is_close[order], np.r_[open_shares, close_shares][order]
+
+    @classmethod
+    def generate_orders(cls, rng: np.random.Generator, rows: int, symbols: int, year: int = None) -> pd.DataFrame:
+        """
+        Generate a random orders history, in the Colmex Pro export format. Each symbol's trades follow each other,
+        some are short, some orders are split into partial fills, and some symbols end with an open long position
+        :param rng: The random generator
+        :param rows: The number of orders (about)
+        :param symbols: The number of symbols
+        :param year: The year
+        :return: A Colmex Pro orders DataFrame
+        """
+        year = year or cls.YEAR
+        trades = max(int(rows / (4 * (1 + cls.PARTIAL_FILLS))), symbols)  # 2 + 2 orders per trade on average
+        trade_symbols = np.sort(rng.integers(0, symbols, trades))  # The trades of a symbol are consecutive
+        trade_ids, is_close, shares = cls._get_trade_orders(rng, trades)
+        is_short = rng.random(trades) < cls.SHORTS
+
+        # Leave the last trade of some symbols open, if it's long (an open short position is invalid)
+        last_trades = np.flatnonzero(np.r_[trade_symbols[1:] != trade_symbols[:-1], True])
+        open_trades = last_trades[~is_short[last_trades] & (rng.random(len(last_trades)) < cls.OPEN_POSITIONS)]
+        keep = ~(is_close & np.isin(trade_ids, open_trades))
+        trade_ids, is_close, shares = trade_ids[keep], is_close[keep], shares[keep]
+        symbol_ids = trade_symbols[trade_ids]
+        is_sell = is_close != is_short[trade_ids]
+
+        # A different second for each order of a symbol, in the order of the symbol's orders
+        days = pd.date_range(f"{year}-01-01", f"{year}-12-31")
+        days = days[days.dayofweek < 5]
+        seconds = np.empty(len(symbol_ids), dtype=np.int64)
+        starts = np.searchsorted(symbol_ids, np.arange(symbols + 1))
+        for start, end in zip(starts[:-1], starts[1:]):
+            seconds[start:end] = np.sort(rng.choice(len(days) * cls._MARKET_SECONDS, end - start, replace=False))
+        walk = rng.normal(0, 0.005, len(symbol_ids)).cumsum()
+        walk -= np.r_[0, walk][starts[symbol_ids]]  # Each symbol's prices walk from its own starting price
+        prices = np.maximum(np.round(rng.uniform(1, 500, symbols)[symbol_ids] * np.exp(walk), 4), 0.01)
+
+        # Split some orders into two partial fills, at the same second and price
+        split = (rng.random(len(shares)) < cls.PARTIAL_FILLS) & (shares > 1)
+        fill_shares = rng.integers(1, np.maximum(shares, 2))
+        positions = np.flatnonzero(split)
+        shares[positions] -= fill_shares[positions]
+        order = np.argsort(np.r_[np.arange(len(shares)), positions], kind="stable")
+        symbol_ids, is_sell, seconds, prices = (
+            np.r_[values, values[positions]][order] for values in (symbol_ids, is_sell, seconds, prices)
+        )
+        shares = np.r_[shares, fill_shares[positions]][order]
+
+        times = cls._MARKET_OPEN + seconds % cls._MARKET_SECONDS
+        time_texts = np.array([f"{t // 3600}:{t // 60 % 60:02d}:{t % 60:02d}" for t in range(24 * 3600)])
+        commissions = np.round(rng.uniform(0, 2, len(shares)), 2)
+        return pd.DataFrame({
+            Columns.ACCOUNT: cls.ACCOUNT,
+            Columns.TRADE_DATE: np.asarray(days.strftime(Config.COLMEX_PRO_MTS_DATE_FORMAT))[
+                seconds // cls._MARKET_SECONDS],
+            Columns.CURRENCY: ColmexProOrdersToForm1325DF.COIN,
+            Columns.ACCOUNT_TYPE: 2,
+            Columns.SIDE: np.where(is_sell, ColmexProOrdersToForm1325DF.SELL, ColmexProOrdersToForm1325DF.BUY),
+            Columns.SYMBOL: np.char.add("SYM", np.arange(symbols).astype(str))[symbol_ids],
+            Columns.SHARES: shares,
+            Columns.PRICE: prices,
+            Columns.EXEC_TIME: time_texts[times],
+            Columns.COMMISSION: commissions,
+            Columns.SEC_FEE: np.where(is_sell, np.round(shares * prices * 0.000008, 2), 0),
+            Columns.TAF_FEE: np.where(is_sell, np.round(np.minimum(shares * 0.000166, 8.3), 2), 0),
+            Columns.ECN_FEE: 0.0,
+            Columns.ROUTING_FEE: 0.0,
+            Columns.NSCC_FEE: 0.0,
+        })
+
+    @staticmethod
+    def _to_numbers(values: np.ndarray) -> np.ndarray:
+        """
+        Convert a column's values (numbers, formatted numbers with thousands separators, or "") to floats
+        :param values: The values
+        :return: A float array, with 0 for the empty ("") values
+        """
+        values = pd.Series(values).astype(str).str.replace(",", "").replace("", "0")
+        return pd.to_numeric(values, errors="coerce").to_numpy(dtype=float)
+
+    @staticmethod
+    def round_reference(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Apply the engine's rounding rule to the reference engine's output (see ReferenceEngine._to_agorot): The ILS
+        amounts are rounded to the agora (half away from zero), and the profit or loss is calculated again from the
+        rounded amounts
+        :param df: The reference engine's output (see ReferenceEngine.transform)
+        :return: The rounded output
+        """
+        rounded_df = pd.DataFrame(ReferenceEngine._to_agorot(df.to_dict(orient="records")), index=df.index)
+        for column in Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT:
+            rounded_df[column] = FixedPoint.to_float(rounded_df[column], FixedPoint.ILS_SCALE)
+        for column in Heb.PROFIT, Heb.LOSS:
+            rounded_df[column] = rounded_df[column].map(
+                lambda x: x if x == "" else FixedPoint.to_float(x, FixedPoint.ILS_SCALE)
+            ).astype(object)
+        return rounded_df
+
+    @classmethod
+    def compare(cls, expected_df: pd.DataFrame, actual_df: pd.DataFrame) -> tuple[int, list]:
+        """
+        Compare the engine's output with the (rounded) reference output, row by row. All the columns must be equal
+        :param expected_df: The reference engine's output (see round_reference)
+        :param actual_df: The engine's output
+        :return: The number of mismatches, and the descriptions of the first MAX_REPORTED of them
+        """
+        if list(expected_df.columns) != list(actual_df.columns):
+            return 1, [f"Different columns: {list(expected_df.columns)} (reference) != {list(actual_df.columns)}"]
+        mismatches = [] if len(expected_df) == len(actual_df) else \
+            [(None, None, f"{len(expected_df)} rows (reference) != {len(actual_df)} rows")]
+        rows = min(len(expected_df), len(actual_df))
+        for column in expected_df.columns:
+            expected, actual = expected_df[column].to_numpy()[:rows], actual_df[column].to_numpy()[:rows]
+            different = np.asarray(expected != actual, dtype=bool)
+            mismatches += [(row, column, None) for row in np.flatnonzero(different)]
+        mismatches.sort(key=lambda mismatch: -1 if mismatch[0] is None else mismatch[0])
+        descriptions = [
+            description if row is None else
+            f"Row {row + 1}, {column!r}: {expected_df[column].iloc[row]!r} (reference) != "
+            f"{actual_df[column].iloc[row]!r}"
+            for row, column, description in mismatches[:cls.MAX_REPORTED]
+        ]
+        return len(mismatches), descriptions
+
+    @classmethod
+    def compare_totals(cls, expected_df: pd.DataFrame, actual_df: pd.DataFrame) -> tuple[int, list]:
+        """
+        Compare the total sales, profit and loss of the engine's output with the reference output's, within
+        TOTALS_TOLERANCE
+        :param expected_df: The reference engine's output (see round_reference)
+        :param actual_df: The engine's output
+        :return: The number of mismatches, and their descriptions
+        """
+        descriptions = []
+        for column in cls._TOTALS:
+            expected, actual = (cls._to_numbers(df[column]).sum() for df in (expected_df, actual_df))
+            if not abs(expected - actual) <= cls.TOTALS_TOLERANCE:
+                descriptions.append(f"Total {column!r}: {expected:.2f} (reference) != {actual:.2f}")
+        return len(descriptions), descriptions
+
+    @staticmethod
+    def _run_engine(engine: type, parse_df, df: pd.DataFrame, rates: dict, aggregate: bool, round_rows=None) -> tuple:
+        """
+        Run an engine on the orders
+        :return: The transformed DataFrame (rounded by round_rows, if passed), the formatted DataFrame, and the seconds
+        each step took
+        """
+        start = time.perf_counter()
+        transformed_df = engine.transform(df.copy(), rates, aggregate=aggregate)
+        transformed = time.perf_counter()
+        if round_rows is not None:
+            transformed_df = round_rows(transformed_df)
+        formatting = time.perf_counter()
+        formatted_df = parse_df(transformed_df.copy(), sub_header=False)
+        return transformed_df, formatted_df, transformed - start, time.perf_counter() - formatting
+
+    @classmethod
+    def verify_history(cls, df: pd.DataFrame, rates: dict, aggregate: bool = False) -> dict:
+        """
+        Run an orders history through the reference engine and the engine, and compare their outputs
+        :param df: The Colmex Pro orders DataFrame
+        :param rates: The rates dictionary
+        :param aggregate: Whether to aggregate the matched lots (see ColmexProOrdersToForm1325DF)
+        :return: A report dictionary: The rows, the seconds each engine took to transform and to format, and the
+        mismatches
+        """
+        formatter = Form1325DFToPDF(cls.YEAR, "", "", False, None, None)
+        reference = cls._run_engine(
+            ReferenceEngine, ReferenceEngine.parse_df, df, rates, aggregate, round_rows=cls.round_reference
+        )
+        engine = cls._run_engine(ColmexProOrdersToForm1325DF, formatter.parse_df, df, rates, aggregate)
+        mismatches, descriptions = 0, []
+        for compare, expected_df, actual_df in (cls.compare, reference[0], engine[0]), \
+                (cls.compare, reference[1], engine[1]), (cls.compare_totals, reference[0], engine[0]):
+            compared_mismatches, compared_descriptions = compare(expected_df, actual_df)
+            mismatches += compared_mismatches
+            descriptions += compared_descriptions
+        return {
+            "orders": len(df), "rows": len(reference[0]),
+            "reference_transform": reference[2], "engine_transform": engine[2],
+            "reference_format": reference[3], "engine_format": engine[3],
+            "mismatches": mismatches, "descriptions": descriptions[:cls.MAX_REPORTED],
+        }
+
+    @staticmethod
+    def _speedup(reference_seconds: float, engine_seconds: float) -> str:
+        """
+        :return: The speedup of the engine, as text
+        """
+        return f"{reference_seconds / engine_seconds:.2f}x" if engine_seconds else "-"
+
+    @classmethod
+    def verify(cls, rows: int, symbols: int, histories: int = 1, seed: int = 0, aggregate: bool = False) -> bool:
+        """
+        Verify the engine against the reference engine on randomized orders histories, and log the speedup and the
+        mismatches of each history
+        :param rows: The number of orders in a history (about)
+        :param symbols: The number of symbols in a history
+        :param histories: The number of histories
+        :param seed: The random seed of the first history (the next histories use the next seeds)
+        :param aggregate: Whether to aggregate the matched lots
+        :return: True if all the outputs match
+        """
+        total_mismatches = 0
+        for history_seed in range(seed, seed + histories):
+            rng = np.random.default_rng(history_seed)
+            rates = cls.generate_rates(rng)
+            df = cls.generate_orders(rng, rows, symbols)
+            ColmexProOrdersValidator.validate(df)  # The generated history must be valid for both engines
+            report = cls.verify_history(df, rates, aggregate)
+            total_mismatches += report["mismatches"]
+            logger.info(
+                f"History {history_seed}: {report['orders']:,} orders, {report['rows']:,} rows. "
+                f"Transform: {report['reference_transform']:.2f}s (reference), {report['engine_transform']:.2f}s "
+                f"(speedup {cls._speedup(report['reference_transform'], report['engine_transform'])}). "
+                f"Format: {report['reference_format']:.2f}s (reference), {report['engine_format']:.2f}s "
+                f"(speedup {cls._speedup(report['reference_format'], report['engine_format'])}). "
+                f"{report['mismatches']:,} mismatches"
+            )
+            for description in report["descriptions"]:
+                logger.error(f"History {history_seed}: {description}")
+        if total_mismatches:
+            logger.error(f"The engine's output differs from the reference engine's output ({total_mismatches:,} "
+                         f"mismatches)")
+        else:
+            logger.info(f"The engine's output matches the reference engine's output ({histories} histories)")
+        return not total_mismatches
@@ -0,0 +1,211 @@
+import heapq
+import os
+import shutil
+import tempfile
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from colmex_pro_orders_validator import ColmexProOrdersValidator
+from colmex_pro_orders_xlsx_reader import ColmexProOrdersXLSXReader
+from config import Config
+from progress import Progress
+
+
+class ExternalSort:
+    """
+    An external sort of a Colmex Pro orders CSV file that is too big to sort in memory. The file is read in chunks,
+    and each chunk is sorted by symbol and execution time and spilled to disk as one sorted run file. The runs are
+    then k-way merged one symbol at a time (reading only the symbol's slice of each run), so only a single symbol's
+    orders are in memory while they are matched.
+    A run file holds the chunk's columns as consecutive typed arrays (np.save, without pickle), so reading a run never
+    executes code from the file. Text columns are saved as fixed-width strings, with a mask of their missing values.
+    """
+    CHUNK_SIZE = 100_000
+    _INDEX = None  # The column name of the DataFrame index (the input file line number minus 2) in the run layout
+
+    def __init__(self, dir_path: str, chunk_size: int = None):
+        self.DIR = dir_path
+        self.CHUNK_SIZE = chunk_size or self.CHUNK_SIZE
+        self.TRADE_DATES = Counter()  # {trade date: number of orders}
+        self._runs = []  # [(run file path, number of orders, [(column, dtype, offset, missing values offset)])]
+        self._symbol_runs = {}  # {symbol: [(run number, first order, end order)]}
+        self._first_datetimes = {}  # {symbol: the execution time of the symbol's first order}
+
+    @classmethod
+    def create(cls, dir_path: str = None, chunk_size: int = None) -> "ExternalSort":
+        """
+        Create an external sort in a new temporary directory
+        :param dir_path: The parent directory of the temporary directory (the system's temp directory if not passed)
+        :param chunk_size: The number of orders in a sorted run
+        :return: An ExternalSort object
+        """
+        return cls(tempfile.mkdtemp(prefix="external_sort_", dir=dir_path), chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        shutil.rmtree(self.DIR, ignore_errors=True)
+
+    @property
+    def symbols(self) -> int:
+        """
+        :return: The number of symbols that were split
+        """
+        return len(self._symbol_runs)
+
+    @staticmethod
+    def _save_array(f, values: np.ndarray) -> int:
+        """
+        Save an array to an open run file
+        :param f: The run file object
+        :param values: A one-dimensional array (not of objects)
+        :return: The offset of the array's data in the file
+        """
+        values = np.ascontiguousarray(values)
+        np.save(f, values, allow_pickle=False)
+        return f.tell() - values.nbytes  # The data follows the array's header
+
+    def _write_run(self, run_path: str, chunk_df: pd.DataFrame) -> list:
+        """
+        Write a sorted chunk to a run file, column after column
+        :param run_path: The run file path
+        :param chunk_df: The sorted chunk DataFrame
+        :return: The run layout: A list of (column, dtype, offset, missing values offset) tuples
+        """
+        layout = []
+        with open(run_path, "wb") as f:
+            for column, values in [(self._INDEX, chunk_df.index.to_numpy()),
+                                   *((column, chunk_df[column].to_numpy()) for column in chunk_df.columns)]:
+                missing_offset = None
+                if values.dtype == object:
+                    is_missing = pd.isna(values)
+                    missing_offset = self._save_array(f, is_missing) if is_missing.any() else None
+                    values = np.where(is_missing, "", values).astype(str)
+                layout.append((column, values.dtype, self._save_array(f, values), missing_offset))
+        return layout
+
+    def split(self, input_file: str, progress: Progress = None):
+        """
+        Read the input file in chunks, and spill each chunk's orders to a sorted run file
+        :param input_file: The Colmex Pro orders CSV or Excel file path
+        :param progress: Reports the parsed rows after each chunk, and stops when the run is cancelled
+        """
+        if os.path.splitext(input_file)[1][1:].lower() == Config.XLSX:
+            chunks = ColmexProOrdersXLSXReader.iter_chunks(input_file, self.CHUNK_SIZE)
+        else:
+            # Blank lines are read as empty rows (dropped below), so the index stays the file line number minus 2
+            chunks = pd.read_csv(input_file, index_col=False, chunksize=self.CHUNK_SIZE, skip_blank_lines=False)
+        rows = 0
+        for chunk_df in chunks:
+            rows += len(chunk_df)
+            if progress is not None:
+                progress.update(Progress.PARSE, rows)
+            chunk_df = chunk_df.dropna(how='all').copy()  # The blank lines' rows are dropped
+            if chunk_df.empty:
+                continue
+            # The chunk's index continues the previous chunks, so the lines are the input file's lines
+            ColmexProOrdersValidator.validate(chunk_df, input_file=input_file, check_orders=False)
+            self.TRADE_DATES.update(chunk_df[Columns.TRADE_DATE].value_counts().to_dict())
+            chunk_df = ColmexProOrdersToForm1325DF.sort(chunk_df)  # Not sorted again if already sorted
+            # Group the symbols, keeping each symbol's orders in execution order
+            chunk_df = chunk_df.iloc[np.argsort(chunk_df[Columns.SYMBOL].to_numpy(dtype=str), kind="stable")]
+
+            run = len(self._runs)
+            run_path = f"{self.DIR}/{run}.npy"
+            self._runs.append((run_path, len(chunk_df), self._write_run(run_path, chunk_df)))
+            symbols = chunk_df[Columns.SYMBOL].to_numpy()
+            starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+            ends = np.r_[starts[1:], len(symbols)]
+            first_datetimes = chunk_df[Columns.DATETIME].to_numpy()[starts]
+            for symbol, first, end, first_datetime in zip(symbols[starts], starts, ends, first_datetimes):
+                self._symbol_runs.setdefault(symbol, []).append((run, first, end))
+                self._first_datetimes[symbol] = min(self._first_datetimes.get(symbol, first_datetime), first_datetime)
+
+    @property
+    def year(self) -> int:
+        """
+        :return: The year of most of the orders that were split
+        """
+        years = Counter()
+        for trade_date, orders in self.TRADE_DATES.items():
+            years[pd.to_datetime(trade_date, format=Config.COLMEX_PRO_MTS_DATE_FORMAT).year] += orders
+        return years.most_common(1)[0][0]
+
+    def _read_symbol_runs(self, symbol: str, run_files: dict) -> list[pd.DataFrame]:
+        """
+        Read a symbol's slice of each run file
+        :param symbol: The symbol
+        :param run_files: The memory-mapped run files, by run number (opened when first read)
+        :return: The symbol's sorted runs, indexed like the input file
+        """
+        run_dfs = []
+        for run, first, end in self._symbol_runs[symbol]:
+            run_path, orders, layout = self._runs[run]
+            if run not in run_files:
+                run_files[run] = np.memmap(run_path, mode="r")
+            buffer = run_files[run]
+            data = {}
+            for column, dtype, offset, missing_offset in layout:
+                values = np.ndarray(orders, dtype, buffer, offset)[first:end].copy()
+                if missing_offset is not None:
+                    values = values.astype(object)
+                    values[np.ndarray(orders, bool, buffer, missing_offset)[first:end]] = np.nan
+                elif dtype.kind == "U":
+                    values = values.astype(object)  # Text columns are objects, like when read from the input file
+                data[column] = values
+            index = data.pop(self._INDEX)
+            run_dfs.append(pd.DataFrame(data, index=index))
+        return run_dfs
+
+    def validate(self, rates: dict, input_file: str = None, progress: Progress = None):
+        """
+        Validate the orders that can only be checked with all of a symbol's orders, before any of them is matched:
+        The year, the position feasibility and the rate coverage. The runs of each symbol are read and concatenated
+        (the checks don't need them merged), and the errors of all the symbols are raised together
+        :param rates: The rates dictionary
+        :param input_file: The input file path, for the error message
+        :param progress: Stops the validation when the run is cancelled
+        """
+        year, errors, run_files = self.year, [], {}
+        for symbol in self._symbol_runs:
+            symbol_df = pd.concat(self._read_symbol_runs(symbol, run_files))  # Indexed like the input file
+            errors += ColmexProOrdersValidator.check_symbol(symbol_df, year, rates)
+            if progress is not None:
+                progress.check()
+        ColmexProOrdersValidator.raise_errors(errors, input_file)
+
+    @staticmethod
+    def _merge_runs(run_dfs: list[pd.DataFrame]) -> pd.DataFrame:
+        """
+        K-way merge sorted runs of a symbol's orders. The runs are concatenated if they don't interleave (like the
+        chunks of a file in execution order)
+        :param run_dfs: The symbol's sorted runs
+        :return: The symbol's sorted orders DataFrame
+        """
+        df = pd.concat(run_dfs, ignore_index=True)
+        run_keys = [
+            list(zip(run_df[Columns.DATETIME].to_numpy().astype(np.int64).tolist(), run_df[Columns.PRICE].tolist()))
+            for run_df in run_dfs
+        ]
+        if all(previous[-1] <= keys[0] for previous, keys in zip(run_keys, run_keys[1:])):
+            return df
+        offsets = np.cumsum([0] + [len(keys) for keys in run_keys])
+        merged = heapq.merge(*([key + (offset + i,) for i, key in enumerate(keys)]
+                               for keys, offset in zip(run_keys, offsets)))
+        order = np.fromiter((position for _, _, position in merged), dtype=np.int64, count=len(df))
+        return df.iloc[order].reset_index(drop=True)
+
+    def iter_symbol_dfs(self):
+        """
+        Read the sorted orders one symbol at a time, in the order of the symbols' first orders (like the order of
+        the symbols in the sorted input)
+        :return: A generator of sorted orders DataFrames, one per symbol
+        """
+        run_files = {}
+        for symbol in sorted(self._symbol_runs, key=lambda s: (self._first_datetimes[s], s)):
+            yield self._merge_runs(self._read_symbol_runs(symbol, run_files))
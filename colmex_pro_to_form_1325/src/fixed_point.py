@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class FixedPoint:
+    """
+    Fixed-point int64 money arithmetic. The float inputs (prices, fees and rates) are rounded once to scaled integers
+    (to_fixed), and from there on the arithmetic is integer only, with explicit rounding, so the results are
+    deterministic: They don't depend on the platform or on the order in which the amounts are added up.
+    """
+    USD_SCALE = 10_000  # USD amounts in 1/100 cents, as Colmex Pro prices have 4 decimals
+    ILS_SCALE = 100  # ILS amounts in agorot
+    RATE_SCALE = 100_000  # BOI rates, with up to 5 decimals
+    ILS_FINE_SCALE = USD_SCALE * RATE_SCALE  # ILS amounts before they are rounded to the agora (a USD amount * a rate)
+    MAX = np.iinfo(np.int64).max
+
+    @staticmethod
+    def to_fixed(values, scale: int) -> np.ndarray:
+        """
+        Convert decimal values to fixed-point integers
+        :param values: A number or an array of numbers
+        :param scale: The scale
+        :return: An int64 array with the values multiplied by the scale and rounded
+        """
+        return np.rint(np.asarray(values, dtype=float) * scale).astype(np.int64)
+
+    @staticmethod
+    def round_half_away(values, scale: int) -> np.ndarray:
+        """
+        Convert decimal values to fixed-point integers, rounding halves away from zero like div_round. A value within
+        a relative 1e-14 below a half is rounded as a half, as it's a half that was lost in the float arithmetic
+        :param values: A number or an array of numbers
+        :param scale: The scale
+        :return: An int64 array with the values multiplied by the scale and rounded
+        """
+        values = np.asarray(values, dtype=float)
+        return (np.sign(values) * np.floor(np.abs(values) * scale * (1 + 1e-14) + 0.5)).astype(np.int64)
+
+    @staticmethod
+    def to_float(values, scale: int):
+        """
+        Convert fixed-point integers to decimal values
+        :param values: A fixed-point integer or an array of fixed-point integers
+        :param scale: The scale
+        :return: The decimal value(s)
+        """
+        return values / scale
+
+    @staticmethod
+    def div_round(numerator, denominator) -> np.ndarray:
+        """
+        Integer division, rounded half away from zero
+        :param numerator: An int64 array (or integer)
+        :param denominator: An int64 array (or integer) of positive numbers
+        :return: An int64 array with the rounded quotients
+        """
+        numerator, denominator = np.asarray(numerator, dtype=np.int64), np.asarray(denominator, dtype=np.int64)
+        quotient, remainder = np.divmod(np.abs(numerator), denominator)
+        return np.sign(numerator) * (quotient + (remainder * 2 >= denominator))
+
+    @classmethod
+    def multiply(cls, values, factors) -> np.ndarray:
+        """
+        Multiply fixed-point integers, and raise instead of silently overflowing the int64 range
+        :param values: An int64 array (or integer)
+        :param factors: An int64 array (or integer)
+        :return: An int64 array with the products
+        """
+        values, factors = np.asarray(values, dtype=np.int64), np.asarray(factors, dtype=np.int64)
+        if np.any(np.abs(values) > cls.MAX // np.maximum(np.abs(factors), 1)):
+            raise Exception("The amounts are too large for the fixed-point int64 arithmetic")
+        return values * factors
+
+    @classmethod
+    def mul_div_round(cls, values, factors, denominator) -> np.ndarray:
+        """
+        Multiply and then divide, rounded half away from zero, without overflowing when the product doesn't fit in
+        int64 but the result does: values * factors / denominator = (q * denominator + r) * factors / denominator =
+        q * factors + r * factors / denominator, where q and r are the quotient and the remainder of the values
+        :param values: An int64 array (or integer)
+        :param factors: An int64 array (or integer) of non-negative numbers
+        :param denominator: An int64 array (or integer) of positive numbers
+        :return: An int64 array with the rounded results
+        """
+        values = np.asarray(values, dtype=np.int64)
+        quotient, remainder = np.divmod(np.abs(values), np.asarray(denominator, dtype=np.int64))
+        return np.sign(values) * (
+            cls.multiply(quotient, factors) + cls.div_round(cls.multiply(remainder, factors), denominator)
+        )
+
+    @classmethod
+    def mul_div_mul_round(cls, values, numerators, denominators, factors) -> np.ndarray:
+        """
+        Calculate values * numerators / denominators * factors, rounded once (half away from zero), without forming
+        the products: |values| * numerators / denominators = quotient + r / denominators, where the quotient and r are
+        found like in mul_div_round (without rounding), so the result is quotient * factors + r * factors / denominators
+        :param values: An int64 array (or integer)
+        :param numerators: An int64 array (or integer) of non-negative numbers
+        :param denominators: An int64 array (or integer) of positive numbers
+        :param factors: An int64 array (or integer) of non-negative numbers
+        :return: An int64 array with the rounded results
+        """
+        values, denominators = np.asarray(values, dtype=np.int64), np.asarray(denominators, dtype=np.int64)
+        quotient, remainder = np.divmod(np.abs(values), denominators)
+        remainder_quotient, remainder = np.divmod(cls.multiply(remainder, numerators), denominators)
+        quotient = cls.multiply(quotient, numerators) + remainder_quotient
+        return np.sign(values) * (
+            cls.multiply(quotient, factors) + cls.div_round(cls.multiply(remainder, factors), denominators)
+        )
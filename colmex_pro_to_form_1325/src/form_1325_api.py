@@ -0,0 +1,53 @@
+import io
+
+from form_1325_generator import Form1325CSVGenerator, Form1325PDFGenerator
+
+
+class Form1325API:
+    """
+    An in-memory API for generating form 1325 from Colmex Pro orders that are already in memory. The orders can be a
+    DataFrame, the CSV content as bytes, or a file-like object, and the output is returned as bytes or written to a
+    binary writable file-like object. Nothing is written to the filesystem (unless a spill directory is passed), and
+    the API can be called from several threads at once, as each call has its own generator and buffers.
+    """
+
+    @staticmethod
+    def _run(cls: type, orders, output, *args, **kwargs):
+        """
+        Run a generator with in-memory input and output
+        :param cls: The generator class
+        :param orders: The Colmex Pro orders: A DataFrame, CSV bytes or a file-like object
+        :param output: A binary writable file-like object (None to return the output as bytes)
+        :return: The output bytes, or None if the output was written to the writable
+        """
+        if kwargs.get("by_account"):
+            raise Exception("by_account is not supported with in-memory output")
+        buffer = io.BytesIO() if output is None else output
+        cls(orders, buffer, *args, **kwargs).run()
+        return buffer.getvalue() if output is None else None
+
+    @classmethod
+    def to_csv(cls, orders, output=None, **kwargs):
+        """
+        Generate form 1325 in CSV format
+        :param orders: The Colmex Pro orders: A DataFrame, CSV bytes or a file-like object
+        :param output: A binary writable file-like object to write the CSV to (returned as bytes if not passed)
+        :param kwargs: More generator options, like subtotals, consolidate_fills, aggregate_rows, and progress (a
+        callback of the stage, done and total) and cancel_token (a CancellationToken) to follow and cancel the run
+        :return: The CSV bytes, or None if the output was written to the writable
+        """
+        return cls._run(Form1325CSVGenerator, orders, output, **kwargs)
+
+    @classmethod
+    def to_pdf(cls, orders, name: str, file_number: str, asset_abroad: bool, output=None, **kwargs):
+        """
+        Generate form 1325 in PDF format
+        :param orders: The Colmex Pro orders: A DataFrame, CSV bytes or a file-like object
+        :param name: The name
+        :param file_number: The file number
+        :param asset_abroad: Whether the asset is abroad
+        :param output: A binary writable file-like object to write the PDF to (returned as bytes if not passed)
+        :param kwargs: More generator options, like consolidate_fills, aggregate_rows, progress and cancel_token
+        :return: The PDF bytes, or None if the output was written to the writable
+        """
+        return cls._run(Form1325PDFGenerator, orders, output, name, file_number, str(asset_abroad), **kwargs)
@@ -1,21 +1,43 @@
+import codecs
+import html as html_lib
+import io
 import os
-import uuid
+import queue
+import re
+import subprocess
+import tempfile
+import threading
 
 import pandas as pd
 import pdfkit
 import pypdf
 
 from form_1325_hebrew_text import Form1325HebrewText as Heb
+from form_1325_totals import Form1325Totals
+from logger import logger
+from matched_lots_store import MatchedLotsStore
+from pdf_optimizer import PDFOptimizer
+from progress import Progress
+from reference_engine import ReferenceEngine
 
 
 class Form1325DFToPDF:
-    def __init__(self, year: int, name: str, file_number: str, asset_abroad: bool, df: pd.DataFrame, output_path: str):
+    _PAGE_PATTERN = re.compile(r"Page (\d+) of (\d+)")  # wkhtmltopdf's progress output while printing the pages
+
+    def __init__(self, year: int, name: str, file_number: str, asset_abroad: bool, df: pd.DataFrame, output_path: str,
+                 store: MatchedLotsStore = None, totals: Form1325Totals = None, explanations_url: str = None,
+                 progress: Progress = None, reference_engine: bool = False):
         self.YEAR = year
         self.NAME = name
         self.FILE_NUMBER = file_number
         self.ASSET_ABROAD = asset_abroad
         self.DF = df
         self.OUTPUT_PATH = output_path
+        self.STORE = store  # When passed, the rows are read from the store instead of from self.DF
+        self.TOTALS = totals  # When passed, the totals are taken from the running totals instead of summing columns
+        self.EXPLANATIONS_URL = explanations_url  # When passed, the explanations are linked instead of appended
+        self.PROGRESS = progress or Progress()
+        self.REFERENCE_ENGINE = reference_engine  # When True, the numbers are formatted by the frozen reference engine
 
     @staticmethod
     def round_number(num: float, decimals: int) -> float:
@@ -40,10 +62,11 @@ class Form1325DFToPDF:
         """
         return "" if num == "" else f"{num:,}"
 
-    def parse_df(self, df: pd.DataFrame) -> pd.DataFrame:
+    def parse_df(self, df: pd.DataFrame, sub_header: bool = True) -> pd.DataFrame:
         """
         Parse the DataFrame columns for a good-looking PDF representation
         :param df: The DataFrame
+        :param sub_header: Whether to add the sub-header row
         :return: The parsed DataFrame
         """
         # Round some float column values
@@ -61,8 +84,9 @@ class Form1325DFToPDF:
             df[column] = df[column].apply(self._add_thousands_separator)
 
         # Add sub-header as 1st row
-        sub_header = {col: Heb.SUB_HEADER[i] for i, col in enumerate(df.columns)}
-        df = pd.concat([df.iloc[:0], pd.DataFrame([sub_header]), df.iloc[0:]]).reset_index(drop=True)
+        if sub_header:
+            sub_header = {col: Heb.SUB_HEADER[i] for i, col in enumerate(df.columns)}
+            df = pd.concat([df.iloc[:0], pd.DataFrame([sub_header]), df.iloc[0:]]).reset_index(drop=True)
 
         return df
 
@@ -163,6 +187,26 @@ class Form1325DFToPDF:
         cls = "data_table"
         return self._get_html_table(cls, df=df, header=True)
 
+    def _data_table_chunks(self):
+        """
+        Create the HTML for the data table in chunks. When reading from the store, each chunk of rows is parsed and
+        rendered separately into the same table, so the whole table is never held in memory
+        :return: A generator of HTML strings
+        """
+        parse_df = ReferenceEngine.parse_df if self.REFERENCE_ENGINE else self.parse_df
+        if self.STORE is None:
+            yield self._data_table(parse_df(self.DF))
+            return
+
+        table_end = ""
+        for i, df in enumerate(self.STORE.iter_dfs()):
+            html = self._data_table(parse_df(df, sub_header=i == 0))
+            if i > 0:  # Keep only the table rows
+                html = html[html.index("<tbody>") + len("<tbody>"):]
+            table_end = html[html.rindex("</tbody>"):]
+            yield html[:-len(table_end)]
+        yield table_end
+
     def _total_profit_loss_table(self, total_profit: str, total_loss: str) -> str:
         """
         Create an HTML table for the total profit & loss table
@@ -207,17 +251,29 @@ class Form1325DFToPDF:
         result = round(pd.to_numeric(df[column_name], errors="coerce").sum())
         return result
 
-    def _df_to_html(self) -> str:
+    def _get_totals(self) -> dict:
         """
-        Get the whole document's HTML string
-        :return: The HTML document string
+        Calculate the column totals
+        :return: A dictionary with the total profit, the total loss and the total sales
+        """
+        if self.TOTALS is not None:
+            return self.TOTALS.totals()
+        if self.STORE is not None:
+            return self.STORE.totals()
+        return {column: self.get_df_column_sum(self.DF, column) for column in (Heb.PROFIT, Heb.LOSS, Heb.SELL_AMOUNT)}
+
+    def _html_chunks(self):
+        """
+        Get the whole document's HTML in chunks
+        :return: A generator of HTML strings
         """
         # Calculate some column totals
-        total_profit = self._add_thousands_separator(self.get_df_column_sum(self.DF, Heb.PROFIT))
-        total_loss = self._add_thousands_separator(self.get_df_column_sum(self.DF, Heb.LOSS))
-        total_sales = self._add_thousands_separator(self.get_df_column_sum(self.DF, Heb.SELL_AMOUNT))
+        totals = self._get_totals()
+        total_profit = self._add_thousands_separator(totals[Heb.PROFIT])
+        total_loss = self._add_thousands_separator(totals[Heb.LOSS])
+        total_sales = self._add_thousands_separator(totals[Heb.SELL_AMOUNT])
 
-        return f"""<!DOCTYPE html>
+        yield f"""<!DOCTYPE html>
             <html>
             <head>
                 <meta charset="UTF-8">
@@ -229,8 +285,11 @@ class Form1325DFToPDF:
                 <p class='title3'>{Heb.cite(Heb.TITLE_3)}</p>
                 {self._personal_details_table()}
                 <br/>
-                {self._data_table(self.parse_df(self.DF))}
+                """
+        yield from self._data_table_chunks()
+        yield f"""
                 <p class='comment'>{Heb.cite(Heb.COMMENT)}</p>
+                {self._explanations_link()}
                 {self._total_profit_loss_table(total_profit, total_loss)}
                 <br/>
                 {self._total_sales_table(total_sales)}
@@ -240,26 +299,151 @@ class Form1325DFToPDF:
             </html>
             """
 
+    def _explanations_link(self) -> str:
+        """
+        Get a link to the explanations, when they are linked instead of appended
+        :return: The HTML p tag string (empty if the explanations are appended)
+        """
+        if self.EXPLANATIONS_URL is None:
+            return ""
+        return self._p_tag(f'<a href="{html_lib.escape(self.EXPLANATIONS_URL)}">{Heb.EXPLANATIONS}</a>', "comment")
+
+    def _df_to_html(self) -> str:
+        """
+        Get the whole document's HTML string
+        :return: The HTML document string
+        """
+        return "".join(self._html_chunks())
+
     @staticmethod
-    def merge_pdfs(pdf_list: list, output_path: str):
+    def _get_size(pdf) -> int:
         """
-        Merge multiple PDF files
-        :param pdf_list: A list with paths to PDF files
-        :param output_path: The output path of the merged PDF file
+        :param pdf: A PDF file path (or a binary file-like object)
+        :return: The PDF's size in bytes
+        """
+        if isinstance(pdf, str):
+            return os.path.getsize(pdf)
+        return pdf.seek(0, io.SEEK_END)
+
+    @classmethod
+    def merge_pdfs(cls, pdf_list: list, output_path, optimize: bool = True):
+        """
+        Merge multiple PDF files. The merged PDF is optimized (see PDFOptimizer), and the byte savings are reported
+        :param pdf_list: A list with paths to PDF files (or binary file-like objects)
+        :param output_path: The output path of the merged PDF file (or a binary writable file-like object)
+        :param optimize: Whether to optimize the merged PDF's size
         """
-        # pdf_merger = PyPDF2.PdfMerger()
         pdf_writer = pypdf.PdfWriter()
 
+        input_size = sum(cls._get_size(pdf) for pdf in pdf_list)
         for pdf in pdf_list:
+            if not isinstance(pdf, str):
+                pdf.seek(0)
             pdf_writer.append(pdf)
+        if optimize:
+            PDFOptimizer.optimize(pdf_writer)
+
+        if isinstance(output_path, str):
+            with open(output_path, "wb") as output_file:
+                pdf_writer.write(output_file)
+                output_size = output_file.tell()
+        else:
+            start = output_path.tell()
+            pdf_writer.write(output_path)
+            output_size = output_path.tell() - start
+        if optimize and input_size:
+            saved = input_size - output_size
+            logger.info(f"Optimized the PDF: {output_size:,} bytes, {saved:,} bytes ({100 * saved / input_size:.1f}%) "
+                        f"smaller than the merged PDFs")
 
-        with open(output_path, "wb") as output_file:
-            pdf_writer.write(output_file)
+    @classmethod
+    def _read_stderr(cls, stream, output: list, pages: queue.Queue):
+        """
+        Read wkhtmltopdf's progress output until it exits. Runs in a thread
+        :param stream: The process's stderr
+        :param output: A list to add the output to, for the error message
+        :param pages: A queue to put the (rendered pages, total pages) of each progress line in
+        """
+        decoder, line = codecs.getincrementaldecoder("utf-8")(errors="replace"), ""
+        # The progress bar is redrawn with carriage returns, so the output is split as it arrives (a text stream
+        # would hold a carriage return back until the next character)
+        for chunk in iter(lambda: stream.read1(io.DEFAULT_BUFFER_SIZE), b""):
+            text = decoder.decode(chunk)
+            output.append(text)
+            *lines, line = re.split(r"[\r\n]", line + text)
+            for match in filter(None, map(cls._PAGE_PATTERN.search, lines)):
+                pages.put((int(match.group(1)), int(match.group(2))))
 
-    def _html_to_pdf(self, html: str):
+    def _report_pages(self, pages: queue.Queue):
         """
-        Write the document's HTML string to a PDF file
+        Report the rendered pages, and check whether the run was cancelled
+        :param pages: The queue of (rendered pages, total pages)
+        """
+        while not pages.empty():
+            self.PROGRESS.update(Progress.RENDER, *pages.get())
+        self.PROGRESS.check()
+
+    def _run_wkhtmltopdf(self, html: str, html_file: str, options: dict, pdf_file: str = None) -> bytes:
+        """
+        Run wkhtmltopdf in a child process that can be stopped, instead of pdfkit's blocking call: The pages are
+        reported as they are rendered, and the process is killed when the run is cancelled
+        :param html: The HTML string, passed to wkhtmltopdf's stdin
+        :param html_file: An HTML file to read the document from, instead of the HTML string. Its path is passed to
+        wkhtmltopdf, which reads it by itself
+        :param options: The wkhtmltopdf options
+        :param pdf_file: A file for wkhtmltopdf to write the PDF to, instead of writing it to stdout
+        :return: The PDF bytes (None when the PDF is written to pdf_file)
+        """
+        source, source_type = (html, "string") if html_file is None else (html_file, "file")
+        kit = pdfkit.PDFKit(source, source_type, options=options, verbose=True)  # Verbose for the progress
+        args = kit.command(pdf_file)  # The input and output file paths, or "-" for stdin and stdout
+        process = subprocess.Popen(args, stdin=subprocess.PIPE if html_file is None else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE if pdf_file is None else subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE, env=kit.environ)
+        pdf, stderr, pages = [None], [], queue.Queue()
+
+        def write_input():
+            try:
+                with process.stdin:
+                    process.stdin.write(kit.source.to_s().encode("utf-8"))
+            except (BrokenPipeError, ValueError):  # Killed, or exited before reading the whole input
+                pass
+
+        def read_output():
+            pdf[0] = process.stdout.read()
+
+        threads = [threading.Thread(target=self._read_stderr, args=(process.stderr, stderr, pages), daemon=True)]
+        if html_file is None:
+            threads.append(threading.Thread(target=write_input, daemon=True))
+        if pdf_file is None:
+            threads.append(threading.Thread(target=read_output, daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while process.poll() is None:
+                try:
+                    process.wait(timeout=Progress.CHECK_INTERVAL)
+                except subprocess.TimeoutExpired:
+                    pass
+                self._report_pages(pages)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            for thread in threads:
+                thread.join()
+            for stream in process.stdout, process.stderr:
+                if stream is not None:
+                    stream.close()
+        self._report_pages(pages)  # The pages that were read after the last check
+        pdfkit.PDFKit.handle_error(process.returncode, "".join(stderr))
+        return pdf[0]
+
+    def _html_to_pdf(self, html: str, html_file: str = None):
+        """
+        Write the document's HTML string to the PDF output file (or writable file-like object)
         :param html: The HTML string
+        :param html_file: An HTML file to read the document from, instead of the HTML string
         """
         options = {
             'encoding': 'UTF-8',
@@ -275,18 +459,40 @@ class Form1325DFToPDF:
             "header-spacing": 6,
             "footer-spacing": 1,
         }
-        # Create the temp PDF file with a uuid as its name
         resources_dir = f"{os.path.dirname(os.path.dirname(__file__))}/resources"
-        temp_pdf = f"/tmp/{uuid.uuid4()}.pdf"
-        # Generate the temp PDF file with a css file for a good-looking output
-        if pdfkit.from_string(html, temp_pdf, options=options, css=f"{resources_dir}/form_1325.css"):
-            # Add the explanations PDF page to the temp PDF file
-            self.merge_pdfs([temp_pdf, f"{resources_dir}/1325_explanations_{self.YEAR}.pdf"], self.OUTPUT_PATH)
-            os.remove(temp_pdf)  # Remove the temp file
+        # A css file for a good-looking output, applied by wkhtmltopdf (the HTML is not read to add it)
+        options["user-style-sheet"] = f"{resources_dir}/form_1325.css"
+        # wkhtmltopdf embeds only the subsets of the (Hebrew) fonts that are used, so the fonts are already subset.
+        # Generate the PDF in memory (wkhtmltopdf writes it to stdout), or next to the HTML file when it's read from
+        # one, so the PDF is streamed to the file and not buffered
+        pdf_file = None if html_file is None else f"{os.path.splitext(html_file)[0]}.pdf"
+        try:
+            pdf = self._run_wkhtmltopdf(html, html_file, options, pdf_file)
+            if pdf if pdf_file is None else os.path.exists(pdf_file) and os.path.getsize(pdf_file):
+                # Add the explanations PDF page to the PDF, unless it's linked
+                pdf_list = [io.BytesIO(pdf) if pdf_file is None else pdf_file]
+                if self.EXPLANATIONS_URL is None:
+                    pdf_list.append(f"{resources_dir}/1325_explanations_{self.YEAR}.pdf")
+                self.merge_pdfs(pdf_list, self.OUTPUT_PATH)
+        finally:
+            if pdf_file is not None and os.path.exists(pdf_file):
+                os.remove(pdf_file)
 
     def run(self):
         """
         Convert the object's DataFrame (self.DF) to HTML, and then from HTML to PDF
         """
-        html = self._df_to_html()
-        self._html_to_pdf(html)
+        if self.STORE is None:
+            html = self._df_to_html()
+            self._html_to_pdf(html)
+            return
+
+        # Write the HTML to a temp file chunk by chunk (next to the store, in the spill folder), so the rows read from
+        # the store are never all in memory
+        fd, temp_html = tempfile.mkstemp(suffix=".html", dir=os.path.dirname(self.STORE.PATH))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.writelines(self._html_chunks())
+            self._html_to_pdf(None, temp_html)
+        finally:
+            os.remove(temp_html)
@@ -1,24 +1,153 @@
+import copy
+import io
+import os
+import signal
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable
+
 import pandas as pd
 
+from bank_of_israel_rates import BankOfIsraelRates
 from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_merger import ColmexProOrdersMerger
 from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from colmex_pro_orders_validator import ColmexProOrdersValidator
+from colmex_pro_orders_xlsx_reader import ColmexProOrdersXLSXReader
+from config import Config
+from external_sort import ExternalSort
 from form_1325_df_to_pdf import Form1325DFToPDF
+from form_1325_totals import Form1325Totals
+from logger import get_log_context, init_process_logging, log_context, logger
+from matched_lots_store import MatchedLotsStore
+from progress import Cancelled, CancellationToken, Progress
+from reference_engine import ReferenceEngine
+from result_cache import ResultCache
+
+
+def _init_worker(queue):
+    """
+    Initialize a worker process: Its logs are sent to the main process, and Ctrl+C is left to the main process,
+    which cancels the run cleanly
+    """
+    init_process_logging(queue)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _generate_account(
+        generator: "_Form1325Generator", df: pd.DataFrame, year: int, rates: dict, account: str, context: dict
+) -> str:
+    """
+    Generate the output of a single account. Runs in a worker process, with only the account's orders
+    :return: The output file path
+    """
+    with log_context(**{**context, "account": account}):
+        generator._generate(df, year, rates)
+    return generator.OUTPUT_FILE
 
 
 class _Form1325Generator:
-    def __init__(self, input_file: str, output_file: str, **kwargs):
+    ACCOUNT_PLACEHOLDER = "{account}"
+
+    # Accounts file columns
+    ACCOUNT_NAME = "Name"
+    ACCOUNT_FILE_NUMBER = "File Number"
+
+    def __init__(self, input_file: str, output_file: str, spill_dir: str = None, summary_file: str = None,
+                 by_account: bool = False, accounts_file: str = None, workers: int = None,
+                 consolidate_fills: bool = False, lineage_file: str = None, aggregate_rows: bool = False,
+                 no_cache: bool = False, cache_dir: str = None, merge_files: list = None, external_sort: bool = False,
+                 chunk_size: int = None, progress: Callable[[str, int, int], None] = None,
+                 cancel_token: CancellationToken = None, reference_engine: bool = False, **kwargs):
         self.INPUT_FILE = input_file
         self.OUTPUT_FILE = output_file
+        self.SPILL_DIR = spill_dir
+        self.SUMMARY_FILE = summary_file
+        self.BY_ACCOUNT = by_account
+        self.ACCOUNTS_FILE = accounts_file
+        self.WORKERS = workers
+        self.CONSOLIDATE_FILLS = consolidate_fills
+        self.LINEAGE_FILE = lineage_file
+        self.AGGREGATE_ROWS = aggregate_rows
+        self.NO_CACHE = no_cache
+        self.CACHE_DIR = cache_dir
+        self.MERGE_FILES = merge_files or []
+        self.EXTERNAL_SORT = external_sort
+        self.CHUNK_SIZE = chunk_size
+        self.PROGRESS = Progress(progress, cancel_token)
+        self.REFERENCE_ENGINE = reference_engine
+        self.ENGINE = ReferenceEngine if reference_engine else ColmexProOrdersToForm1325DF
+        self.OUTPUT_FILES = []
+        self._lines = None  # The input file and line of each order, when merging input files
 
-    def _extract(self) -> pd.DataFrame:
+    @staticmethod
+    def _read_input_file(input_file) -> pd.DataFrame:
         """
-        Get a DataFrame with the Colmex Pro orders data
+        Read a Colmex Pro orders file. The reader is picked by the file extension: CSV, or the Excel export
+        :param input_file: The CSV or Excel file path, or the CSV content as bytes or as a file-like object, or the
+        orders DataFrame itself
         :return: A DataFrame with the Colmex Pro orders data
         """
-        df = pd.read_csv(self.INPUT_FILE, index_col=False)
+        if isinstance(input_file, pd.DataFrame):
+            df = input_file.copy()  # The transform adds columns, so the caller's DataFrame is left unchanged
+        elif isinstance(input_file, str) and os.path.splitext(input_file)[1][1:].lower() == Config.XLSX:
+            df = ColmexProOrdersXLSXReader.read(input_file)  # All the orders, already without empty rows
+        else:
+            if isinstance(input_file, (bytes, bytearray)):
+                input_file = io.BytesIO(input_file)
+            # Blank lines are read as empty rows and then dropped, so the index stays the file line number minus 2
+            df = pd.read_csv(input_file, index_col=False, skip_blank_lines=False)
         df = df.dropna(how='all')
         return df
 
+    def _extract(self) -> pd.DataFrame:
+        """
+        Get a DataFrame with the Colmex Pro orders data. The input files to merge are merged with the input file
+        :return: A DataFrame with the Colmex Pro orders data
+        """
+        df = self._read_input_file(self.INPUT_FILE)
+        self.PROGRESS.update(Progress.PARSE, len(df))
+        if self.MERGE_FILES:
+            input_files = [self.INPUT_FILE, *self.MERGE_FILES]
+            dfs = [df]
+            for merge_file in self.MERGE_FILES:
+                dfs.append(self._read_input_file(merge_file))
+                self.PROGRESS.update(Progress.PARSE, sum(map(len, dfs)))
+            for file_df, input_file in zip(dfs, input_files):  # The merge needs valid dates and times
+                ColmexProOrdersValidator.validate(file_df, input_file=input_file, check_orders=False)
+            df, self._lines = ColmexProOrdersMerger.merge(dfs, input_files, return_lines=True)
+        return df
+
+    def _validate(self, df: pd.DataFrame, get_rates: Callable[[int], dict] = None) -> tuple[int, dict]:
+        """
+        Validate the orders before they are transformed, and get the year and its rates. The rates are checked last,
+        as they can only be fetched for valid orders from one year
+        :param df: The Colmex Pro orders DataFrame
+        :param get_rates: A function that gets the rates of a year (fetched from BOI if not passed)
+        :return: The year and the rates dictionary
+        """
+        input_file = self.INPUT_FILE if not self.MERGE_FILES else None  # The lines of merged files have the file
+        ColmexProOrdersValidator.validate(df, self._lines, self.BY_ACCOUNT, input_file)
+        year = self._get_year(df)
+        if get_rates is None:
+            rates = BankOfIsraelRates.get_rates(year, ColmexProOrdersToForm1325DF.COIN)
+        else:
+            rates = get_rates(year)
+        ColmexProOrdersValidator.validate_rates(df, rates, self._lines, input_file)
+        return year, rates
+
+    def read_orders(self, get_rates: Callable[[int], dict] = None) -> tuple[pd.DataFrame, int, dict]:
+        """
+        Read and validate the orders of the input files, and get their year and its rates
+        :param get_rates: A function that gets the rates of a year (fetched from BOI if not passed)
+        :return: The Colmex Pro orders DataFrame, the year and the rates dictionary
+        """
+        with log_context(stage="extract"):
+            df = self._extract()
+        with log_context(stage="validate"):
+            year, rates = self._validate(df, get_rates)
+        return df, year, rates
+
     @staticmethod
     def _get_year(df: pd.DataFrame) -> int:
         """
@@ -30,12 +159,17 @@ class _Form1325Generator:
         raise Exception("Error: Multiple years found in input file. Can only support files with orders from one year")
 
     @staticmethod
-    def _transform(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    def _transform(
+            df: pd.DataFrame, year: int, totals: Form1325Totals = None, rates: dict = None, aggregate: bool = False,
+            progress: Progress = None, engine: type = ColmexProOrdersToForm1325DF
+    ) -> pd.DataFrame:
         """
         Transform the Colmex Pro orders DataFrame to Form 1325 rows DataFrame
         :return: A pd.DataFrame object
         """
-        transformed_df = ColmexProOrdersToForm1325DF.run(df, year)
+        transformed_df = engine.run(
+            df, year, totals=totals, rates=rates, aggregate=aggregate, progress=progress
+        )
         return transformed_df
 
     def _load(self, df: pd.DataFrame, **kwargs):
@@ -44,40 +178,355 @@ class _Form1325Generator:
         """
         pass
 
-    def run(self):
+    @contextmanager
+    def _open_output_file(self):
+        """
+        Open the output file for writing text. The output file can also be a binary writable file-like object, which
+        is left open
+        :return: A text file object
+        """
+        if isinstance(self.OUTPUT_FILE, str):
+            with open(self.OUTPUT_FILE, "w", encoding="utf-8-sig", newline="") as f:
+                yield f
+        else:
+            f = io.TextIOWrapper(self.OUTPUT_FILE, encoding="utf-8-sig", newline="")
+            try:
+                yield f
+            finally:
+                f.flush()
+                f.detach()  # Don't close the caller's file object
+
+    def _run_spilled(self, df: pd.DataFrame, year: int, totals: Form1325Totals, rates: dict = None):
+        """
+        Run the generator with the matched lots written to a memory-mapped store in the spill directory, instead of
+        being collected into a DataFrame
+        """
+        with MatchedLotsStore.create(self.SPILL_DIR) as store:
+            self.ENGINE.run(df, year, store, totals, rates, self.AGGREGATE_ROWS, self.PROGRESS)
+            self._load(None, year=year, store=store, totals=totals)
+
+    def _write_summary(self, totals: Form1325Totals):
+        """
+        Write the totals summary (per symbol, per month and grand total) to the summary CSV file
+        """
+        totals.to_df().to_csv(self.SUMMARY_FILE, index=False, encoding='utf-8-sig')
+
+    def _consolidate_fills(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merge the partial fills of each order before matching, and write the lineage file if requested
+        :return: The consolidated orders DataFrame
+        """
+        consolidated_df = ColmexProOrdersToForm1325DF.consolidate_fills(df)
+        logger.info(f"Consolidated {len(df)} fills into {len(consolidated_df)} orders")
+        if self.LINEAGE_FILE is not None:
+            consolidated_df.to_csv(self.LINEAGE_FILE, index=False, encoding='utf-8-sig')
+        return consolidated_df
+
+    def _generate_files(self, df: pd.DataFrame, year: int, rates: dict = None):
+        """
+        Generate the output file (and the summary and lineage files) from the Colmex Pro orders DataFrame
+        """
+        totals = Form1325Totals()
+        with log_context(stage="transform"):
+            if self.CONSOLIDATE_FILLS:
+                df = self._consolidate_fills(df)
+            if self.SPILL_DIR is not None:
+                self._run_spilled(df, year, totals, rates)  # Transformed and loaded together
+                transformed_df = None
+            else:
+                transformed_df = self._transform(
+                    df, year, totals, rates, self.AGGREGATE_ROWS, self.PROGRESS, self.ENGINE
+                )
+                if transformed_df is None:
+                    raise Exception(f"Failed to transform the input file")
+        with log_context(stage="load"):
+            if transformed_df is not None:
+                self._load(transformed_df, year=year, totals=totals)
+            if self.SUMMARY_FILE is not None:
+                self._write_summary(totals)
+
+    @staticmethod
+    def _get_mtime(path: str):
+        """
+        :param path: A file path
+        :return: The file's modification time in nanoseconds (None if it doesn't exist)
+        """
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    @contextmanager
+    def _remove_outputs_on_cancel(self, generators: list):
+        """
+        Remove the files written by a run that is cancelled, so no partial outputs are left. Files that the run didn't
+        write (like the outputs of a previous run) are kept
+        :param generators: The run's generators (one per account with by_account)
+        """
+        paths = [
+            path for generator in generators
+            for path in (generator.OUTPUT_FILE, generator.SUMMARY_FILE, generator.LINEAGE_FILE) if isinstance(path, str)
+        ]
+        mtimes = {path: self._get_mtime(path) for path in paths}
+        try:
+            yield
+        except Cancelled:
+            removed = [path for path, mtime in mtimes.items() if self._get_mtime(path) not in (None, mtime)]
+            for path in removed:
+                os.remove(path)
+            if removed:
+                logger.info(f"Removed the partial outputs of the cancelled run: {', '.join(removed)}")
+            raise
+
+    def _get_cache_files(self) -> dict:
+        """
+        :return: The generated files, in {name: file path} format
+        """
+        files = {"output": self.OUTPUT_FILE, "summary": self.SUMMARY_FILE, "lineage": self.LINEAGE_FILE}
+        if not self.CONSOLIDATE_FILLS:
+            files.pop("lineage")  # The lineage file is written only when consolidating fills
+        return {name: file_path for name, file_path in files.items() if file_path is not None}
+
+    def _get_cache_options(self, year: int) -> dict:
+        """
+        Get the options that affect the output. Subclasses add their own options
+        :return: A dictionary of the options
+        """
+        return {
+            "generator": type(self).__name__, "year": year, "consolidate_fills": self.CONSOLIDATE_FILLS,
+            "aggregate_rows": self.AGGREGATE_ROWS, "files": sorted(self._get_cache_files()),
+            "reference_engine": self.REFERENCE_ENGINE,
+        }
+
+    def _generate(self, df: pd.DataFrame, year: int, rates: dict = None):
+        """
+        Generate the output files, or copy them from the result cache if they were already generated from the same
+        orders, options, rates and tool version
+        """
+        if self.NO_CACHE or not isinstance(self.OUTPUT_FILE, str):  # Only output files can be cached
+            self._generate_files(df, year, rates)
+        else:
+            if rates is None:
+                rates = BankOfIsraelRates.get_rates(year, ColmexProOrdersToForm1325DF.COIN)
+            cache = ResultCache(self.CACHE_DIR)
+            files = self._get_cache_files()
+            key = cache.get_key(df, self._get_cache_options(year), rates)
+            if cache.restore(key, files):
+                logger.info(f"The output is unchanged, copied from the cache: {self.OUTPUT_FILE}")
+            else:
+                self._generate_files(df, year, rates)
+                cache.store(key, files)
+        self.OUTPUT_FILES.append(self.OUTPUT_FILE)
+
+    @classmethod
+    def _get_account_path(cls, path: str, account: str) -> str:
+        """
+        Get an account's file path: The account replaces the {account} placeholder, or is added as a suffix to the
+        file name if there is no placeholder
+        :param path: The file path (or template)
+        :param account: The account
+        :return: The account's file path
+        """
+        if cls.ACCOUNT_PLACEHOLDER in path:
+            return path.replace(cls.ACCOUNT_PLACEHOLDER, account)
+        root, extension = os.path.splitext(path)
+        return f"{root}_{account}{extension}"
+
+    def _read_accounts_file(self) -> dict:
+        """
+        Read the accounts file: A CSV file with the Account, Name and File Number columns
+        :return: A dictionary with {account: {column: value}} format
+        """
+        if self.ACCOUNTS_FILE is None:
+            return {}
+        accounts_df = pd.read_csv(self.ACCOUNTS_FILE, dtype=str, index_col=False).dropna(how='all')
+        return accounts_df.set_index(Columns.ACCOUNT).to_dict(orient="index")
+
+    def _for_account(self, account: str, details: dict) -> "_Form1325Generator":
+        """
+        Get a copy of the generator for a single account
+        :param account: The account
+        :param details: The account's row from the accounts file (empty if missing)
+        :return: The account's generator
+        """
+        generator = copy.copy(self)
+        generator.BY_ACCOUNT = False
+        generator.OUTPUT_FILES = []
+        generator.PROGRESS = Progress()  # Runs in a worker process, the accounts' progress is reported by the run
+        generator.OUTPUT_FILE = self._get_account_path(self.OUTPUT_FILE, account)
+        if self.SUMMARY_FILE is not None:
+            generator.SUMMARY_FILE = self._get_account_path(self.SUMMARY_FILE, account)
+        if self.LINEAGE_FILE is not None:
+            generator.LINEAGE_FILE = self._get_account_path(self.LINEAGE_FILE, account)
+        return generator
+
+    def _wait_for_accounts(self, executor: ProcessPoolExecutor, futures: list[Future]):
+        """
+        Wait for the accounts' outputs, and report the generated accounts. When the run is cancelled, the accounts
+        that didn't start are cancelled, and the running accounts are waited for
+        """
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=Progress.CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+                if done:
+                    self.PROGRESS.update(Progress.ACCOUNTS, len(futures) - len(pending), len(futures))
+                else:
+                    self.PROGRESS.check()
+        except Cancelled:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    def _run_by_account(self, df: pd.DataFrame, year: int, rates: dict):
+        """
+        Split the orders by account in a single pass, and generate each account's output in a worker process, so
+        the positions of different accounts are matched separately. The rates are fetched once for all accounts
+        """
+        accounts = self._read_accounts_file()
+        account_dfs = [(str(account), account_df) for account, account_df in df.groupby(Columns.ACCOUNT, sort=False)]
+        generators = {account: self._for_account(account, accounts.get(account, {})) for account, _ in account_dfs}
+        workers = min(self.WORKERS or os.cpu_count() or 1, len(account_dfs)) or 1
+
+        errors = []
+        context = get_log_context()
+        with self._remove_outputs_on_cancel(list(generators.values())), ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(logger.get_process_queue(),)
+        ) as executor:
+            futures = {
+                account: executor.submit(_generate_account, generators[account], account_df, year, rates, account,
+                                         context)
+                for account, account_df in account_dfs
+            }
+            del account_dfs
+            self._wait_for_accounts(executor, list(futures.values()))
+            for account, future in futures.items():
+                try:
+                    self.OUTPUT_FILES.append(future.result())
+                except Exception as e:
+                    errors.append(f"{account}: {e}")
+        if errors:
+            raise Exception(f"Failed to generate the output for accounts: {'; '.join(errors)}")
+
+    def _run_external_sort(self, get_rates: Callable[[int], dict] = None):
+        """
+        Run the generator on an input file that is too big to sort in memory: The orders are sorted with an external
+        sort in the spill directory (or in the system's temp directory), validated one symbol at a time, and then
+        matched one symbol at a time
+        :param get_rates: A function that gets the rates of a year (fetched from BOI if not passed)
+        """
+        if self.BY_ACCOUNT or self.MERGE_FILES or self.CONSOLIDATE_FILLS:
+            raise Exception("--external_sort can't be used with --by_account, --merge_files or --consolidate_fills")
+        totals = Form1325Totals()
+        with ExternalSort.create(self.SPILL_DIR, self.CHUNK_SIZE) as external_sort:
+            external_sort.split(self.INPUT_FILE, self.PROGRESS)
+            if not external_sort.symbols:
+                raise Exception(f"No orders found in {self.INPUT_FILE}")
+            year = external_sort.year
+            if get_rates is None:
+                rates = BankOfIsraelRates.get_rates(year, ColmexProOrdersToForm1325DF.COIN)
+            else:
+                rates = get_rates(year)
+            external_sort.validate(rates, self.INPUT_FILE, self.PROGRESS)  # Before the orders are matched
+            symbol_dfs = external_sort.iter_symbol_dfs()
+            if self.SPILL_DIR is not None:
+                with MatchedLotsStore.create(self.SPILL_DIR) as store:
+                    self.ENGINE.transform_sorted(
+                        symbol_dfs, rates, store, totals, self.AGGREGATE_ROWS, self.PROGRESS, external_sort.symbols
+                    )
+                    self._load(None, year=year, store=store, totals=totals)
+            else:
+                transformed_df = self.ENGINE.transform_sorted(
+                    symbol_dfs, rates, totals=totals, aggregate=self.AGGREGATE_ROWS, progress=self.PROGRESS,
+                    symbols=external_sort.symbols
+                )
+                self._load(transformed_df, year=year, totals=totals)
+        if self.SUMMARY_FILE is not None:
+            self._write_summary(totals)
+        self.OUTPUT_FILES.append(self.OUTPUT_FILE)
+
+    def run(self, get_rates: Callable[[int], dict] = None):
         """
         Run the generator
+        :param get_rates: A function that gets the rates of a year (fetched from BOI if not passed), e.g. to reuse the
+        rates in the runs of several generators
         """
-        df = self._extract()
-        year = self._get_year(df)
-        transformed_df = self._transform(df, year)
-        if transformed_df is not None:
-            self._load(transformed_df, year=year)
+        if self.EXTERNAL_SORT:
+            with self._remove_outputs_on_cancel([self]):
+                self._run_external_sort(get_rates)
+            return
+        df, year, rates = self.read_orders(get_rates)
+        if self.BY_ACCOUNT:
+            self._run_by_account(df, year, rates)  # The accounts' outputs are removed when the run is cancelled
         else:
-            raise Exception(f"Failed to transform the input file")
+            with self._remove_outputs_on_cancel([self]):
+                self._generate(df, year, rates)
 
 
 class Form1325CSVGenerator(_Form1325Generator):
-    def __init__(self, input_file: str, output_file: str, **kwargs):
+    def __init__(self, input_file: str, output_file: str, subtotals: bool = False, **kwargs):
         super().__init__(input_file, output_file, **kwargs)
+        self.SUBTOTALS = subtotals
+
+    def _get_cache_options(self, year: int) -> dict:
+        """
+        Get the options that affect the output, with the subtotals option
+        """
+        return {**super()._get_cache_options(year), "subtotals": self.SUBTOTALS}
 
     def _load(self, df: pd.DataFrame, **kwargs):
         """
         Load the DataFrame to a CSV file
         """
-        df.to_csv(self.OUTPUT_FILE, index=False, encoding='utf-8-sig')
+        store = kwargs.get("store")
+        totals = kwargs.get("totals")
+        with self._open_output_file() as f:
+            if store is None:
+                df.to_csv(f, index=False)
+            else:
+                for i, chunk_df in enumerate(store.iter_dfs()):
+                    chunk_df.to_csv(f, index=False, header=i == 0)
+
+            # Add the subtotals section after an empty line
+            if self.SUBTOTALS and totals is not None:
+                f.write("\n")
+                totals.to_df().to_csv(f, index=False)
 
 
 class Form1325PDFGenerator(_Form1325Generator):
-    def __init__(self, input_file: str, output_file: str, name: str, file_number: str, asset_abroad: str, **kwargs):
+    def __init__(self, input_file: str, output_file: str, name: str, file_number: str, asset_abroad: str,
+                 explanations_url: str = None, **kwargs):
         super().__init__(input_file, output_file, **kwargs)
         self.NAME = name
         self.FILE_NUMER = file_number
         self.ASSET_ABROAD = eval(asset_abroad.capitalize())
+        self.EXPLANATIONS_URL = explanations_url
+
+    def _get_cache_options(self, year: int) -> dict:
+        """
+        Get the options that affect the output, with the details printed on the form
+        """
+        return {
+            **super()._get_cache_options(year),
+            "name": self.NAME, "file_number": self.FILE_NUMER, "asset_abroad": self.ASSET_ABROAD,
+            "explanations_url": self.EXPLANATIONS_URL,
+        }
+
+    def _for_account(self, account: str, details: dict) -> "_Form1325Generator":
+        """
+        Get a copy of the generator for a single account, with the account's name and file number
+        """
+        generator = super()._for_account(account, details)
+        generator.NAME = details.get(self.ACCOUNT_NAME, self.NAME)
+        generator.FILE_NUMER = details.get(self.ACCOUNT_FILE_NUMBER, self.FILE_NUMER)
+        if generator.NAME is None or generator.FILE_NUMER is None:
+            raise Exception(f"Missing name or file number for account {account}. Add it to the accounts file")
+        return generator
 
     def _load(self, df: pd.DataFrame, **kwargs):
         """
         Load the DataFrame to a PDF file
         """
         year = kwargs.get("year")
-        Form1325DFToPDF(year, self.NAME, self.FILE_NUMER, self.ASSET_ABROAD, df, self.OUTPUT_FILE).run()
+        store = kwargs.get("store")
+        totals = kwargs.get("totals")
+        Form1325DFToPDF(
+            year, self.NAME, self.FILE_NUMER, self.ASSET_ABROAD, df, self.OUTPUT_FILE, store, totals,
+            self.EXPLANATIONS_URL, self.PROGRESS, self.REFERENCE_ENGINE
+        ).run()
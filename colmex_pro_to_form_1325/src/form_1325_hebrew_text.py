@@ -55,6 +55,8 @@ class Form1325HebrewText:
 
     COMMENT = "הערה: בעל מניות מהותי, התובע רווחים ראויים לחלוקה, ימלא טופס 1399(י) או 1399(ח)(8)"
 
+    EXPLANATIONS = "דברי הסבר למילוי הטופס"
+
     SIGNATURE_1 = "חתימה"
     SIGNATURE_2 = "חותמת המייצג לשם זיהוי"
 
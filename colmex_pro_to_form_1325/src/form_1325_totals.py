@@ -0,0 +1,82 @@
+from datetime import datetime
+
+import pandas as pd
+
+from config import Config
+from fixed_point import FixedPoint
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+
+
+class Form1325Totals:
+    """
+    Running totals of the form 1325 rows: the total profit, loss and sales, broken down by symbol and by sell month.
+    The totals are added up in agorot as the lots are matched, so the renderers don't need to sum the output columns.
+    """
+    # Summary columns
+    SECTION = "Section"
+    KEY = "Key"
+
+    # Summary sections
+    SYMBOL = "Symbol"
+    MONTH = "Month"
+    TOTAL = "Total"
+
+    _COLUMNS = [Heb.PROFIT, Heb.LOSS, Heb.SELL_AMOUNT]
+
+    def __init__(self):
+        self.TOTAL_PROFIT = 0
+        self.TOTAL_LOSS = 0
+        self.TOTAL_SALES = 0
+        self.BY_SYMBOL = {}  # {symbol: [profit, loss, sales]}
+        self.BY_MONTH = {}  # {YYYY-MM: [profit, loss, sales]}
+        self._months = {}  # Cache of sell date -> month
+
+    def _get_month(self, trade_date: str) -> str:
+        """
+        :param trade_date: A trade date string in Colmex Pro MTS format
+        :return: The month in YYYY-MM format
+        """
+        month = self._months.get(trade_date)
+        if month is None:
+            month = datetime.strptime(trade_date, Config.COLMEX_PRO_MTS_DATE_FORMAT).strftime("%Y-%m")
+            self._months[trade_date] = month
+        return month
+
+    def add(self, rows: list[dict]):
+        """
+        Add form 1325 rows to the totals
+        :param rows: A list of form 1325 dictionary rows, with the amounts in agorot
+        """
+        for row in rows:
+            profit, loss, sales = row[Heb.PROFIT] or 0, row[Heb.LOSS] or 0, row[Heb.SELL_AMOUNT]
+            self.TOTAL_PROFIT += profit
+            self.TOTAL_LOSS += loss
+            self.TOTAL_SALES += sales
+            month = self._get_month(row[Heb.SELL_DATE])
+            for breakdown, key in (self.BY_SYMBOL, row[Heb.SYMBOL]), (self.BY_MONTH, month):
+                values = breakdown.setdefault(key, [0, 0, 0])
+                values[0] += profit
+                values[1] += loss
+                values[2] += sales
+
+    def totals(self) -> dict:
+        """
+        :return: A dictionary with the rounded total profit, total loss and total sales
+        """
+        return {
+            Heb.PROFIT: round(FixedPoint.to_float(self.TOTAL_PROFIT, FixedPoint.ILS_SCALE)),
+            Heb.LOSS: round(FixedPoint.to_float(self.TOTAL_LOSS, FixedPoint.ILS_SCALE)),
+            Heb.SELL_AMOUNT: round(FixedPoint.to_float(self.TOTAL_SALES, FixedPoint.ILS_SCALE)),
+        }
+
+    def to_df(self) -> pd.DataFrame:
+        """
+        Get the totals as a summary DataFrame: a row per symbol, a row per month and a row for the grand total
+        :return: The summary DataFrame
+        """
+        rows = [[self.SYMBOL, symbol, *values] for symbol, values in self.BY_SYMBOL.items()]
+        rows.extend([self.MONTH, month, *self.BY_MONTH[month]] for month in sorted(self.BY_MONTH))
+        rows.append([self.TOTAL, "", self.TOTAL_PROFIT, self.TOTAL_LOSS, self.TOTAL_SALES])
+        df = pd.DataFrame(rows, columns=[self.SECTION, self.KEY, *self._COLUMNS])
+        df[self._COLUMNS] = FixedPoint.to_float(df[self._COLUMNS], FixedPoint.ILS_SCALE)
+        return df
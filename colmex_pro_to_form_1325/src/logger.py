@@ -1,32 +1,210 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os.path
-import sys
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from utilities import PACKAGE_NAME, Utilities
+
+# The context of the log records: The job (a run of the tool or a watched file), the account and the stage
+JOB_ID = contextvars.ContextVar("job_id", default=None)
+ACCOUNT = contextvars.ContextVar("account", default=None)
+STAGE = contextvars.ContextVar("stage", default=None)
+_CONTEXT = {"job_id": JOB_ID, "account": ACCOUNT, "stage": STAGE}
+
+
+@contextmanager
+def log_context(**kwargs):
+    """
+    Set the context of the log records written inside the block
+    :param kwargs: The job_id, account and/or stage
+    """
+    tokens = [(_CONTEXT[key], _CONTEXT[key].set(value)) for key, value in kwargs.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def get_log_context() -> dict:
+    """
+    :return: The current log context, to be passed to a worker process
+    """
+    return {key: var.get() for key, var in _CONTEXT.items()}
+
+
+def new_job_id() -> str:
+    """
+    :return: A new job ID
+    """
+    return uuid.uuid4().hex[:12]
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Add the log context to the records. It runs in the thread that logs, where the context is set
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, var in _CONTEXT.items():
+            setattr(record, key, var.get())
+        return True
+
+
+class _JSONFormatter(logging.Formatter):
+    """
+    Format the records as JSON lines
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record), "level": record.levelname, "process": record.process,
+            "module": record.module, "function": record.funcName, "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        data.update({key: getattr(record, key, None) for key in _CONTEXT})
+        return json.dumps(data, ensure_ascii=False)
 
 
 class MyLogger:
-    LOGS_FOLDER = f"/var/tmp/log/{os.path.basename(os.path.dirname(os.path.dirname(__file__)))}"
+    """
+    The app's logger. The records are put on a queue and written to the console and to a JSON lines log file by a
+    background thread, so logging never blocks on I/O. Worker processes put their records on a multiprocessing queue
+    that is written by the same thread, so the log file has a single writer. The logger is set up when it is first
+    used.
+    Each process that sets up the logger (a run of the tool, or a watch) writes its own log file, in a private per-user
+    folder, so concurrent runs never write to or rotate the same file. The file is reopened if it's moved, so it can
+    be rotated externally (e.g. by logrotate), and the log files that were not written for MAX_AGE_DAYS are removed.
+    """
+    LOGS_FOLDER = os.path.join(Utilities.USER_STATE_FOLDER, "log")
+    MAX_AGE_DAYS = 30
+    LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG records are dropped unless enabled
 
     def __init__(self):
-        if not os.path.exists(self.LOGS_FOLDER):
-            os.makedirs(self.LOGS_FOLDER, exist_ok=True)
+        self._logger = None
+        self._handlers = []
+        self._listeners = []
+        self._process_queue = None
+        self._lock = threading.Lock()
+        self.LOG_FILE = None  # Set when the logger is set up
 
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
+    def _get_logger(self) -> logging.Logger:
+        """
+        Get the logger, and set it up on the first use
+        :return: A logging.Logger object
+        """
+        if self._logger is None:
+            with self._lock:
+                if self._logger is None:
+                    self._logger = self._setup()
+        return self._logger
 
-        # Create a formatter and add it to the handler
-        formatter = logging.Formatter("%(asctime)s %(module)s.%(funcName)s -> %(lineno)d-%(levelname)s: %(message)s")
+    def _setup(self) -> logging.Logger:
+        """
+        Set up the logger: A queue handler, and a background listener that writes the records to the handlers
+        :return: A logging.Logger object
+        """
+        logs_folder = Utilities.make_private_folder(self.LOGS_FOLDER)
+        self._remove_old_logs(logs_folder)
+        log_name = f"{PACKAGE_NAME}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.log"
+        self.LOG_FILE = os.path.join(logs_folder, log_name)
 
-        # Create & add a console handler
+        # Create a formatter and add it to the console handler
+        formatter = logging.Formatter("%(asctime)s %(module)s.%(funcName)s -> %(lineno)d-%(levelname)s: %(message)s")
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.INFO)
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
 
-        # Create & add a file handler
-        file_handler = logging.FileHandler(f"{self.LOGS_FOLDER}/{os.path.basename(sys.argv[0])}.log")
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+        # Create a JSON lines file handler, of this process's log file
+        file_handler = logging.handlers.WatchedFileHandler(self.LOG_FILE, encoding="utf-8")
+        file_handler.setFormatter(_JSONFormatter())
+        self._handlers = [console_handler, file_handler]
+
+        log_queue = queue.SimpleQueue()
+        self._start_listener(log_queue)
+        atexit.register(self._stop_listeners)
+        return self._create_logger(log_queue)
+
+    def _remove_old_logs(self, logs_folder: str):
+        """
+        Remove the log files that were not written for MAX_AGE_DAYS
+        :param logs_folder: The logs folder
+        """
+        oldest = time.time() - self.MAX_AGE_DAYS * 24 * 3600
+        for entry in os.scandir(logs_folder):
+            try:
+                if entry.name.endswith(".log") and entry.stat().st_mtime < oldest:
+                    os.remove(entry.path)
+            except OSError:  # Removed by another process
+                pass
+
+    def _create_logger(self, log_queue) -> logging.Logger:
+        """
+        Create the logger with a queue handler
+        :param log_queue: The queue of the records
+        :return: A logging.Logger object
+        """
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(_ContextFilter())
+        new_logger = logging.getLogger(__name__)
+        new_logger.setLevel(self.LEVEL)
+        for handler in list(new_logger.handlers):
+            new_logger.removeHandler(handler)
+        new_logger.addHandler(queue_handler)
+        return new_logger
+
+    def _start_listener(self, log_queue):
+        listener = logging.handlers.QueueListener(log_queue, *self._handlers, respect_handler_level=True)
+        listener.start()
+        self._listeners.append(listener)
+
+    def _stop_listeners(self):
+        """
+        Write the remaining records and stop the background threads
+        """
+        for listener in self._listeners:
+            listener.stop()
+        self._listeners = []
+
+    def get_process_queue(self):
+        """
+        Get a queue for the records of worker processes (see init_process_logging)
+        :return: A multiprocessing.Queue object
+        """
+        self._get_logger()
+        with self._lock:
+            if self._process_queue is None:
+                self._process_queue = multiprocessing.Queue()
+                self._start_listener(self._process_queue)
+        return self._process_queue
+
+    def init_process(self, process_queue):
+        """
+        Set up the logger of a worker process, to put its records on the main process's queue
+        :param process_queue: The queue from get_process_queue
+        """
+        with self._lock:
+            self._listeners = []  # The listeners of a forked process belong to the parent
+            self._logger = self._create_logger(process_queue)
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):  # Not set yet (e.g. while copying)
+            raise AttributeError(name)
+        return getattr(self._get_logger(), name)
+
+
+def init_process_logging(process_queue):
+    """
+    The initializer of worker processes: Send the records to the main process
+    :param process_queue: The queue from logger.get_process_queue()
+    """
+    logger.init_process(process_queue)
 
 
-logger = MyLogger().logger
+logger = MyLogger()
@@ -0,0 +1,187 @@
+import json
+import os
+import uuid
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from config import Config
+from fixed_point import FixedPoint
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+
+
+class MatchedLotsStore:
+    """
+    A fixed-width record file of matched lots (the form 1325 rows), written as the lots are matched and read back
+    through a memory map. Used to keep the memory bounded when generating the form for very large accounts.
+    """
+    EXTENSION = "lots"
+    DTYPE = np.dtype([
+        ("symbol_id", "<i4"),
+        ("buy_date", "<i4"),  # Date ordinal
+        ("sell_date", "<i4"),  # Date ordinal
+        ("shares", "<i8"),
+        ("buy_amount", "<i8"),  # Agorot
+        ("rate_change", "<f8"),
+        ("buy_amount_adjusted", "<i8"),  # Agorot
+        ("sell_amount", "<i8"),  # Agorot
+        ("profit_loss", "<i8"),  # Agorot
+    ])
+    _EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+    _TOTALS_CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path: str):
+        self.PATH = path
+        self.SYMBOLS_PATH = f"{path}.symbols"
+        self._symbol_ids = {}
+        self._date_ordinals = {}
+        self._file = open(path, "wb")
+        self._records = None
+
+    @classmethod
+    def create(cls, directory: str) -> "MatchedLotsStore":
+        """
+        Create a new store file in a directory
+        :param directory: The directory
+        :return: A MatchedLotsStore object
+        """
+        os.makedirs(directory, exist_ok=True)
+        return cls(f"{directory}/{uuid.uuid4()}.{cls.EXTENSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.remove()
+
+    def _get_symbol_id(self, symbol: str) -> int:
+        """
+        :param symbol: The symbol
+        :return: The symbol's ID in the store's symbols table
+        """
+        return self._symbol_ids.setdefault(symbol, len(self._symbol_ids))
+
+    def _get_date_ordinal(self, trade_date: str) -> int:
+        """
+        :param trade_date: A trade date string in Colmex Pro MTS format
+        :return: The date ordinal
+        """
+        ordinal = self._date_ordinals.get(trade_date)
+        if ordinal is None:
+            ordinal = datetime.strptime(trade_date, Config.COLMEX_PRO_MTS_DATE_FORMAT).toordinal()
+            self._date_ordinals[trade_date] = ordinal
+        return ordinal
+
+    def append(self, rows: list[dict]):
+        """
+        Write form 1325 rows to the store file
+        :param rows: A list of form 1325 dictionary rows
+        """
+        records = np.empty(len(rows), dtype=self.DTYPE)
+        for i, row in enumerate(rows):
+            records[i] = (
+                self._get_symbol_id(row[Heb.SYMBOL]),
+                self._get_date_ordinal(row[Heb.BUY_DATE]),
+                self._get_date_ordinal(row[Heb.SELL_DATE]),
+                row[Heb.SHARES],
+                row[Heb.BUY_AMOUNT],
+                row[Heb.RATE_CHANGE],
+                row[Heb.BUY_AMOUNT_ADJUSTED],
+                row[Heb.SELL_AMOUNT],
+                row[Heb.PROFIT] or row[Heb.LOSS] or 0,
+            )
+        records.tofile(self._file)
+
+    def close(self):
+        """
+        Finish writing the store file and map it to memory for reading
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            with open(self.SYMBOLS_PATH, "w", encoding="utf-8") as f:
+                json.dump(list(self._symbol_ids), f)
+        if self._records is None:
+            size = os.path.getsize(self.PATH)
+            self._records = np.memmap(self.PATH, dtype=self.DTYPE, mode="r") if size else \
+                np.empty(0, dtype=self.DTYPE)
+
+    def remove(self):
+        """
+        Close and delete the store files
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._records = None
+        for path in self.PATH, self.SYMBOLS_PATH:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def records(self) -> np.ndarray:
+        """
+        :return: The memory-mapped records
+        """
+        self.close()
+        return self._records
+
+    def __len__(self):
+        return len(self.records)
+
+    def _format_dates(self, ordinals: np.ndarray) -> np.ndarray:
+        """
+        :param ordinals: An array of date ordinals
+        :return: An array of date strings in the form's format
+        """
+        dates = (ordinals.astype("int64") - self._EPOCH_ORDINAL).astype("datetime64[D]")
+        return pd.DatetimeIndex(dates).strftime(Config.COLMEX_PRO_LOG_DATE_FORMAT).to_numpy()
+
+    def iter_dfs(self, chunk_size: int = 10000):
+        """
+        Read the store in chunks of form 1325 rows
+        :param chunk_size: The number of rows in a chunk
+        :return: A generator of DataFrames with rows in form 1325 format, like the output of the transform
+        """
+        records = self.records
+        symbols = np.array(list(self._symbol_ids), dtype=object)
+        for start in range(0, max(len(records), 1), chunk_size):
+            chunk = records[start:start + chunk_size]
+            profit_loss = FixedPoint.to_float(chunk["profit_loss"], FixedPoint.ILS_SCALE)
+            profit, loss = profit_loss.astype(object), profit_loss.astype(object)
+            profit[profit_loss <= 0] = ""
+            loss[profit_loss >= 0] = ""
+            yield pd.DataFrame({
+                Columns.ROW_NUMBER: np.arange(start + 1, start + len(chunk) + 1),
+                Heb.SYMBOL: symbols[chunk["symbol_id"]],
+                Heb.BOUGHT_DURING_PRE_MARKET: "",
+                Heb.SHARES: chunk["shares"],
+                Heb.BUY_DATE: self._format_dates(chunk["buy_date"]),
+                Heb.BUY_AMOUNT: FixedPoint.to_float(chunk["buy_amount"], FixedPoint.ILS_SCALE),
+                Heb.RATE_CHANGE: chunk["rate_change"],
+                Heb.BUY_AMOUNT_ADJUSTED: FixedPoint.to_float(chunk["buy_amount_adjusted"], FixedPoint.ILS_SCALE),
+                Heb.SELL_DATE: self._format_dates(chunk["sell_date"]),
+                Heb.SELL_AMOUNT: FixedPoint.to_float(chunk["sell_amount"], FixedPoint.ILS_SCALE),
+                Heb.PROFIT: profit,
+                Heb.LOSS: loss,
+            })
+
+    def totals(self) -> dict:
+        """
+        Get the column totals, summed over the memory-mapped records
+        :return: A dictionary with the total profit, the total loss and the total sales
+        """
+        profit, loss, sales = 0, 0, 0
+        records = self.records
+        for start in range(0, len(records), self._TOTALS_CHUNK_SIZE):  # Sum in chunks to keep the memory bounded
+            chunk = records[start:start + self._TOTALS_CHUNK_SIZE]
+            profit += int(chunk["profit_loss"].clip(min=0).sum())
+            loss += int(chunk["profit_loss"].clip(max=0).sum())
+            sales += int(chunk["sell_amount"].sum())
+        return {
+            Heb.PROFIT: round(FixedPoint.to_float(profit, FixedPoint.ILS_SCALE)),
+            Heb.LOSS: round(FixedPoint.to_float(loss, FixedPoint.ILS_SCALE)),
+            Heb.SELL_AMOUNT: round(FixedPoint.to_float(sales, FixedPoint.ILS_SCALE)),
+        }
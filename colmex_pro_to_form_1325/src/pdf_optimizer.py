@@ -0,0 +1,20 @@
+import pypdf
+
+
+class PDFOptimizer:
+    """
+    Lossless size optimization of a pypdf.PdfWriter before it is written, with pypdf's public API: The page content
+    streams are Flate-compressed, identical objects are stored once, and unreachable objects are dropped. pypdf
+    writes no dates or random IDs, so the output depends only on the input PDFs' content.
+    """
+    COMPRESSION_LEVEL = 9
+
+    @classmethod
+    def optimize(cls, writer: pypdf.PdfWriter):
+        """
+        Optimize the writer's objects in place
+        :param writer: The writer, with all the pages added
+        """
+        for page in writer.pages:
+            page.compress_content_streams(level=cls.COMPRESSION_LEVEL)
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
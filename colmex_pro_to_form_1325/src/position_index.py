@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from config import Config
+from fixed_point import FixedPoint
+from form_1325_generator import Form1325CSVGenerator
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+from result_cache import ResultCache
+from utilities import Utilities
+
+
+class PositionIndex:
+    """
+    A per-symbol index of an orders file: the sorted fills with their cumulative Position, the trade boundaries and
+    the matched lots. It is built once per input file and saved to disk, so realized P&L, open lots and totals can be
+    queried per symbol and per date range without parsing the CSV and matching the orders again.
+    The index is saved as plain arrays (npz, loaded without pickle) in a private per-user folder, with the version of
+    the rates it was built with. It is valid only for the same input file content, and it is checked against the rates
+    only when they are passed or when the caller asks to revalidate them.
+    """
+    INDEX_FOLDER = os.path.join(Utilities.USER_CACHE_FOLDER, "index")
+    _VERSION = 3
+
+    # Index columns
+    TRADE_ID = Columns.TRADE_ID
+    PNL = "P&L"
+    TOTAL = "Total"
+
+    _FILLS_COLUMNS = [Columns.SYMBOL, Columns.SIDE, Columns.SHARES, Columns.PRICE, Columns.DATETIME, Columns.POSITION]
+    _SUM_COLUMNS = [PNL, Heb.PROFIT, Heb.LOSS, Heb.SELL_AMOUNT]
+
+    def __init__(
+            self, input_hash: str, year: int, rates_hash: str, fills: pd.DataFrame, lots: pd.DataFrame,
+            open_lots: pd.DataFrame
+    ):
+        self.INPUT_HASH = input_hash
+        self.YEAR = year
+        self.RATES_HASH = rates_hash
+        self.FILLS = fills
+        self.LOTS = lots
+        self.OPEN_LOTS = open_lots
+        self._build_lookups()
+
+    def _build_lookups(self):
+        """
+        Build the in-memory lookups for the queries: the symbol slices of the lots (which are sorted by symbol and
+        then by sell date), and the prefix sums of the summed columns, both per symbol and over all the symbols
+        """
+        symbols = self.LOTS[Columns.SYMBOL].to_numpy()
+        boundaries = np.flatnonzero(symbols[1:] != symbols[:-1]) + 1
+        starts, stops = np.r_[0, boundaries], np.r_[boundaries, len(symbols)]
+        self._symbol_slices = {symbols[start]: (start, stop) for start, stop in zip(starts, stops) if stop > start}
+
+        sell_dates = self.LOTS[Heb.SELL_DATE].to_numpy()
+        order = np.argsort(sell_dates, kind="stable")
+        self._sell_dates = sell_dates
+        self._all_sell_dates = sell_dates[order]
+        self._prefix_sums = {}
+        self._all_prefix_sums = {}
+        for column in self._SUM_COLUMNS:
+            values = self.LOTS[column].to_numpy(dtype=float)
+            self._prefix_sums[column] = np.r_[0.0, np.cumsum(values)]
+            self._all_prefix_sums[column] = np.r_[0.0, np.cumsum(values[order])]
+
+    @staticmethod
+    def get_file_hash(file_path: str) -> str:
+        """
+        Get the SHA-256 hash of a file's content
+        :param file_path: The file path
+        :return: The hex digest
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @classmethod
+    def _get_index_path(cls, input_file: str) -> str:
+        """
+        Get the index file path of an input file
+        :param input_file: The input file path
+        :return: The index file path
+        """
+        name = hashlib.sha256(os.path.abspath(input_file).encode("utf-8")).hexdigest()
+        return f"{cls.INDEX_FOLDER}/{name}.npz"
+
+    @staticmethod
+    def _get_open_lots(df: pd.DataFrame, is_open: np.ndarray) -> pd.DataFrame:
+        """
+        Get the lots left open at the end of the long trades. The orders are matched oldest first, so the open lots
+        are the latest buy orders of the trade: the part of each buy order beyond the trade's sold shares
+        :param df: The orders split to trades (see ColmexProOrdersToForm1325DF.split_trades)
+        :param is_open: Whether each order's trade is left open
+        :return: A DataFrame with the open orders, with the open number of shares in the Quantity column
+        """
+        is_buy = (df[Columns.SIDE] == ColmexProOrdersToForm1325DF.BUY).to_numpy()
+        shares = df[Columns.SHARES].to_numpy(dtype=np.int64)
+        trade_ids = df[Columns.TRADE_ID]
+        cumulative_bought = pd.Series(np.where(is_buy, shares, 0)).groupby(trade_ids).cumsum().to_numpy()
+        sold = pd.Series(np.where(is_buy, 0, shares)).groupby(trade_ids).transform("sum").to_numpy()
+        open_df = df[[Columns.SYMBOL, Columns.SIDE, Columns.DATETIME, Columns.PRICE]].copy()
+        open_df[Columns.QUANTITY] = np.clip(cumulative_bought - sold, 0, shares)
+        return open_df[is_open & is_buy & (open_df[Columns.QUANTITY] > 0).to_numpy()].reset_index(drop=True)
+
+    @classmethod
+    def build(cls, df: pd.DataFrame, year: int, rates: dict, input_hash: str) -> "PositionIndex":
+        """
+        Build the index from a validated Colmex Pro orders DataFrame (a trade can only be left open long)
+        :param df: The Colmex Pro orders DataFrame
+        :param year: The orders' year
+        :param rates: The rates dictionary
+        :param input_hash: The input file hash
+        :return: A PositionIndex object
+        """
+        transformer = ColmexProOrdersToForm1325DF
+        orders_df = transformer.split_trades(transformer.sort(df))
+        trade_ids = orders_df[Columns.TRADE_ID].to_numpy()
+        is_last = np.r_[trade_ids[1:] != trade_ids[:-1], True]
+        open_trades = trade_ids[is_last & (orders_df[Columns.POSITION].to_numpy() != 0)]
+        is_open = np.isin(trade_ids, open_trades)
+
+        fills = orders_df[cls._FILLS_COLUMNS + [cls.TRADE_ID]].astype({
+            Columns.SHARES: int, Columns.PRICE: float, Columns.POSITION: int, Columns.DATETIME: "datetime64[ns]"
+        })
+
+        # The matched shares of the open trades are their sold shares, so only the bought shares beyond them are open
+        lots = transformer.round_lots(transformer.match_trades(orders_df, rates))
+        lots = lots.drop(columns=Heb.BOUGHT_DURING_PRE_MARKET)
+        lots = lots.rename(columns={Heb.SYMBOL: Columns.SYMBOL})
+        for column in Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT, Heb.PROFIT, Heb.LOSS:
+            lots[column] = FixedPoint.to_float(lots[column], FixedPoint.ILS_SCALE)
+        lots[cls.PNL] = lots[Heb.PROFIT] + lots[Heb.LOSS]
+        for column in Heb.BUY_DATE, Heb.SELL_DATE:
+            lots[column] = pd.to_datetime(lots[column], format=Config.COLMEX_PRO_MTS_DATE_FORMAT)
+        lots = lots.sort_values(by=[Columns.SYMBOL, Heb.SELL_DATE], kind="stable").reset_index(drop=True)
+
+        open_lots = cls._get_open_lots(orders_df, is_open)
+
+        return cls(input_hash, year, ResultCache.get_rates_version(rates), fills, lots, open_lots)
+
+    def save(self, index_path: str):
+        """
+        Save the index to a file: the columns of the DataFrames as plain arrays, and a JSON metadata entry with the
+        hashes the index is valid for and the names and types of the columns
+        :param index_path: The index file path
+        """
+        Utilities.make_private_folder(os.path.dirname(index_path))  # Other users can't plant or read an index
+        arrays, frames = {}, {}
+        for name, frame in ("fills", self.FILLS), ("lots", self.LOTS), ("open_lots", self.OPEN_LOTS):
+            frames[name] = []
+            for i, column in enumerate(frame.columns):
+                values = frame[column].to_numpy()
+                frames[name].append([column, str(values.dtype)])
+                arrays[f"{name}_{i}"] = values.astype(str) if values.dtype == object else values
+        metadata = {
+            "version": self._VERSION, "input_hash": self.INPUT_HASH, "year": self.YEAR,
+            "rates_hash": self.RATES_HASH, "frames": frames
+        }
+        arrays["metadata"] = np.array(json.dumps(metadata))
+        temp_path = f"{index_path}.{os.getpid()}.tmp"
+        with Utilities.open_private_file(temp_path) as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, index_path)  # Replace atomically, so a concurrent reader never sees a partial index
+
+    @classmethod
+    def load(cls, index_path: str, input_hash: str = None, get_rates=None):
+        """
+        Load an index from a file
+        :param index_path: The index file path
+        :param input_hash: The expected input file hash. The index is considered stale if it doesn't match
+        :param get_rates: A function that gets the rates of a year. The index is considered stale if it was built
+        with other rates
+        :return: A PositionIndex object, or None if there is no valid index
+        """
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with np.load(index_path, allow_pickle=False) as data:
+                metadata = json.loads(str(data["metadata"]))
+                if metadata["version"] != cls._VERSION or \
+                        (input_hash is not None and metadata["input_hash"] != input_hash):
+                    return None
+                frames = {
+                    name: pd.DataFrame({column: data[f"{name}_{i}"].astype(dtype)
+                                        for i, (column, dtype) in enumerate(columns)})
+                    for name, columns in metadata["frames"].items()
+                }
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None  # A corrupt index is built again
+        if get_rates is not None and ResultCache.get_rates_version(get_rates(metadata["year"])) != \
+                metadata["rates_hash"]:
+            return None
+        return cls(metadata["input_hash"], metadata["year"], metadata["rates_hash"], frames["fills"],
+                   frames["lots"], frames["open_lots"])
+
+    @classmethod
+    def open(cls, input_file: str, rates: dict = None, revalidate_rates: bool = False) -> "PositionIndex":
+        """
+        Get the index of an input file. The saved index is used as long as the input file's hash is unchanged (and it
+        was built with the same rates, when they are checked), otherwise it is built again and saved. Opening a saved
+        index doesn't fetch the BOI rates, unless revalidate_rates is set
+        :param input_file: The Colmex Pro orders CSV or Excel file path
+        :param rates: The rates dictionary (fetched from BOI if not passed). The saved index is checked against it
+        :param revalidate_rates: Whether to check the saved index against the BOI rates (when rates isn't passed)
+        :return: A PositionIndex object
+        """
+        if rates is None:
+            def get_rates(year: int) -> dict:
+                return BankOfIsraelRates.get_rates(year, ColmexProOrdersToForm1325DF.COIN)
+        else:
+            def get_rates(year: int) -> dict:
+                return rates
+        input_hash = cls.get_file_hash(input_file)
+        index_path = cls._get_index_path(input_file)
+        index = cls.load(index_path, input_hash, get_rates if rates is not None or revalidate_rates else None)
+        if index is None:
+            df, year, year_rates = Form1325CSVGenerator(input_file, None).read_orders(get_rates)
+            index = cls.build(df, year, year_rates, input_hash)
+            index.save(index_path)
+        return index
+
+    def symbols(self) -> list:
+        """
+        :return: A list of the traded symbols
+        """
+        return list(self.FILLS[Columns.SYMBOL].unique())
+
+    def fills(self, symbol: str) -> pd.DataFrame:
+        """
+        :param symbol: The symbol
+        :return: The symbol's sorted fills, with the cumulative Position and the trade IDs
+        """
+        return self.FILLS[self.FILLS[Columns.SYMBOL] == symbol]
+
+    def open_lots(self, symbol: str = None) -> pd.DataFrame:
+        """
+        :param symbol: The symbol (all symbols if not passed)
+        :return: The open lots
+        """
+        if symbol is None:
+            return self.OPEN_LOTS
+        return self.OPEN_LOTS[self.OPEN_LOTS[Columns.SYMBOL] == symbol]
+
+    def totals(self, symbol: str = None, start=None, end=None) -> dict:
+        """
+        Get the totals of the lots sold in a date range
+        :param symbol: The symbol (all symbols if not passed)
+        :param start: The first sell date (inclusive, no limit if not passed)
+        :param end: The last sell date (inclusive, no limit if not passed)
+        :return: A dictionary with the realized P&L, the total profit, the total loss and the total sales
+        """
+        if symbol is None:
+            dates, prefix_sums, offset = self._all_sell_dates, self._all_prefix_sums, 0
+        else:
+            first, last = self._symbol_slices.get(symbol, (0, 0))
+            dates, prefix_sums, offset = self._sell_dates[first:last], self._prefix_sums, first
+
+        i = 0 if start is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start)), side="left")
+        j = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end)), side="right")
+        return {column: float(prefix_sums[column][offset + j] - prefix_sums[column][offset + i])
+                for column in self._SUM_COLUMNS}
+
+    def realized_pnl(self, symbol: str = None, start=None, end=None) -> float:
+        """
+        Get the realized profit or loss of the lots sold in a date range
+        :param symbol: The symbol (all symbols if not passed)
+        :param start: The first sell date (inclusive, no limit if not passed)
+        :param end: The last sell date (inclusive, no limit if not passed)
+        :return: The realized profit (positive) or loss (negative)
+        """
+        return self.totals(symbol, start, end)[self.PNL]
+
+    def summary(self, symbol: str = None, start=None, end=None) -> pd.DataFrame:
+        """
+        Get the totals of the lots sold in a date range, per symbol and in total
+        :param symbol: The symbol (all symbols if not passed)
+        :param start: The first sell date (inclusive, no limit if not passed)
+        :param end: The last sell date (inclusive, no limit if not passed)
+        :return: A DataFrame with the totals (see totals) of each symbol, and a Total row for all the symbols
+        """
+        symbols = sorted(self.symbols()) if symbol is None else [symbol]
+        rows = [self.totals(s, start, end) for s in symbols]
+        if symbol is None:
+            symbols.append(self.TOTAL)
+            rows.append(self.totals(None, start, end))
+        return pd.DataFrame(rows, index=pd.Index(symbols, name=Columns.SYMBOL)).round(2)
@@ -0,0 +1,117 @@
+import sys
+import threading
+import time
+from typing import Callable
+
+
+class Cancelled(Exception):
+    """
+    Raised by a run that was cancelled with its CancellationToken
+    """
+    def __init__(self):
+        super().__init__("The run was cancelled")
+
+
+class CancellationToken:
+    """
+    A thread-safe flag for cancelling a run cleanly. The run is not interrupted: Its long loops check the token
+    between steps (the matching loop between symbols, the PDF rendering and the accounts' worker pool while they
+    wait), and stop by raising Cancelled.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """
+        Cancel the run. Can be called from any thread (or a signal handler)
+        """
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        """
+        Raise Cancelled if the run was cancelled
+        """
+        if self._event.is_set():
+            raise Cancelled()
+
+
+class Progress:
+    """
+    Report the progress of a run's stages to a callback, and check the run's cancellation token on every report.
+    The callback gets the stage, the number of items done and the total number of items (None if unknown).
+    """
+    PARSE = "parse"  # Orders rows parsed
+    MATCH = "match"  # Symbols matched
+    RENDER = "render"  # PDF pages rendered
+    ACCOUNTS = "accounts"  # Accounts generated (with by_account)
+
+    CHECK_INTERVAL = 0.2  # Seconds between the checks of the token while waiting for a child process
+
+    def __init__(self, callback: Callable[[str, int, int], None] = None, token: CancellationToken = None):
+        self.CALLBACK = callback
+        self.TOKEN = token
+
+    def update(self, stage: str, done: int, total: int = None):
+        """
+        Report the progress of a stage, and then check the cancellation token
+        :param stage: The stage
+        :param done: The number of items done
+        :param total: The total number of items (None if unknown)
+        """
+        if self.CALLBACK is not None:
+            self.CALLBACK(stage, done, total)
+        self.check()
+
+    def check(self):
+        """
+        Raise Cancelled if the run was cancelled
+        """
+        if self.TOKEN is not None:
+            self.TOKEN.check()
+
+
+class ProgressBar:
+    """
+    A progress callback that draws a text progress bar of the current stage. It's drawn only on a terminal, and at
+    most every INTERVAL seconds, so frequent reports don't slow the run down.
+    """
+    WIDTH = 30
+    INTERVAL = 0.1  # Seconds
+
+    def __init__(self, stream=None):
+        self.STREAM = stream or sys.stderr
+        self._stage = None
+        self._drawn_at = 0.0
+
+    def __call__(self, stage: str, done: int, total: int = None):
+        if not self.STREAM.isatty():
+            return
+        now = time.monotonic()
+        finished = total is not None and done >= total
+        if stage == self._stage and not finished and now - self._drawn_at < self.INTERVAL:
+            return
+        if self._stage is not None and stage != self._stage:
+            self.STREAM.write("\n")  # Keep the previous stage's last bar
+        self._stage, self._drawn_at = stage, now
+        if total:
+            filled = self.WIDTH * min(done, total) // total
+            bar = f"[{'#' * filled}{'-' * (self.WIDTH - filled)}] {100 * min(done, total) // total:3d}% " \
+                  f"({done:,}/{total:,})"
+        else:
+            bar = f"{done:,}"
+        self.STREAM.write(f"\r{stage:<8} {bar}")
+        self.STREAM.flush()
+
+    def close(self):
+        """
+        End the bar's line
+        """
+        if self._stage is not None:
+            self.STREAM.write("\n")
+            self.STREAM.flush()
+            self._stage = None
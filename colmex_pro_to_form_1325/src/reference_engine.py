@@ -0,0 +1,362 @@
+import math
+from itertools import groupby
+from typing import Iterable
+
+import pandas as pd
+
+from config import Config
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from fixed_point import FixedPoint
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+from form_1325_totals import Form1325Totals
+from logger import logger
+from matched_lots_store import MatchedLotsStore
+from progress import Progress
+
+
+class ReferenceEngine:
+    """
+    The original form 1325 engine, frozen as the reference: The float matching (iterrows over the sell orders, the
+    oldest buy order first) and the PDF number formatting (parse_df), as they were before any optimization. This class
+    must NOT be optimized or changed: It's run with --reference_engine, and the EngineVerifier compares the engine
+    against it, after applying the engine's rounding rule (see _to_agorot). The aggregation, the totals, the store and
+    the progress are only wrapped around the frozen matching, so the reference can run wherever the engine runs
+    """
+    COIN = "USD"
+    BUY = "B"
+    SELL = "S"
+    FEES = [
+        Columns.COMMISSION, Columns.SEC_FEE, Columns.TAF_FEE, Columns.ECN_FEE, Columns.ROUTING_FEE, Columns.NSCC_FEE
+    ]
+
+    @classmethod
+    def get_shares(cls, row) -> int:
+        """
+        Get the number of shares considering the side
+        :param row: The row
+        :return: The number of shares - positive for sell orders, negative for buy orders
+        """
+        if row[Columns.SIDE] == cls.SELL:
+            return int(row[Columns.SHARES])
+        else:
+            return -1 * int(row[Columns.SHARES])
+
+    @staticmethod
+    def _symbol_df_to_trade_dfs(df: pd.DataFrame) -> list[pd.DataFrame]:
+        """
+        Split the symbol DataFrame to trade DataFrames
+        :param df: A DataFrame for a certain symbol
+        :return: A list of DataFrames, split to trade DataFrames based on the Position column
+        """
+        dfs = []
+        temp_df = pd.DataFrame(columns=df.columns)  # Create an empty temp DataFrame
+
+        for index, row in df.iterrows():
+            temp_df = pd.concat([temp_df, row.to_frame().T], ignore_index=True)  # Add the current row to temp_df
+            if row[Columns.POSITION] == 0:  # If the Position value is 0, it means the trade is closed
+                dfs.append(temp_df.copy())  # Save the trade df to dfs
+                temp_df = pd.DataFrame(columns=df.columns)  # Reset the temp DataFrame
+
+        # Append remaining rows if last Position != 0
+        if not temp_df.empty:
+            dfs.append(temp_df)
+
+        return dfs
+
+    @classmethod
+    def _get_trade_dfs(cls, df: pd.DataFrame) -> list[pd.DataFrame]:
+        """
+        Split the DataFrame to symbol DataFrames, and then to trade DataFrames
+        :param df: The DataFrame
+        :return: A list of trade DataFrames
+        """
+        symbol_dfs = df.groupby([Columns.SYMBOL], sort=False)  # Split to DataFrames based on the symbol
+        trade_dfs = []
+        for key, symbol_df in symbol_dfs:
+            symbol_df[Columns.POSITION] = symbol_df.apply(cls.get_shares, axis=1).cumsum()  # Update Position column
+            trade_dfs.extend(cls._symbol_df_to_trade_dfs(symbol_df))  # Save the symbol's trade dfs to a list
+        return trade_dfs
+
+    @classmethod
+    def _trade_df_to_form1325_rows(cls, df: pd.DataFrame, rates: dict) -> list[dict]:
+        """
+        Transform the trade DataFrame to a list of rows in form 1325 format
+        :param df: The trade DataFrame
+        :param rates: The rates dictionary
+        :return: A list of form 1325 dictionary rows
+        """
+        results = []
+
+        # Calculate total commissions and fees
+        commissions_and_fees = df[Columns.COMMISSION].astype(float) + df[Columns.SEC_FEE].astype(float) + \
+            df[Columns.TAF_FEE].astype(float) + df[Columns.ECN_FEE].astype(float) + \
+            df[Columns.ROUTING_FEE].astype(float) + df[Columns.NSCC_FEE].astype(float)
+
+        # Create a copy of the Shares column, for changing the value during iteration & also keeping the original number
+        df[Columns.SHARES] = df[Columns.SHARES].astype(int)
+        df[Columns.QUANTITY] = df[Columns.SHARES]
+
+        # Separate Buy and Sell transactions
+        buys = df[df[Columns.SIDE] == cls.BUY].copy()
+        sells = df[df[Columns.SIDE] == cls.SELL].copy()
+
+        # Calculate amount including commissions
+        buys[Columns.AMOUNT] = buys[Columns.QUANTITY] * buys[Columns.PRICE].astype(float) + commissions_and_fees
+        sells[Columns.AMOUNT] = sells[Columns.QUANTITY] * sells[Columns.PRICE].astype(float) - commissions_and_fees
+
+        # Iterate over sell orders
+        for sell_index, sell in sells.iterrows():
+            shares_to_sell = sell[Columns.QUANTITY]
+
+            # Iterate over buy orders
+            while shares_to_sell > 0:
+                buy = buys[buys[Columns.QUANTITY] > 0].iloc[0]  # Find the oldest relevant buy order
+                buy_index = buy.name
+                buy_rate = rates.get(buy[Columns.DATETIME].strftime(Config.DATE_FORMAT), 0)
+                sell_rate = rates.get(sell[Columns.DATETIME].strftime(Config.DATE_FORMAT), 0)
+
+                # Determine the shares and price for this transaction
+                if buy[Columns.QUANTITY] <= shares_to_sell:  # There are more or same amount of shares bought as to sell
+                    shares_sold = buy[Columns.QUANTITY]
+                    shares_to_sell -= buy[Columns.QUANTITY]
+                    buys.at[buy_index, Columns.QUANTITY] = 0  # All of this buy order is used up
+                else:  # There are more buy shares than sell shares, meaning the sell order is complete
+                    shares_sold = shares_to_sell
+                    buys.at[buy_index, Columns.QUANTITY] -= shares_to_sell
+                    shares_to_sell = 0  #
+
+                rate_change = 1 + ((sell_rate - buy_rate) / buy_rate)  # Calculate the currency rate change
+                # Calculate the amounts, the profit and the loss
+                amount_sell = sell[Columns.AMOUNT] * (shares_sold / sell[Columns.SHARES]) * sell_rate
+                amount_buy = buy[Columns.AMOUNT] * (shares_sold / buy[Columns.SHARES]) * buy_rate
+                amount_buy_adjusted = amount_buy * rate_change
+                profit_loss = cls._get_profit_loss(amount_buy, amount_buy_adjusted, amount_sell)
+
+                # Create a dictionary row in form 1325 format. Use Hebrew column headers
+                row = {
+                    Heb.SYMBOL: sell[Columns.SYMBOL],
+                    Heb.BOUGHT_DURING_PRE_MARKET: "",
+                    Heb.SHARES: shares_sold,
+                    Heb.BUY_DATE: buy[Columns.TRADE_DATE],
+                    Heb.BUY_AMOUNT: amount_buy,
+                    Heb.RATE_CHANGE: rate_change,
+                    Heb.BUY_AMOUNT_ADJUSTED: amount_buy_adjusted,
+                    Heb.SELL_DATE: sell[Columns.TRADE_DATE],
+                    Heb.SELL_AMOUNT: amount_sell,
+                    Heb.PROFIT: "" if profit_loss <= 0 else profit_loss,
+                    Heb.LOSS: "" if profit_loss >= 0 else profit_loss,
+                }
+                results.append(row)
+        return results
+
+    @staticmethod
+    def _get_profit_loss(amount_buy: float, amount_buy_adjusted: float, amount_sell: float) -> float:
+        """
+        The profit and loss can be calculated based on the buy amount and also based on the adjusted buy amount, so
+        according to Israeli law, the calculation should be the value closer to 0 (positive or negative) between both
+        of the options. If one of them is positive and one is negative, there is 0 profit and 0 loss
+        :param amount_buy: The amount bought
+        :param amount_buy_adjusted: The amount bought, adjusted by the rate change
+        :param amount_sell: The amount sold
+        :return: A float representing the profit or loss
+        """
+        if math.copysign(1, amount_sell - amount_buy_adjusted) != math.copysign(1, amount_sell - amount_buy):
+            return 0
+        sign = math.copysign(1, amount_sell - amount_buy_adjusted)
+        return sign * min(abs(amount_sell - amount_buy_adjusted), abs(amount_sell - amount_buy))
+
+    @classmethod
+    def _aggregate_rows(cls, rows: list[dict]) -> list[dict]:
+        """
+        Combine the matched lots with the same symbol, buy date and sell date into one row. The shares and the amounts
+        are summed, and the profit or loss is calculated again from the summed amounts
+        :param rows: A list of form 1325 dictionary rows
+        :return: A list of the aggregated rows, in the order of their first matched lot
+        """
+        aggregated_rows = {}
+        for row in rows:
+            key = (row[Heb.SYMBOL], row[Heb.BUY_DATE], row[Heb.SELL_DATE])
+            aggregated_row = aggregated_rows.get(key)
+            if aggregated_row is None:
+                aggregated_rows[key] = dict(row)  # The rate change is the same for the same buy and sell dates
+                continue
+            for column in Heb.SHARES, Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT:
+                aggregated_row[column] += row[column]
+
+        for row in aggregated_rows.values():
+            profit_loss = cls._get_profit_loss(row[Heb.BUY_AMOUNT], row[Heb.BUY_AMOUNT_ADJUSTED], row[Heb.SELL_AMOUNT])
+            row[Heb.PROFIT] = "" if profit_loss <= 0 else profit_loss
+            row[Heb.LOSS] = "" if profit_loss >= 0 else profit_loss
+        return list(aggregated_rows.values())
+
+    @classmethod
+    def _to_agorot(cls, rows: list[dict]) -> list[dict]:
+        """
+        Convert the ILS amounts of form 1325 rows to agorot, for the totals and the store (which count in agorot), with
+        the engine's rounding rule: The amounts are rounded to the agora (half away from zero), and the profit or loss
+        is calculated again from the rounded amounts
+        :param rows: A list of form 1325 dictionary rows
+        :return: A list of the rows, with the amounts in integer agorot
+        """
+        agorot_rows = []
+        for row in rows:
+            amounts = {column: int(FixedPoint.round_half_away(row[column], FixedPoint.ILS_SCALE))
+                       for column in (Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT)}
+            profit_loss = int(cls._get_profit_loss(*amounts.values()))
+            agorot_rows.append({
+                **row, **amounts,
+                Heb.PROFIT: "" if profit_loss <= 0 else profit_loss, Heb.LOSS: "" if profit_loss >= 0 else profit_loss
+            })
+        return agorot_rows
+
+    @classmethod
+    def transform(
+            cls, df: pd.DataFrame, rates: dict, store: MatchedLotsStore = None, totals: Form1325Totals = None,
+            aggregate: bool = False, progress: Progress = None
+    ) -> pd.DataFrame:
+        """
+        Transform the Colmex Pro orders DataFrame to form 1325 DataFrame
+        :param df: The Colmex Pro orders DataFrame
+        :param rates: The rates dictionary
+        :param store: A matched lots store. If passed, the rows are written to the store as they are matched, instead
+        of being collected into a DataFrame
+        :param totals: Running totals to add the rows to as they are matched
+        :param aggregate: Whether to combine the matched lots with the same symbol, buy date and sell date into one row
+        :param progress: Reports the matched symbols, and stops the matching when the run is cancelled
+        :return: A DataFrame with rows in form 1325 format, or None when the rows are written to the store
+        """
+        # Create a DateTime column and sort by it, then by symbol and then by price
+        fmt = f"{Config.COLMEX_PRO_MTS_DATE_FORMAT} {Config.TIME_FORMAT}"
+        df[Columns.DATETIME] = pd.to_datetime(df[Columns.TRADE_DATE] + " " + df[Columns.EXEC_TIME], format=fmt)
+        df = df.sort_values(by=[Columns.DATETIME, Columns.SYMBOL, Columns.PRICE])
+
+        symbols = df[Columns.SYMBOL].nunique() if progress is not None else None
+        return cls.transform_sorted([df], rates, store, totals, aggregate, progress, symbols)
+
+    @classmethod
+    def transform_sorted(
+            cls, dfs: Iterable[pd.DataFrame], rates: dict, store: MatchedLotsStore = None,
+            totals: Form1325Totals = None, aggregate: bool = False, progress: Progress = None, symbols: int = None
+    ) -> pd.DataFrame:
+        """
+        Transform sorted Colmex Pro orders DataFrames to form 1325 DataFrame. All the orders of a symbol must be in
+        the same DataFrame, so the DataFrames can be streamed one symbol at a time (see ExternalSort)
+        :param dfs: An iterable of sorted Colmex Pro orders DataFrames, with a DateTime column
+        :param rates: The rates dictionary
+        :param store: A matched lots store. If passed, the rows are written to the store as they are matched, instead
+        of being collected into a DataFrame
+        :param totals: Running totals to add the rows to as they are matched
+        :param aggregate: Whether to combine the matched lots with the same symbol, buy date and sell date into one row
+        :param progress: Reports the matched symbols, and stops the matching when the run is cancelled
+        :param symbols: The number of symbols, for the progress (None if unknown)
+        :return: A DataFrame with rows in form 1325 format, or None when the rows are written to the store
+        """
+        trade_dfs = (trade_df for df in dfs for trade_df in cls._get_trade_dfs(df))  # Get the trade DataFrames
+        form1325_rows = []
+        matched_lots = output_rows = matched_symbols = 0
+        # The trades of a symbol are consecutive, so the rows are aggregated one symbol at a time
+        for symbol, symbol_trade_dfs in groupby(trade_dfs, key=lambda trade_df: trade_df[Columns.SYMBOL].iloc[0]):
+            symbol_1325_rows = [
+                row for trade_df in symbol_trade_dfs for row in cls._trade_df_to_form1325_rows(trade_df, rates)
+            ]  # Get the form 1325 rows
+            matched_lots += len(symbol_1325_rows)
+            if aggregate:
+                symbol_1325_rows = cls._aggregate_rows(symbol_1325_rows)
+            output_rows += len(symbol_1325_rows)
+            if totals is not None:
+                totals.add(cls._to_agorot(symbol_1325_rows))
+            if store is not None:
+                store.append(cls._to_agorot(symbol_1325_rows))
+            else:
+                form1325_rows.extend(symbol_1325_rows)
+            matched_symbols += 1
+            if progress is not None:
+                progress.update(Progress.MATCH, matched_symbols, symbols)
+
+        if aggregate:
+            reduction = 100 * (1 - output_rows / matched_lots) if matched_lots else 0
+            logger.info(f"Aggregated {matched_lots} matched lots into {output_rows} rows ({reduction:.1f}% fewer rows)")
+
+        if store is not None:
+            store.close()
+            return None
+
+        transformed_df = pd.DataFrame(form1325_rows)
+
+        # Add a Row Number column and move it to the beginning
+        transformed_df[Columns.ROW_NUMBER] = transformed_df.reset_index().index + 1
+        transformed_df.insert(0, Columns.ROW_NUMBER, transformed_df.pop(Columns.ROW_NUMBER))
+
+        # Reformat date columns
+        for column in Heb.BUY_DATE, Heb.SELL_DATE:
+            transformed_df[column] = pd.to_datetime(transformed_df[column]).\
+                dt.strftime(Config.COLMEX_PRO_LOG_DATE_FORMAT)
+
+        return transformed_df
+
+    @classmethod
+    def run(
+            cls, df: pd.DataFrame, year: int, store: MatchedLotsStore = None, totals: Form1325Totals = None,
+            rates: dict = None, aggregate: bool = False, progress: Progress = None
+    ) -> pd.DataFrame:
+        """
+        Get a form 1325 rows DataFrame from a csv with Colmex Pro orders data
+        :return: A DataFrame with the form 1325 rows data (None when the rows are written to the store)
+        """
+        if rates is None:
+            rates = BankOfIsraelRates.get_rates(year, cls.COIN)  # Get the currency rates
+        transformed_df = cls.transform(df, rates, store, totals, aggregate, progress)
+        return transformed_df
+
+    @staticmethod
+    def round_number(num: float, decimals: int) -> float:
+        """
+        Round a float based on the number of decimals
+        :param num: The number to round
+        :param decimals: The number of decimals
+        :return: The rounded number - int if decimals is 0, float otherwise
+        """
+        if isinstance(num, float):
+            num = round(num, decimals)
+            if decimals == 0:
+                num = int(num)
+        return num
+
+    @staticmethod
+    def _add_thousands_separator(num: float) -> str:
+        """
+        Get a string representing a number with thousands separator
+        :param num: The number
+        :return: The number as a string with thousands separator
+        """
+        return "" if num == "" else f"{num:,}"
+
+    @classmethod
+    def parse_df(cls, df: pd.DataFrame, sub_header: bool = True) -> pd.DataFrame:
+        """
+        Parse the DataFrame columns for a good-looking PDF representation
+        :param df: The DataFrame
+        :param sub_header: Whether to add the sub-header row (the store's rows are parsed in chunks)
+        :return: The parsed DataFrame
+        """
+        # Round some float column values
+        columns_to_round = {
+            0: [Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT, Heb.PROFIT, Heb.LOSS],
+            2: [Heb.RATE_CHANGE]
+        }
+        for num_decimals, columns in columns_to_round.items():
+            for column in columns:
+                df[column] = df[column].apply(lambda x: cls.round_number(x, num_decimals))
+
+        # Add thousands separators
+        for column in Heb.ROW_NUMBER, Heb.SHARES, Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT, \
+                Heb.PROFIT, Heb.LOSS:
+            df[column] = df[column].apply(cls._add_thousands_separator)
+
+        # Add sub-header as 1st row
+        if sub_header:
+            sub_header = {col: Heb.SUB_HEADER[i] for i, col in enumerate(df.columns)}
+            df = pd.concat([df.iloc[:0], pd.DataFrame([sub_header]), df.iloc[0:]]).reset_index(drop=True)
+
+        return df
@@ -0,0 +1,148 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import pandas as pd
+
+from logger import logger
+from utilities import Utilities
+
+
+class ResultCache:
+    """
+    A content-addressed cache of generated output files. An entry is keyed by a hash of the orders, the generator
+    options, the rates table and the tool's own source, so a regeneration with nothing changed copies the stored
+    files into place instead of transforming and rendering again. The least recently used entries are evicted when
+    the cache grows beyond its maximum size.
+    The outputs hold the taxpayer's details and P&L, so the cache is a private per-user folder (0o700, with 0o600
+    files), and a folder owned by another user is never used.
+    """
+    CACHE_FOLDER = os.path.join(Utilities.USER_CACHE_FOLDER, "results")
+    MAX_SIZE = 1 << 30  # 1 GiB
+
+    _tool_version = None
+
+    def __init__(self, cache_dir: str = None, max_size: int = None):
+        self.CACHE_DIR = cache_dir or self.CACHE_FOLDER
+        self.MAX_SIZE = max_size or self.MAX_SIZE
+
+    @classmethod
+    def get_tool_version(cls) -> str:
+        """
+        Get the tool version: a hash of the source files and of the resources used for rendering, so any change to
+        the code invalidates the cached outputs
+        :return: The hex digest
+        """
+        if cls._tool_version is None:
+            package_dir = os.path.dirname(os.path.dirname(__file__))
+            sha256 = hashlib.sha256()
+            for file_path in sorted(glob.glob(f"{package_dir}/src/*.py") + glob.glob(f"{package_dir}/resources/*")):
+                sha256.update(os.path.basename(file_path).encode("utf-8"))
+                with open(file_path, "rb") as f:
+                    sha256.update(f.read())
+            cls._tool_version = sha256.hexdigest()
+        return cls._tool_version
+
+    @staticmethod
+    def get_rates_version(rates: dict) -> str:
+        """
+        :param rates: The rates dictionary
+        :return: A hash of the rates table
+        """
+        return hashlib.sha256(json.dumps(rates, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_df_hash(df: pd.DataFrame) -> str:
+        """
+        :param df: The Colmex Pro orders DataFrame
+        :return: A hash of the DataFrame's content, including the index (the input file line of each order)
+        """
+        sha256 = hashlib.sha256(",".join(map(str, df.columns)).encode("utf-8"))
+        sha256.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        return sha256.hexdigest()
+
+    @classmethod
+    def get_key(cls, df: pd.DataFrame, options: dict, rates: dict) -> str:
+        """
+        Get the cache key of a generation
+        :param df: The Colmex Pro orders DataFrame
+        :param options: The generator options that affect the output
+        :param rates: The rates dictionary
+        :return: The cache key
+        """
+        key = {
+            "input": cls.get_df_hash(df), "options": options,
+            "rates": cls.get_rates_version(rates), "tool": cls.get_tool_version(),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _get_entry_path(self, key: str) -> str:
+        return f"{self.CACHE_DIR}/{key}"
+
+    def restore(self, key: str, files: dict) -> bool:
+        """
+        Copy the cached files of a key into place
+        :param key: The cache key
+        :param files: A dictionary with {name: destination path} format
+        :return: True if the key was found and the files were restored, False otherwise
+        """
+        entry_path = self._get_entry_path(key)
+        if not all(os.path.exists(f"{entry_path}/{name}") for name in files):
+            return False
+        Utilities.make_private_folder(self.CACHE_DIR)  # Never restore entries planted by another user
+        try:
+            for name, file_path in files.items():
+                shutil.copyfile(f"{entry_path}/{name}", file_path)
+            os.utime(entry_path)  # Mark the entry as recently used
+        except FileNotFoundError:  # Evicted meanwhile
+            return False
+        return True
+
+    def store(self, key: str, files: dict):
+        """
+        Store the generated files of a key, and evict the least recently used entries if the cache is too big
+        :param key: The cache key
+        :param files: A dictionary with {name: generated file path} format
+        """
+        entry_path = self._get_entry_path(key)
+        temp_path = f"{Utilities.make_private_folder(self.CACHE_DIR)}/.{uuid.uuid4()}.tmp"
+        os.mkdir(temp_path, mode=0o700)
+        for name, file_path in files.items():
+            with open(file_path, "rb") as source, Utilities.open_private_file(f"{temp_path}/{name}") as destination:
+                shutil.copyfileobj(source, destination)
+        try:
+            os.rename(temp_path, entry_path)  # Rename atomically, so a concurrent reader never sees a partial entry
+        except OSError:  # Stored meanwhile by a concurrent run
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self.evict()
+
+    @staticmethod
+    def _get_dir_size(dir_path: str) -> int:
+        size = 0
+        for entry in os.scandir(dir_path):
+            size += entry.stat().st_size
+        return size
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache size is within the maximum size
+        """
+        entries = []
+        for entry in os.scandir(self.CACHE_DIR):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, self._get_dir_size(entry.path), entry.path))
+            except FileNotFoundError:  # Evicted meanwhile
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.MAX_SIZE:
+                break
+            logger.debug(f"Evicting cache entry: {entry_path}")
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
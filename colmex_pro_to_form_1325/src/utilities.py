@@ -1,7 +1,16 @@
 import os.path
+import stat
+
+PACKAGE_NAME = os.path.basename(os.path.dirname(os.path.dirname(__file__)))
 
 
 class Utilities:
+    # Per-user folders (XDG base directories), for the files that must not be shared with other local users
+    USER_CACHE_FOLDER = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), PACKAGE_NAME)
+    USER_STATE_FOLDER = os.path.join(
+        os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), PACKAGE_NAME
+    )
+
     @staticmethod
     def get_file_extension(file_path: str):
         extension = os.path.splitext(file_path)
@@ -12,3 +21,31 @@ class Utilities:
     @staticmethod
     def file_exists(file_path):
         return os.path.exists(file_path)
+
+    @staticmethod
+    def make_private_folder(folder: str) -> str:
+        """
+        Create a folder that only the current user can access (0o700). An existing folder is used only if it's a real
+        folder (not a symlink) owned by the current user, so other users can't read its files or plant their own
+        :param folder: The folder path
+        :return: The folder path
+        """
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        folder_stat = os.lstat(folder)
+        if not stat.S_ISDIR(folder_stat.st_mode) or folder_stat.st_uid != os.geteuid():
+            raise Exception(f"Refusing to use the folder {folder}: It's not a folder owned by the current user")
+        if stat.S_IMODE(folder_stat.st_mode) != 0o700:
+            os.chmod(folder, 0o700)
+        return folder
+
+    @staticmethod
+    def open_private_file(file_path: str, mode: str = "wb"):
+        """
+        Create (or truncate) a file that only the current user can read and write (0o600)
+        :param file_path: The file path
+        :param mode: The open mode ("wb" or "w")
+        :return: A file object
+        """
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # An existing file keeps its mode otherwise
+        return os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8"}))
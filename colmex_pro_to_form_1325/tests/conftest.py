@@ -0,0 +1,46 @@
+from datetime import date, timedelta
+
+import pytest
+from colmex_pro_to_form_1325.src.__main__ import Main  # noqa: F401 (sets up the src imports)
+from bank_of_israel_rates import BankOfIsraelRates
+
+HEADER = """Account,Trade Date,Currency,Account Type,Side,Symbol,Shares,Price,Exec Time,Commission,SEC Fee,TAF Fee,\
+ECN Fee,Routing Fee,NSCC Fee,Clr Type,Clr Broker,Note
+"""
+
+# Sample orders: A short trade (MARA), a sell matched with two buys (BTU), and two buys matched with a sell on another
+# date (TSLA)
+CONTENT = HEADER + """COLH95300,04/17/2023,USD,2,S,MARA,400,11.1518,9:42:42,0,0,0,0,0,0,Stoc,Stocks2,
+COLH95300,04/17/2023,USD,2,B,MARA,400,11.3687,10:11:03,0,0,0,0,0,0,Stoc,Stocks2,
+COLH95300,04/17/2023,USD,2,S,BTU,400,26.7823,10:29:52,1.5,0.01,0,0,0,0,Stoc,Stocks1,
+COLH95300,04/17/2023,USD,2,B,BTU,300,26.5265,10:38:42,1,0,0.02,0,0,0,Stoc,Stocks1,
+COLH95300,04/17/2023,USD,2,B,BTU,100,26.4888,10:46:01,0,0,0,0,0,0,Stoc,Stocks1,
+COLH95300,05/02/2023,USD,2,B,TSLA,10,160.25,10:00:00,0,0,0,0,0,0,Stoc,Stocks1,
+COLH95300,05/03/2023,USD,2,B,TSLA,15,161.5,10:00:00,0,0,0,0,0,0,Stoc,Stocks1,
+COLH95300,06/05/2023,USD,2,S,TSLA,25,150.75,15:30:00,0.5,0,0,0,0,0,Stoc,Stocks1,"""
+
+
+@pytest.fixture()
+def header():
+    return HEADER
+
+
+@pytest.fixture()
+def content():
+    return CONTENT
+
+
+@pytest.fixture()
+def input_csv(tmpdir, content):
+    input_file = tmpdir.join("input.csv")
+    input_file.write(content)
+    return str(input_file)
+
+
+@pytest.fixture()
+def rates(monkeypatch):
+    # A rate for every day of 2023 (and the last days of 2022), used instead of the BOI rates
+    start = date(2022, 12, 29)
+    rates = {(start + timedelta(days=i)).isoformat(): 3.6 + i * 0.001 for i in range(368)}
+    monkeypatch.setattr(BankOfIsraelRates, "get_rates", classmethod(lambda cls, year, symbol: dict(rates)))
+    return rates
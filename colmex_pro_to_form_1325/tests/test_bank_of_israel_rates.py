@@ -0,0 +1,100 @@
+import gzip
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from bank_of_israel_rates import BankOfIsraelRates
+
+SERIES = """Time Period,RER_USD_ILS:D:USD:ILS:ILS:OF00
+2023-04-13,3.652
+2023-04-14,3.661
+2023-04-17,3.648
+"""
+ETAG = '"rer-usd-ils-2023"'
+
+
+class _SDMXHandler(BaseHTTPRequestHandler):
+    requests_log = []
+    status = 200
+
+    def do_GET(self):
+        self.requests_log.append(dict(self.headers))
+        if self.status != 200:
+            self.send_response(self.status)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+
+        body = SERIES.encode("utf-8")
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.send_header("ETag", ETAG)
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sdmx_server(monkeypatch, tmpdir):
+    _SDMXHandler.requests_log = []
+    _SDMXHandler.status = 200
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SDMXHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(BankOfIsraelRates, "_BASE_URL", f"http://127.0.0.1:{server.server_port}/")
+    monkeypatch.setattr(BankOfIsraelRates, "_cache", {})
+    monkeypatch.setattr(BankOfIsraelRates, "_session", None)
+    monkeypatch.setattr(BankOfIsraelRates, "CACHE_FOLDER", str(tmpdir.join("rates")))
+    yield _SDMXHandler.requests_log
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_rates_fills_missing_dates(sdmx_server):
+    rates = BankOfIsraelRates.get_rates(2023, "USD")
+
+    assert rates["2023-04-14"] == 3.661
+    assert rates["2023-04-15"] == rates["2023-04-16"] == 3.661  # Weekend takes the previous trading day's rate
+    assert rates["2023-04-17"] == 3.648
+    assert rates["2023-01-01"] == 0.0  # No earlier rate in the series
+    assert "gzip" in sdmx_server[0]["Accept-Encoding"]
+
+
+def test_get_rates_conditional_request(sdmx_server):
+    first = BankOfIsraelRates.get_rates(2023, "USD")
+    second = BankOfIsraelRates.get_rates(2023, "USD")
+
+    assert first == second
+    assert len(sdmx_server) == 2
+    assert "If-None-Match" not in sdmx_server[0]
+    assert sdmx_server[1]["If-None-Match"] == ETAG
+
+
+def test_get_rates_cached_on_disk(sdmx_server, monkeypatch):
+    first = BankOfIsraelRates.get_rates(2023, "USD")
+    monkeypatch.setattr(BankOfIsraelRates, "_cache", {})  # A new run
+    second = BankOfIsraelRates.get_rates(2023, "USD")
+
+    assert first == second
+    assert sdmx_server[1]["If-None-Match"] == ETAG  # Answered with 304 Not Modified, from the cache file
+    assert os.stat(BankOfIsraelRates.CACHE_FOLDER).st_mode & 0o777 == 0o700
+    assert [os.stat(entry.path).st_mode & 0o777 for entry in os.scandir(BankOfIsraelRates.CACHE_FOLDER)] == [0o600]
+
+
+def test_get_rates_failed_request(sdmx_server):
+    _SDMXHandler.status = 503
+    with pytest.raises(Exception, match="HTTP status 503"):
+        BankOfIsraelRates.get_rates(2023, "USD")
@@ -0,0 +1,57 @@
+from io import StringIO
+
+import pandas as pd
+import pytest
+from colmex_pro_orders_merger import ColmexProOrdersMerger
+
+HEADER = "Account,Trade Date,Currency,Account Type,Side,Symbol,Shares,Price,Exec Time,Commission,SEC Fee,TAF Fee,\
+ECN Fee,Routing Fee,NSCC Fee,Clr Type,Clr Broker,Note"
+ROWS = [
+    "COLH95300,04/17/2023,USD,2,B,BTU,100,26.4888,10:46:01,0,0,0,0,0,0,Stoc,Stocks1,",
+    "COLH95300,04/17/2023,USD,2,B,BTU,100,26.4888,10:46:01,0,0,0,0,0,0,Stoc,Stocks1,",  # A second identical fill
+    "COLH95300,04/18/2023,USD,2,S,BTU,200,26.7823,9:29:52,1.5,0.01,0,0,0,0,Stoc,Stocks1,",
+    "COLH95300,05/02/2023,USD,2,B,TSLA,10,160.25,10:00:00,0,0,0,0,0,0,Stoc,Stocks1,",
+    "COLH95300,06/05/2023,USD,2,S,TSLA,10,150.75,15:30:00,0.5,0,0,0,0,0,Stoc,Stocks1,",
+]
+
+
+def read_rows(rows: list) -> pd.DataFrame:
+    return pd.read_csv(StringIO("\n".join([HEADER, *rows])), index_col=False)
+
+
+def test_merge_overlapping_exports(caplog):
+    dfs = [read_rows(ROWS[3:]), read_rows(ROWS[:4])]  # Overlapping on 05/02, and not in order
+    merged_df = ColmexProOrdersMerger.merge(dfs, ["b.csv", "a.csv"])
+
+    pd.testing.assert_frame_equal(merged_df, read_rows(ROWS))  # Identical fills of the same export are kept
+    assert "1 duplicate orders dropped" in caplog.text
+    assert "Conflicting" not in caplog.text
+
+
+def test_merge_interleaved_exports():
+    # The exports of two accounts over the same dates (not conflicting, as the accounts' orders are different)
+    other_rows = ["COLH95301,04/17/2023,USD,2,B,MARA,400,11.3687,11:11:03,0,0,0,0,0,0,Stoc,Stocks2,",
+                  "COLH95301,05/02/2023,USD,2,S,MARA,400,11.5,11:00:00,0,0,0,0,0,0,Stoc,Stocks2,"]
+    dfs = [read_rows([ROWS[0], ROWS[2], ROWS[3], ROWS[4]]), read_rows(other_rows)]
+    merged_df = ColmexProOrdersMerger.merge(dfs, ["a.csv", "b.csv"])
+    # Sorted by symbol, and then by execution time
+    pd.testing.assert_frame_equal(merged_df, read_rows([ROWS[0], ROWS[2], *other_rows, ROWS[3], ROWS[4]]))
+
+
+def test_merge_subset_on_overlapping_date(caplog):
+    # The first export was taken during 04/18, so its orders of 04/18 are a subset of the second export's
+    later_row = "COLH95300,04/18/2023,USD,2,B,BTU,50,26.8,10:15:00,0,0,0,0,0,0,Stoc,Stocks1,"
+    dfs = [read_rows(ROWS[:3]), read_rows([ROWS[2], later_row, ROWS[3]])]
+    merged_df = ColmexProOrdersMerger.merge(dfs, ["a.csv", "b.csv"])
+
+    pd.testing.assert_frame_equal(merged_df, read_rows([*ROWS[:3], later_row, ROWS[3]]))
+    assert "1 duplicate orders dropped" in caplog.text
+
+
+def test_merge_conflicting_exports():
+    conflicting_row = ROWS[2].replace("26.7823", "26.7824")
+    dfs = [read_rows(ROWS[:3]), read_rows(ROWS[:2] + [conflicting_row])]
+    with pytest.raises(Exception) as e:
+        ColmexProOrdersMerger.merge(dfs, ["a.csv", "b.csv"])
+    assert str(e.value) == "Conflicting orders in the overlapping input files a.csv and b.csv on 2023-04-18: " \
+                           "lines a.csv:4, b.csv:4"
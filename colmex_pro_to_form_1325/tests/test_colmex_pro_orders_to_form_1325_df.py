@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from fixed_point import FixedPoint
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+
+COLUMNS = ["Account", "Trade Date", "Currency", "Account Type", "Side", "Symbol", "Shares", "Price", "Exec Time",
+           "Commission", "SEC Fee", "TAF Fee", "ECN Fee", "Routing Fee", "NSCC Fee"]
+
+
+def orders_df(rows: list) -> pd.DataFrame:
+    return pd.DataFrame([["COLH95300", trade_date, "USD", 2, side, symbol, shares, price, exec_time, commission,
+                          0, 0, 0, 0, 0]
+                         for trade_date, side, symbol, shares, price, exec_time, commission in rows], columns=COLUMNS)
+
+
+@pytest.fixture()
+def rates():
+    return {"2023-04-17": 3.6, "2023-04-18": 3.5, "2023-04-19": 3.7}
+
+
+def test_transform_partial_fills_fixed_point(rates):
+    df = orders_df([
+        ("04/17/2023", "B", "ABC", 300, 10.0, "10:00:00", 1.0),
+        ("04/17/2023", "B", "ABC", 100, 11.0, "10:01:00", 0),
+        ("04/18/2023", "S", "ABC", 200, 12.0, "10:00:00", 0.5),
+        ("04/19/2023", "S", "ABC", 200, 9.0, "10:00:00", 0),
+    ])
+    transformed_df = ColmexProOrdersToForm1325DF.transform(df, rates)
+
+    assert list(transformed_df[Heb.SHARES]) == [200, 100, 100]
+    # 2/3 of (300 * 10 + 1) USD at 3.6
+    assert list(transformed_df[Heb.BUY_AMOUNT]) == [7202.4, 3601.2, 3960.0]
+    assert list(transformed_df[Heb.BUY_AMOUNT_ADJUSTED]) == [7002.33, 3701.23, 4070.0]
+    assert list(transformed_df[Heb.SELL_AMOUNT]) == [8398.25, 3330.0, 3330.0]
+    # The profit or loss is the one closer to 0 between the nominal and the real (adjusted) ones
+    assert list(transformed_df[Heb.PROFIT]) == [1195.85, "", ""]
+    assert list(transformed_df[Heb.LOSS]) == ["", -271.2, -630.0]
+
+
+def test_get_profit_loss():
+    profit_loss = ColmexProOrdersToForm1325DF._get_profit_loss(
+        np.array([100, 100, 100, 100]), np.array([110, 90, 110, 120]), np.array([130, 80, 105, 80])
+    )
+    assert list(profit_loss) == [20, -10, 0, -20]
+
+
+def test_transform_sells_without_buys(rates):
+    df = orders_df([("04/17/2023", "S", "ABC", 100, 10.0, "10:00:00", 0)])
+    with pytest.raises(Exception, match="Not enough bought shares of ABC"):
+        ColmexProOrdersToForm1325DF.transform(df, rates)
+
+
+def test_consolidate_fills(rates):
+    df = orders_df([
+        ("04/17/2023", "B", "ABC", 100, 10.0, "10:00:00", 0.5),
+        ("04/17/2023", "B", "ABC", 200, 10.0, "10:00:00", 0.5),
+        ("04/17/2023", "B", "ABC", 100, 10.1, "10:00:00", 0),
+        ("04/18/2023", "S", "ABC", 150, 12.0, "10:00:00", 0),
+        ("04/18/2023", "S", "ABC", 250, 12.0, "10:00:00", 1.0),
+    ])
+    consolidated_df = ColmexProOrdersToForm1325DF.consolidate_fills(df)
+
+    assert list(consolidated_df["Shares"]) == [300, 100, 400]
+    assert list(consolidated_df["Commission"]) == [1.0, 0, 1.0]
+    assert list(consolidated_df[Columns.LINEAGE]) == ["2;3", "4", "5;6"]
+
+    fills_df = ColmexProOrdersToForm1325DF.transform(df, rates)
+    orders_df_ = ColmexProOrdersToForm1325DF.transform(consolidated_df, rates)
+    assert (len(fills_df), len(orders_df_)) == (4, 2)
+    for column in Heb.BUY_AMOUNT, Heb.SELL_AMOUNT, Heb.PROFIT:
+        assert orders_df_[column].sum() == pytest.approx(fills_df[column].sum(), abs=0.02)
+
+
+def test_transform_aggregate_rows(rates):
+    df = orders_df([
+        ("04/17/2023", "B", "ABC", 100, 10.0, "10:00:00", 0),
+        ("04/17/2023", "B", "ABC", 100, 10.5, "10:01:00", 0),
+        ("04/18/2023", "S", "ABC", 150, 12.0, "10:00:00", 0),
+        ("04/18/2023", "S", "ABC", 50, 9.0, "10:01:00", 0),
+        ("04/18/2023", "B", "XYZ", 10, 5.0, "10:00:00", 0),
+        ("04/19/2023", "S", "XYZ", 10, 4.0, "10:00:00", 0),
+    ])
+    lots_df = ColmexProOrdersToForm1325DF.transform(df.copy(), rates)
+    aggregated_df = ColmexProOrdersToForm1325DF.transform(df.copy(), rates, aggregate=True)
+
+    assert (len(lots_df), len(aggregated_df)) == (4, 2)
+    assert list(aggregated_df[Heb.SYMBOL]) == ["ABC", "XYZ"]
+    assert list(aggregated_df[Heb.SHARES]) == [200, 10]
+    for column in Heb.BUY_AMOUNT, Heb.BUY_AMOUNT_ADJUSTED, Heb.SELL_AMOUNT:
+        assert list(aggregated_df[column]) == pytest.approx([lots_df[column][:3].sum(), lots_df[column][3]])
+    # The profit or loss is calculated again from the aggregated amounts (not summed): 7875 - 7380 vs 7875 - 7175
+    assert list(aggregated_df[Heb.PROFIT]) == [495.0, ""]
+    assert list(aggregated_df[Heb.LOSS]) == ["", -27.0]
+
+
+def test_transform_rounds_once_to_the_agora(rates):
+    df = orders_df([
+        ("04/17/2023", "B", "ABC", 300, 10.0001, "10:00:00", 0),
+        ("04/18/2023", "S", "ABC", 100, 10.0, "10:00:00", 0),
+        ("04/18/2023", "S", "ABC", 100, 10.0, "10:01:00", 0),
+        ("04/18/2023", "S", "ABC", 100, 10.0, "10:02:00", 0),
+        ("04/17/2023", "B", "XYZ", 1, 10.0125, "10:00:00", 0),
+        ("04/18/2023", "S", "XYZ", 1, 10.0, "10:00:00", 0),
+    ])
+    lots_df = ColmexProOrdersToForm1325DF.transform(df.copy(), rates)
+    aggregated_df = ColmexProOrdersToForm1325DF.transform(df.copy(), rates, aggregate=True)
+
+    # 100 * 10.0001 * 3.6 = 3600.036, and 10.0125 * 3.6 = 36.045 is rounded half away from zero
+    assert list(lots_df[Heb.BUY_AMOUNT]) == [3600.04, 3600.04, 3600.04, 36.05]
+    # The aggregated amount is rounded after it's summed: 300 * 10.0001 * 3.6 = 10800.108
+    assert list(aggregated_df[Heb.BUY_AMOUNT]) == [10800.11, 36.05]
+    # The loss is calculated from the rounded amounts: 10500 - 10500.11 (10500.105 adjusted), and 35 - 35.04
+    assert list(aggregated_df[Heb.BUY_AMOUNT_ADJUSTED]) == [10500.11, 35.04]
+    assert list(aggregated_df[Heb.LOSS]) == [-0.11, -0.04]
+
+
+def test_transform_large_notional(rates):
+    # The USD amount times the sliced shares (3.6e19) exceeds int64, so it must not be formed
+    df = orders_df([
+        ("04/17/2023", "B", "ABC", 3_000_000, 400.0, "10:00:00", 0),
+        ("04/19/2023", "S", "ABC", 1_000_000, 410.0, "10:00:00", 0),
+        ("04/19/2023", "S", "ABC", 2_000_000, 410.0, "10:01:00", 0),
+    ])
+    transformed_df = ColmexProOrdersToForm1325DF.transform(df, rates)
+
+    assert list(transformed_df[Heb.BUY_AMOUNT]) == [1_440_000_000.0, 2_880_000_000.0]
+    assert list(transformed_df[Heb.BUY_AMOUNT_ADJUSTED]) == [1_480_000_000.0, 2_960_000_000.0]
+    assert list(transformed_df[Heb.SELL_AMOUNT]) == [1_517_000_000.0, 3_034_000_000.0]
+    assert list(transformed_df[Heb.PROFIT]) == [37_000_000.0, 74_000_000.0]
+
+
+def test_fixed_point_mul_div_round():
+    # The products (1e20) don't fit in int64, but the results do
+    assert list(FixedPoint.mul_div_round(np.array([-7, 7, 10**13]), np.array([3, 3, 10**7]), np.array([2, 2, 10**7]))) \
+        == [-11, 11, 10**13]
+    with pytest.raises(Exception, match="too large"):
+        FixedPoint.multiply(10**13, 10**7)
@@ -0,0 +1,73 @@
+from io import StringIO
+
+import pandas as pd
+import pytest
+from colmex_pro_orders_merger import ColmexProOrdersMerger
+from colmex_pro_orders_validator import ColmexProOrdersValidator
+
+HEADER = "Account,Trade Date,Currency,Account Type,Side,Symbol,Shares,Price,Exec Time,Commission,SEC Fee,TAF Fee,\
+ECN Fee,Routing Fee,NSCC Fee,Clr Type,Clr Broker,Note"
+ROWS = [
+    "COLH95300,04/17/2023,USD,2,S,MARA,400,11.1518,9:42:42,0,0,0,0,0,0,Stoc,Stocks2,",  # A short sale
+    "COLH95300,04/17/2023,USD,2,B,MARA,400,11.3687,10:11:03,0,0,0,0,0,0,Stoc,Stocks2,",
+    "COLH95300,04/17/2023,USD,2,B,BTU,300,26.5265,10:38:42,1,0,0.02,0,0,0,Stoc,Stocks1,",
+    "COLH95300,04/18/2023,USD,2,S,BTU,300,26.7823,10:46:01,1.5,0.01,,0,0,0,Stoc,Stocks1,",
+]
+
+
+def read_rows(rows: list) -> pd.DataFrame:
+    return pd.read_csv(StringIO("\n".join([HEADER, *rows])), index_col=False)
+
+
+def test_valid_orders():
+    df = read_rows(ROWS)
+    ColmexProOrdersValidator.validate(df)
+    ColmexProOrdersValidator.validate_rates(df, {"2023-04-17": 3.6, "2023-04-18": 3.5})
+
+
+def test_all_errors_are_reported():
+    df = read_rows([
+        ROWS[0].replace(",S,", ",X,"),
+        ROWS[1].replace(",400,", ",-400,"),
+        ROWS[2].replace("04/17/2023", "17/04/2023"),
+        ROWS[3].replace("10:46:01", "10:46"),
+        ROWS[3].replace(",1.5,", ",-1.5,").replace(",300,", ",2.5,"),
+    ])
+    with pytest.raises(Exception) as e:
+        ColmexProOrdersValidator.validate(df, input_file="orders.csv")
+    assert str(e.value).splitlines() == [
+        "Invalid orders in orders.csv:",
+        "Unknown Side (must be B or S): line 2",
+        "Shares must be a non-negative whole number: lines 3, 6",
+        "Commission must be a non-negative number: line 6",
+        "Invalid Trade Date (must be MM/DD/YYYY): line 4",
+        "Invalid Exec Time (must be HH:MM:SS): line 5",
+    ]
+
+    with pytest.raises(Exception, match="Missing columns: Price"):
+        ColmexProOrdersValidator.validate(df.drop(columns="Price"))
+
+
+def test_year_and_positions():
+    df = read_rows([
+        ROWS[1].replace("04/17/2023", "12/30/2022"),
+        *ROWS[2:],
+        ROWS[3].replace("10:46:01", "11:00:00"),  # Sold again after the BTU position was closed
+        ROWS[0],  # MARA is sold short, and the position is closed by the next order
+        ROWS[1],
+    ])
+    with pytest.raises(Exception) as e:
+        ColmexProOrdersValidator.validate(df)
+    assert str(e.value).splitlines() == [
+        "Invalid orders:",
+        "Only orders from one year are supported, these orders are not from 2023: line 2",
+        "More shares of BTU are sold than bought: line 5",
+    ]
+
+
+def test_rates_and_merged_lines():
+    dfs = [read_rows(ROWS[3:]), read_rows(ROWS[:3])]
+    df, lines = ColmexProOrdersMerger.merge(dfs, ["b.csv", "a.csv"], return_lines=True)
+    assert list(lines) == ["a.csv:4", "b.csv:2", "a.csv:2", "a.csv:3"]  # Sorted by symbol (BTU, MARA)
+    with pytest.raises(Exception, match="Missing currency rate for 2023-04-18: line b.csv:2$"):
+        ColmexProOrdersValidator.validate_rates(df, {"2023-04-17": 3.6, "2023-04-18": 0.0}, lines)
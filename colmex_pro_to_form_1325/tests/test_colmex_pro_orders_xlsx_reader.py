@@ -0,0 +1,56 @@
+from datetime import datetime, time
+from io import StringIO
+
+import pandas as pd
+import pytest
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_orders_xlsx_reader import ColmexProOrdersXLSXReader
+from form_1325_generator import Form1325CSVGenerator
+
+openpyxl = pytest.importorskip("openpyxl")
+
+CONTENT = """Account,Trade Date,Currency,Account Type,Side,Symbol,Shares,Price,Exec Time,Commission,SEC Fee,TAF Fee,\
+ECN Fee,Routing Fee,NSCC Fee,Clr Type, Clr Broker,Note
+COLH95300,04/17/2023,USD,2,S,BTU,400,26.7823,9:29:52,1.5,0.01,0,0,0,0,Stoc,Stocks1,
+COLH95300,04/17/2023,USD,2,B,BTU,300,26.5265,10:38:42,1,0,0.02,0,0,0,Stoc,Stocks1,
+COLH95300,04/17/2023,USD,2,B,BTU,100,26.4888,10:46:01,0,0,,0,0,0,Stoc,Stocks1,"""
+
+
+@pytest.fixture()
+def input_xlsx(tmpdir):
+    df = pd.read_csv(StringIO(CONTENT), index_col=False)
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append([column.strip() for column in df.columns])
+    for i, row in enumerate(df.itertuples(index=False)):
+        values = [None if pd.isna(value) else value for value in row]
+        values[1] = datetime.strptime(values[1], "%m/%d/%Y")  # Date and time cells
+        values[8] = time.fromisoformat(values[8].zfill(8))
+        sheet.append(values)
+        if i == 0:
+            sheet.append([])  # An empty row
+    path = str(tmpdir.join("orders.xlsx"))
+    workbook.save(path)
+    return path
+
+
+def test_read(input_xlsx):
+    expected_df = pd.read_csv(StringIO(CONTENT), index_col=False)
+    expected_df.index = [0, 2, 3]  # The lines of the sheet, after the empty row
+    pd.testing.assert_frame_equal(ColmexProOrdersXLSXReader.read(input_xlsx), expected_df)
+    assert ColmexProOrdersXLSXReader.read(input_xlsx)["Exec Time"].iloc[0] == "9:29:52"  # Like the CSV export
+
+    chunks = list(ColmexProOrdersXLSXReader.iter_chunks(input_xlsx, chunk_size=2))
+    assert [list(chunk.index) for chunk in chunks] == [[0, 2], [3]]
+
+
+def test_generate_from_xlsx(tmpdir, input_xlsx, monkeypatch):
+    rates = {"2023-04-17": 3.6}
+    monkeypatch.setattr(BankOfIsraelRates, "get_rates", classmethod(lambda cls, year, symbol: dict(rates)))
+    input_csv, output_csv, output_xlsx_csv = (str(tmpdir.join(name)) for name in ("in.csv", "a.csv", "b.csv"))
+    with open(input_csv, "w") as f:
+        f.write(CONTENT)
+    Form1325CSVGenerator(input_csv, output_csv, no_cache=True).run()
+    Form1325CSVGenerator(input_xlsx, output_xlsx_csv, no_cache=True).run()
+    with open(output_csv) as expected, open(output_xlsx_csv) as actual:
+        assert actual.read() == expected.read()
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+from bank_of_israel_rates import BankOfIsraelRates
+from drop_folder_watcher import DropFolderWatcher
+from form_1325_generator import Form1325CSVGenerator
+
+@pytest.fixture()
+def fetches(monkeypatch, rates):
+    fetches = []
+    monkeypatch.setattr(BankOfIsraelRates, "get_rates",
+                        classmethod(lambda cls, year, symbol: fetches.append(year) or dict(rates)))
+    return fetches
+
+
+def wait(watcher: DropFolderWatcher):
+    for future, _ in list(watcher._in_flight.values()):
+        future.result()
+
+
+def test_watch(tmpdir, fetches, content):
+    watcher = DropFolderWatcher(str(tmpdir), Form1325CSVGenerator, "csv", workers=1, settle_time=5, no_cache=True)
+    tmpdir.join("a.csv").write(content)
+    tmpdir.join("b.csv").write(content)
+    tmpdir.join("c.csv").write(content)
+    tmpdir.join("notes.txt").write("")
+
+    watcher.poll(now=0)
+    tmpdir.join("b.csv").write(content + "\n")  # Still being written
+    os.utime(tmpdir.join("b.csv"), ns=(1, 1))
+    watcher.poll(now=3)
+    assert watcher._in_flight == {}  # Not settled yet
+
+    watcher.poll(now=6)
+    assert list(watcher._in_flight) == [str(tmpdir.join("a.csv"))]  # A single worker, so c.csv waits
+    wait(watcher)
+    watcher.poll(now=7)
+    assert list(watcher._in_flight) == [str(tmpdir.join("c.csv"))]  # b.csv hasn't settled yet
+    wait(watcher)
+    watcher.poll(now=8)
+    assert list(watcher._in_flight) == [str(tmpdir.join("b.csv"))]
+    wait(watcher)
+    watcher.poll(now=10)
+
+    expected_csv = tmpdir.mkdir("expected").join("a.csv")
+    Form1325CSVGenerator(str(tmpdir.join("a.csv")), str(expected_csv), no_cache=True).run()
+    for name in "a", "b", "c":
+        assert tmpdir.join("form_1325", f"{name}.csv.csv").read() == expected_csv.read()
+    assert sorted(os.listdir(tmpdir.join("form_1325"))) == ["a.csv.csv", "b.csv.csv", "c.csv.csv"]
+    assert fetches == [2023, 2023]  # Once by the watcher, and once for the expected output
+
+    # Unchanged files are not processed again, changed files are
+    watcher.poll(now=20)
+    watcher.poll(now=30)
+    assert watcher._in_flight == {}
+    os.utime(tmpdir.join("a.csv"), ns=(2, 2))
+    watcher.poll(now=40)
+    watcher.poll(now=50)
+    assert list(watcher._in_flight) == [str(tmpdir.join("a.csv"))]
+    wait(watcher)
+
+
+def test_output_file_names(tmpdir):
+    watcher = DropFolderWatcher(str(tmpdir), Form1325CSVGenerator, "pdf", workers=1)
+    # The CSV and the Excel exports of the same name don't overwrite each other's output
+    assert watcher._get_output_file(str(tmpdir.join("orders.csv"))) == str(tmpdir.join("form_1325", "orders.csv.pdf"))
+    assert watcher._get_output_file(str(tmpdir.join("orders.xlsx"))) == str(tmpdir.join("form_1325", "orders.xlsx.pdf"))
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_validator import ColmexProOrdersValidator
+from engine_verifier import EngineVerifier
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+from reference_engine import ReferenceEngine
+
+
+def test_generated_history():
+    rng = np.random.default_rng(0)
+    rates = EngineVerifier.generate_rates(rng)
+    df = EngineVerifier.generate_orders(rng, 3000, 10)
+    ColmexProOrdersValidator.validate(df)
+    ColmexProOrdersValidator.validate_rates(df, rates)
+
+    published = [date for date in pd.date_range("2023-01-01", "2023-12-31").strftime("%Y-%m-%d")
+                 if rates[date] != rates[(pd.Timestamp(date) - pd.Timedelta(days=1)).strftime("%Y-%m-%d")]]
+    assert len(published) < 260 - EngineVerifier.HOLIDAYS // 2  # Some weekdays have the previous day's rate
+    first_sides = df.groupby(Columns.SYMBOL)[Columns.SIDE].first()
+    assert (first_sides == ReferenceEngine.SELL).any()  # Short trades
+    keys = [Columns.SYMBOL, Columns.TRADE_DATE, Columns.EXEC_TIME, Columns.PRICE]
+    assert df.duplicated(keys).any()  # Partial fills
+
+
+def test_verify_history():
+    rng = np.random.default_rng(1)
+    rates = EngineVerifier.generate_rates(rng)
+    report = EngineVerifier.verify_history(EngineVerifier.generate_orders(rng, 2000, 8), rates, aggregate=True)
+    assert report["mismatches"] == 0 and report["descriptions"] == []
+    assert report["rows"] > 0 and report["reference_transform"] > 0 and report["engine_transform"] > 0
+
+
+def test_compare():
+    rng = np.random.default_rng(2)
+    rates = EngineVerifier.generate_rates(rng)
+    expected_df = ReferenceEngine.transform(EngineVerifier.generate_orders(rng, 500, 4), rates)
+    assert EngineVerifier.compare(expected_df, expected_df.copy()) == (0, [])
+
+    actual_df = expected_df.copy()
+    actual_df.loc[3, Heb.SELL_AMOUNT] += 0.01  # An agora
+    assert EngineVerifier.compare(expected_df, actual_df)[0] == 1
+    assert EngineVerifier.compare_totals(expected_df, actual_df) == (0, [])  # Within the totals tolerance
+    mismatches, descriptions = EngineVerifier.compare(expected_df, actual_df.iloc[:-1])
+    assert mismatches == 2
+    assert descriptions[0] == f"{len(expected_df)} rows (reference) != {len(expected_df) - 1} rows"
+    assert descriptions[1].startswith(f"Row 4, {Heb.SELL_AMOUNT!r}: ")
+
+    actual_df.loc[4, Heb.SELL_AMOUNT] += 0.01
+    assert EngineVerifier.compare_totals(expected_df, actual_df)[1] == [
+        f"Total {Heb.SELL_AMOUNT!r}: {expected_df[Heb.SELL_AMOUNT].sum():.2f} (reference) != "
+        f"{actual_df[Heb.SELL_AMOUNT].sum():.2f}"
+    ]
+
+
+def test_compare_formatted():
+    expected_df = pd.DataFrame({Heb.SELL_AMOUNT: ["1,234", "99"], Heb.PROFIT: ["", "3"], Heb.SYMBOL: ["A", "B"]})
+    actual_df = pd.DataFrame({Heb.SELL_AMOUNT: ["1,235", "99"], Heb.PROFIT: ["", "3"], Heb.SYMBOL: ["A", "B"]})
+    assert EngineVerifier.compare(expected_df, expected_df.copy()) == (0, [])
+    actual_df.loc[1, Heb.SYMBOL] = "C"
+    assert EngineVerifier.compare(expected_df, actual_df) == (2, [
+        f"Row 1, {Heb.SELL_AMOUNT!r}: '1,234' (reference) != '1,235'", f"Row 2, {Heb.SYMBOL!r}: 'B' (reference) != 'C'"
+    ])
+
+
+def test_round_reference():
+    # The engine's rounding rule: The amounts are rounded to the agora (half away from zero, also when the half was
+    # lost in the float arithmetic), and the profit or loss is calculated from the rounded amounts
+    expected_df = pd.DataFrame({
+        Heb.BUY_AMOUNT: [100.004, 100.0], Heb.BUY_AMOUNT_ADJUSTED: [100.004, 100.0], Heb.SELL_AMOUNT: [100.015, 99.994],
+        Heb.PROFIT: [0.011, ""], Heb.LOSS: ["", -0.006]
+    })
+    rounded_df = EngineVerifier.round_reference(expected_df)
+    assert list(rounded_df[Heb.BUY_AMOUNT]) == [100.0, 100.0]
+    assert list(rounded_df[Heb.SELL_AMOUNT]) == [100.02, 99.99]  # 100.015 is 100.01499999999999 as a float
+    assert list(rounded_df[Heb.PROFIT]) == [0.02, ""]
+    assert list(rounded_df[Heb.LOSS]) == ["", -0.01]
@@ -0,0 +1,54 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pypdf
+import pytest
+from form_1325_api import Form1325API
+from form_1325_df_to_pdf import Form1325DFToPDF
+from form_1325_generator import Form1325CSVGenerator
+
+pytestmark = pytest.mark.usefixtures("rates")
+
+
+def test_to_csv(tmpdir, input_csv, content):
+    csv_bytes, output_csv = content.encode(), str(tmpdir.join("output.csv"))
+    Form1325CSVGenerator(input_csv, output_csv, no_cache=True).run()
+    with open(output_csv, "rb") as f:
+        expected = f.read()
+
+    df = pd.read_csv(io.BytesIO(csv_bytes))
+    assert Form1325API.to_csv(df) == expected
+    assert "DateTime" not in df.columns  # The caller's DataFrame is left unchanged
+    assert Form1325API.to_csv(csv_bytes) == expected
+    output = io.BytesIO()
+    assert Form1325API.to_csv(io.BytesIO(csv_bytes), output) is None
+    assert output.getvalue() == expected
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(Form1325API.to_csv, [csv_bytes] * 8)) == [expected] * 8
+
+
+def test_to_pdf(monkeypatch, content):
+    csv_bytes = content.encode()
+    htmls = []
+
+    def run_wkhtmltopdf(self, html, html_file, options, pdf_file=None):
+        assert html_file is None and pdf_file is None  # Generated in memory
+        htmls.append(html)
+        pdf, writer = io.BytesIO(), pypdf.PdfWriter()
+        writer.add_blank_page(842, 595)
+        writer.write(pdf)
+        return pdf.getvalue()
+    monkeypatch.setattr(Form1325DFToPDF, "_run_wkhtmltopdf", run_wkhtmltopdf)
+
+    pdf = Form1325API.to_pdf(csv_bytes, "ישראל ישראלי", "123456789", True)
+    reader = pypdf.PdfReader(io.BytesIO(pdf))
+    assert len(reader.pages) > 1  # With the explanations pages
+
+    # The explanations are linked instead of appended
+    pdf = Form1325API.to_pdf(
+        csv_bytes, "ישראל ישראלי", "123456789", True, explanations_url="https://example.com/a?b&c"
+    )
+    assert len(pypdf.PdfReader(io.BytesIO(pdf)).pages) == 1
+    assert '<a href="https://example.com/a?b&amp;c">' in htmls[-1]
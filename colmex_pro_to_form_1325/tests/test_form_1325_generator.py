@@ -0,0 +1,239 @@
+import os
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+from colmex_pro_orders_csv_headers import ColmexProOrdersCSVColumns as Columns
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from engine_verifier import EngineVerifier
+from external_sort import ExternalSort
+from form_1325_df_to_pdf import Form1325DFToPDF
+from form_1325_generator import Form1325CSVGenerator, Form1325PDFGenerator
+from form_1325_hebrew_text import Form1325HebrewText as Heb
+from form_1325_totals import Form1325Totals
+from matched_lots_store import MatchedLotsStore
+from result_cache import ResultCache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join("cache"))
+    monkeypatch.setattr(ResultCache, "CACHE_FOLDER", cache_dir)
+    return cache_dir
+
+
+def test_spill_dir_output_matches_in_memory_output(tmpdir, input_csv, rates):
+    in_memory_csv, spilled_csv = str(tmpdir.join("in_memory.csv")), str(tmpdir.join("spilled.csv"))
+    Form1325CSVGenerator(input_csv, in_memory_csv, no_cache=True).run()
+    Form1325CSVGenerator(input_csv, spilled_csv, spill_dir=str(tmpdir.join("spill")), no_cache=True).run()
+
+    in_memory_df, spilled_df = pd.read_csv(in_memory_csv), pd.read_csv(spilled_csv)
+    pd.testing.assert_frame_equal(in_memory_df, spilled_df)
+    assert len(spilled_df) == 5
+    assert tmpdir.join("spill").listdir() == []  # The store files are removed
+
+
+def test_reference_engine(tmpdir, input_csv, rates):
+    engine_csv, reference_csv = str(tmpdir.join("engine.csv")), str(tmpdir.join("reference.csv"))
+    Form1325CSVGenerator(input_csv, engine_csv, subtotals=True, no_cache=True).run()
+    Form1325CSVGenerator(input_csv, reference_csv, subtotals=True, no_cache=True, reference_engine=True).run()
+    with open(engine_csv, encoding="utf-8-sig") as engine_file, \
+            open(reference_csv, encoding="utf-8-sig") as reference_file:
+        (engine_rows, engine_subtotals), (reference_rows, reference_subtotals) = (
+            [pd.read_csv(StringIO(part)).fillna("") for part in file.read().split("\n\n")]
+            for file in (engine_file, reference_file)
+        )
+    # The engine's CSV has the amounts rounded to the agora, and the reference engine's CSV has them unrounded
+    assert reference_rows[Heb.SELL_AMOUNT].iloc[0] != engine_rows[Heb.SELL_AMOUNT].iloc[0]
+    assert EngineVerifier.compare(EngineVerifier.round_reference(reference_rows), engine_rows) == (0, [])
+    pd.testing.assert_frame_equal(reference_subtotals, engine_subtotals, atol=EngineVerifier.TOTALS_TOLERANCE)
+
+
+def test_spill_dir_pdf_html(tmpdir, input_csv, rates):
+    generator = Form1325CSVGenerator(input_csv, None)
+    df = generator._extract()
+    transformed_df = generator._transform(df.copy(), 2023)
+    total_sales = Form1325DFToPDF.get_df_column_sum(transformed_df, Heb.SELL_AMOUNT)
+    with MatchedLotsStore.create(str(tmpdir)) as store:
+        ColmexProOrdersToForm1325DF.run(df, 2023, store)
+        args = (2023, "ישראל ישראלי", "123456789", True)
+        in_memory_html = Form1325DFToPDF(*args, transformed_df, None)._df_to_html()
+        spilled_html = Form1325DFToPDF(*args, None, None, store)._df_to_html()
+        assert store.totals()[Heb.SELL_AMOUNT] == total_sales
+
+    assert spilled_html == in_memory_html
+
+
+def test_running_totals(tmpdir, input_csv, rates):
+    output_csv, summary_csv = str(tmpdir.join("output.csv")), str(tmpdir.join("summary.csv"))
+    Form1325CSVGenerator(input_csv, output_csv, summary_file=summary_csv, subtotals=True).run()
+
+    with open(output_csv, encoding="utf-8-sig") as f:
+        rows_section, subtotals_section = f.read().split("\n\n")
+    output_df = pd.read_csv(StringIO(rows_section))
+    summary_df = pd.read_csv(summary_csv)
+    pd.testing.assert_frame_equal(pd.read_csv(StringIO(subtotals_section)), summary_df)
+
+    total = summary_df[summary_df[Form1325Totals.SECTION] == Form1325Totals.TOTAL].iloc[0]
+    for column in Heb.PROFIT, Heb.LOSS, Heb.SELL_AMOUNT:
+        assert total[column] == pytest.approx(output_df[column].sum(), abs=0.01)
+        by_symbol = summary_df[summary_df[Form1325Totals.SECTION] == Form1325Totals.SYMBOL][column]
+        by_month = summary_df[summary_df[Form1325Totals.SECTION] == Form1325Totals.MONTH][column]
+        assert by_symbol.sum() == pytest.approx(total[column], abs=0.05)
+        assert by_month.sum() == pytest.approx(total[column], abs=0.05)
+    assert list(summary_df[summary_df[Form1325Totals.SECTION] == Form1325Totals.MONTH][Form1325Totals.KEY]) == \
+        ["2023-04", "2023-06"]
+
+
+def test_by_account(tmpdir, input_csv, content, rates):
+    # Add a second account, with an opposite position in the same symbol
+    with open(input_csv, "a") as f:
+        f.write("\nCOLH95301,04/18/2023,USD,2,B,MARA,100,11.5,10:00:00,0,0,0,0,0,0,Stoc,Stocks2,"
+                "\nCOLH95301,04/19/2023,USD,2,S,MARA,100,12.5,10:00:00,0,0,0,0,0,0,Stoc,Stocks2,")
+    output_template = str(tmpdir.join("form_{account}.csv"))
+    generator = Form1325CSVGenerator(input_csv, output_template, by_account=True, workers=2)
+    generator.run()
+
+    expected_files = [str(tmpdir.join(f"form_{account}.csv")) for account in ("COLH95300", "COLH95301")]
+    assert sorted(generator.OUTPUT_FILES) == expected_files
+    assert len(pd.read_csv(tmpdir.join("form_COLH95300.csv"))) == 5
+    account_df = pd.read_csv(tmpdir.join("form_COLH95301.csv"))
+    assert len(account_df) == 1 and account_df[Heb.PROFIT].iloc[0] > 0
+
+
+def test_by_account_pdf_details(tmpdir):
+    accounts_file = tmpdir.join("accounts.csv")
+    accounts_file.write("Account,Name,File Number\nCOLH95300,ישראל ישראלי,123456789\n")
+    generator = Form1325PDFGenerator(str(tmpdir.join("in.csv")), str(tmpdir.join("out.pdf")), None, None, "True",
+                                     by_account=True, accounts_file=str(accounts_file))
+    accounts = generator._read_accounts_file()
+
+    account_generator = generator._for_account("COLH95300", accounts["COLH95300"])
+    assert account_generator.OUTPUT_FILE == str(tmpdir.join("out_COLH95300.pdf"))
+    assert (account_generator.NAME, account_generator.FILE_NUMER) == ("ישראל ישראלי", "123456789")
+    with pytest.raises(Exception, match="Missing name or file number for account COLH95399"):
+        generator._for_account("COLH95399", accounts.get("COLH95399", {}))
+
+
+def test_result_cache(tmpdir, input_csv, rates, cache_dir, monkeypatch):
+    output_csv, summary_csv = str(tmpdir.join("output.csv")), str(tmpdir.join("summary.csv"))
+    Form1325CSVGenerator(input_csv, output_csv, summary_file=summary_csv).run()
+    with open(output_csv, "rb") as f:
+        output = f.read()
+    tmpdir.join("output.csv").remove()
+    tmpdir.join("summary.csv").remove()
+
+    # Unchanged: the files are copied from the cache without generating them
+    def fail(*args):
+        raise AssertionError("The output was generated again")
+    with monkeypatch.context() as m:
+        m.setattr(Form1325CSVGenerator, "_generate_files", fail)
+        Form1325CSVGenerator(input_csv, output_csv, summary_file=summary_csv).run()
+    with open(output_csv, "rb") as f:
+        assert f.read() == output
+    assert tmpdir.join("summary.csv").exists()
+
+    # Changed options or rates: new entries. The least recently used entry is evicted when the cache is too big
+    Form1325CSVGenerator(input_csv, output_csv, subtotals=True).run()
+    rates["2023-06-05"] += 0.1
+    Form1325CSVGenerator(input_csv, output_csv).run()
+    entries = sorted(os.scandir(cache_dir), key=lambda entry: entry.stat().st_mtime)
+    assert len(entries) == 3
+    ResultCache(cache_dir, max_size=sum(ResultCache._get_dir_size(entry.path) for entry in entries[1:])).evict()
+    assert sorted(os.listdir(cache_dir)) == sorted(entry.name for entry in entries[1:])
+
+
+def test_result_cache_is_private(tmpdir, input_csv, cache_dir, rates, monkeypatch):
+    output_csv = str(tmpdir.join("output.csv"))
+    Form1325CSVGenerator(input_csv, output_csv).run()
+    (entry,) = os.scandir(cache_dir)
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+    assert [os.stat(file.path).st_mode & 0o777 for file in os.scandir(entry.path)] == [0o600]
+
+    # A cache folder owned by another user is never used
+    monkeypatch.setattr(os, "geteuid", lambda: os.stat(cache_dir).st_uid + 1)
+    with pytest.raises(Exception, match="Refusing to use the folder"):
+        Form1325CSVGenerator(input_csv, output_csv).run()
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_external_sort(tmpdir, input_csv, content, rates, spill):
+    header, *rows = content.split("\n")
+    unsorted_csv = tmpdir.join("unsorted.csv")
+    unsorted_csv.write("\n".join([header, *rows[::-1]]))  # Split to interleaving sorted runs of 2 orders
+    in_memory_csv, external_csv = str(tmpdir.join("in_memory.csv")), str(tmpdir.join("external.csv"))
+    spill_dir = str(tmpdir.mkdir("spill")) if spill else None
+    Form1325CSVGenerator(input_csv, in_memory_csv, no_cache=True).run()
+    Form1325CSVGenerator(str(unsorted_csv), external_csv, spill_dir=spill_dir, external_sort=True, chunk_size=2).run()
+
+    pd.testing.assert_frame_equal(pd.read_csv(in_memory_csv), pd.read_csv(external_csv))
+    if spill:
+        assert tmpdir.join("spill").listdir() == []  # The runs are removed
+
+
+def test_external_sort_runs(tmpdir, content):
+    header, *rows = content.split("\n")
+    rows[0] = rows[0].replace(",Stoc,Stocks2,", ",Stoc,Stocks2,A note")
+    input_file = tmpdir.join("unsorted.csv")
+    input_file.write("\n".join([header, *rows[::-1]]))
+    with ExternalSort.create(str(tmpdir), chunk_size=3) as external_sort:
+        external_sort.split(str(input_file))
+
+        # A run file per chunk, with the columns as plain arrays
+        run_files = sorted(os.listdir(external_sort.DIR))
+        assert len(run_files) == 3
+        with open(os.path.join(external_sort.DIR, run_files[0]), "rb") as f:
+            arrays = []
+            while f.tell() < os.fstat(f.fileno()).st_size:
+                arrays.append(np.load(f, allow_pickle=False))  # Fails if any array needs pickle
+        assert all(len(values) == 3 for values in arrays)
+
+        symbol_dfs = list(external_sort.iter_symbol_dfs())
+
+    expected_df = ColmexProOrdersToForm1325DF.sort(pd.read_csv(input_file))
+    assert [df[Columns.SYMBOL].iloc[0] for df in symbol_dfs] == ["MARA", "BTU", "TSLA"]
+    for symbol_df in symbol_dfs:
+        symbol = symbol_df[Columns.SYMBOL].iloc[0]
+        pd.testing.assert_frame_equal(
+            symbol_df, expected_df[expected_df[Columns.SYMBOL] == symbol].reset_index(drop=True), check_dtype=False
+        )
+    assert list(symbol_dfs[0]["Note"].fillna("")) == ["A note", ""]
+
+
+@pytest.mark.parametrize("external_sort", [False, True])
+def test_line_numbers_after_blank_lines(tmpdir, content, rates, external_sort):
+    header, *rows = content.split("\n")
+    input_file = tmpdir.join("blank_lines.csv")
+    input_file.write("\n".join([header, rows[0], "", rows[1], "", rows[2].replace(",S,BTU,", ",X,BTU,")]))
+    with pytest.raises(Exception, match="Unknown Side \\(must be B or S\\): line 6$"):
+        Form1325CSVGenerator(str(input_file), str(tmpdir.join("output.csv")), external_sort=external_sort,
+                             chunk_size=2, no_cache=True).run()
+
+    input_file.write("\n".join([header, rows[0], "", rows[1]]))
+    generator = Form1325CSVGenerator(str(input_file), None)
+    assert list(generator._consolidate_fills(generator._extract())[Columns.LINEAGE]) == ["2", "4"]
+
+
+@pytest.mark.parametrize("row, old, new, missing_rate, errors", [
+    (5, "05/02/2023", "05/02/2022", None,  # Another year (without a rate)
+     ["Only orders from one year are supported, these orders are not from 2023: line 7",
+      "Missing currency rate for 2022-05-02: line 7"]),
+    (7, ",S,TSLA,25,", ",S,TSLA,30,", None, ["More shares of TSLA are sold than bought: line 9"]),
+    (0, "", "", "2023-04-17", ["Missing currency rate for 2023-04-17: lines 2, 3, 4, 5, 6"]),  # MARA and BTU
+])
+def test_external_sort_validation(tmpdir, content, rates, monkeypatch, row, old, new, missing_rate, errors):
+    header, *rows = content.split("\n")
+    rows[row] = rows[row].replace(old, new)
+    if missing_rate is not None:
+        del rates[missing_rate]
+    input_file = tmpdir.join("invalid.csv")
+    input_file.write("\n".join([header, *rows]))
+
+    def fail(*args):
+        raise AssertionError("The orders were matched before they were validated")
+    monkeypatch.setattr(ColmexProOrdersToForm1325DF, "transform_sorted", fail)
+    with pytest.raises(Exception) as e:
+        Form1325CSVGenerator(str(input_file), str(tmpdir.join("output.csv")), external_sort=True, chunk_size=2,
+                             no_cache=True).run()
+    assert str(e.value).splitlines() == [f"Invalid orders in {input_file}:", *errors]
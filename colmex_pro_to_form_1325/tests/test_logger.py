@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import stat
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from logger import _JSONFormatter, get_log_context, init_process_logging, log_context, logger
+
+
+def test_log_context(caplog):
+    logger.getEffectiveLevel()  # Set up the logger before caplog saves its level
+    with caplog.at_level(logging.INFO, logger="logger"):
+        with log_context(job_id="job1", stage="transform"):
+            with log_context(account="A1"):
+                assert get_log_context() == {"job_id": "job1", "account": "A1", "stage": "transform"}
+                logger.info("Inside")
+            logger.info("Outside")
+        logger.info("No job")
+
+    records = [r for r in caplog.records if r.getMessage() in ("Inside", "Outside", "No job")]
+    assert [(r.job_id, r.account, r.stage) for r in records] == \
+        [("job1", "A1", "transform"), ("job1", None, "transform"), (None, None, None)]
+
+    line = json.loads(_JSONFormatter().format(records[0]))
+    assert line["message"] == "Inside"
+    assert line["level"] == "INFO"
+    assert (line["job_id"], line["account"], line["stage"]) == ("job1", "A1", "transform")
+
+
+def _log_in_worker(message: str, context: dict) -> int:
+    with log_context(**context):
+        logger.info(message)
+    return os.getpid()
+
+
+def _read_records(message: str, count: int) -> list:
+    """
+    Read the records with a message from the log file, waiting for the background thread to write them
+    """
+    deadline = time.monotonic() + 10
+    while True:
+        with open(logger.LOG_FILE, encoding="utf-8") as f:
+            records = [record for record in map(json.loads, f) if record["message"] == message]
+        if len(records) >= count or time.monotonic() > deadline:
+            return records
+        time.sleep(0.05)
+
+
+def test_log_file():
+    message = f"In the log file {uuid.uuid4()}"
+    with log_context(job_id="job2", stage="load"):
+        logger.info(message)
+    records = _read_records(message, 1)
+    assert [(r["job_id"], r["account"], r["stage"], r["process"]) for r in records] == \
+        [("job2", None, "load", os.getpid())]
+
+    folder = os.path.dirname(logger.LOG_FILE)
+    assert stat.S_IMODE(os.stat(folder).st_mode) == 0o700  # A private per-user folder
+    assert str(os.getpid()) in os.path.basename(logger.LOG_FILE)  # A log file per process
+
+
+def test_worker_process_records():
+    message = f"In a worker {uuid.uuid4()}"
+    with log_context(job_id="job3"), ProcessPoolExecutor(
+            max_workers=2, initializer=init_process_logging, initargs=(logger.get_process_queue(),)
+    ) as executor:
+        futures = [executor.submit(_log_in_worker, message, {**get_log_context(), "account": account})
+                   for account in ("A1", "A2")]
+        pids = {future.result() for future in futures}
+
+    # The workers' records are written to the main process's log file, with the job context and their process
+    records = _read_records(message, 2)
+    assert sorted((r["job_id"], r["account"]) for r in records) == [("job3", "A1"), ("job3", "A2")]
+    assert {r["process"] for r in records} == pids and os.getpid() not in pids
@@ -0,0 +1,48 @@
+import io
+import os
+
+import pypdf
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+from form_1325_df_to_pdf import Form1325DFToPDF
+
+EXPLANATIONS = f"{os.path.dirname(os.path.dirname(__file__))}/resources/1325_explanations_2023.pdf"
+
+
+def form_pdf(pages: int = 3) -> io.BytesIO:
+    # Form pages with uncompressed text content streams
+    pdf, writer = io.BytesIO(), pypdf.PdfWriter()
+    font = DictionaryObject({NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+                             NameObject("/BaseFont"): NameObject("/Helvetica")})
+    for page_number in range(pages):
+        page = writer.add_blank_page(842, 595)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+        content = DecodedStreamObject()
+        content.set_data(b"".join(b"BT /F1 8 Tf 20 %d Td (Page %d row %d MARA 400 11.1518) Tj ET\n"
+                                  % (560 - 12 * row, page_number + 1, row) for row in range(45)))
+        page.replace_contents(content)
+    writer.write(pdf)
+    return pdf
+
+
+def merge(optimize: bool) -> bytes:
+    output = io.BytesIO()
+    Form1325DFToPDF.merge_pdfs([form_pdf(), EXPLANATIONS], output, optimize)
+    return output.getvalue()
+
+
+def test_merge_pdfs(caplog):
+    optimized, plain = merge(True), merge(False)
+    assert "Optimized the PDF" in caplog.text
+    assert len(optimized) < len(plain)
+    assert merge(True) == optimized  # Byte-stable
+
+    optimized_pages = pypdf.PdfReader(io.BytesIO(optimized), strict=True).pages
+    plain_pages = pypdf.PdfReader(io.BytesIO(plain), strict=True).pages
+    assert len(optimized_pages) == len(plain_pages) == 3 + len(pypdf.PdfReader(EXPLANATIONS).pages)
+    for optimized_page, plain_page in zip(optimized_pages, plain_pages):
+        assert optimized_page.get_contents().get_data() == plain_page.get_contents().get_data()
+        assert optimized_page.extract_text() == plain_page.extract_text()
+    assert optimized_pages[0]["/Contents"].get_object()["/Filter"] == "/FlateDecode"
+    assert "Page 1 row 0" in optimized_pages[0].extract_text()
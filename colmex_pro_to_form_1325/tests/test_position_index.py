@@ -0,0 +1,98 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from bank_of_israel_rates import BankOfIsraelRates
+from colmex_pro_to_form_1325.src.__main__ import Main
+from position_index import PositionIndex
+
+
+@pytest.fixture()
+def content(header):
+    # An open position: The last BTU buy is partially sold
+    return header + """COLH95300,04/17/2023,USD,2,S,MARA,400,11.1518,9:42:42,0,0,0,0,0,0,Stoc,Stocks2,
+COLH95300,04/17/2023,USD,2,B,MARA,400,11.3687,10:11:03,0,0,0,0,0,0,Stoc,Stocks2,
+COLH95300,04/17/2023,USD,2,B,BTU,300,26.5265,10:38:42,0,0,0,0,0,0,Stoc,Stocks1,
+COLH95300,04/18/2023,USD,2,B,BTU,100,26.4888,10:46:01,0,0,0,0,0,0,Stoc,Stocks1,
+COLH95300,05/02/2023,USD,2,S,BTU,350,27.1000,11:00:00,0,0,0,0,0,0,Stoc,Stocks1,"""
+
+
+@pytest.fixture()
+def index_file(tmpdir, monkeypatch, input_csv):
+    monkeypatch.setattr(PositionIndex, "INDEX_FOLDER", str(tmpdir.join("index")))
+    return input_csv
+
+
+def test_position_index_queries(index_file, rates):
+    index = PositionIndex.open(index_file, rates)
+
+    assert set(index.symbols()) == {"MARA", "BTU"}
+    assert index.realized_pnl("MARA") < 0  # Sold short below the buy price
+    assert index.realized_pnl("BTU") > 0
+    assert index.realized_pnl("BTU", end="2023-04-30") == 0
+    assert index.realized_pnl() == pytest.approx(index.realized_pnl("MARA") + index.realized_pnl("BTU"))
+
+    open_lots = index.open_lots("BTU")
+    assert list(open_lots["Quantity"]) == [50]  # The last buy is partially open (FIFO)
+    assert list(index.fills("BTU")["Position"]) == [-300, -400, -50]
+
+
+def test_position_index_invalidated_by_input_change(index_file, rates, content):
+    index = PositionIndex.open(index_file, rates)
+    assert PositionIndex.open(index_file, rates).INPUT_HASH == index.INPUT_HASH
+
+    with open(index_file, "a") as f:
+        f.write("\nCOLH95300,05/03/2023,USD,2,S,BTU,50,27.2000,11:00:00,0,0,0,0,0,0,Stoc,Stocks1,")
+    reopened = PositionIndex.open(index_file, rates)
+
+    assert reopened.INPUT_HASH != index.INPUT_HASH
+    assert reopened.open_lots("BTU").empty
+    assert len(os.listdir(PositionIndex.INDEX_FOLDER)) == 1
+
+
+def test_position_index_saved_without_pickle(index_file, rates):
+    index = PositionIndex.open(index_file, rates)
+    index_path = PositionIndex._get_index_path(index_file)
+    assert os.stat(PositionIndex.INDEX_FOLDER).st_mode & 0o777 == 0o700
+    assert os.stat(index_path).st_mode & 0o777 == 0o600
+
+    loaded = PositionIndex.load(index_path, index.INPUT_HASH, lambda year: rates)
+    for frame in "FILLS", "LOTS", "OPEN_LOTS":
+        pd.testing.assert_frame_equal(getattr(loaded, frame), getattr(index, frame))
+    with np.load(index_path, allow_pickle=False) as data:  # Fails if any array needs pickle
+        assert all(data[name].dtype != object for name in data.files)
+
+
+def test_position_index_invalidated_by_rates_change(index_file, rates):
+    index = PositionIndex.open(index_file, rates)
+    changed_rates = dict(rates, **{"2023-05-02": rates["2023-05-02"] + 0.1})
+    reopened = PositionIndex.open(index_file, changed_rates)
+
+    assert reopened.RATES_HASH != index.RATES_HASH
+    assert reopened.realized_pnl("BTU") != index.realized_pnl("BTU")
+
+
+def test_position_index_rates_revalidated_on_request(index_file, rates, monkeypatch):
+    index = PositionIndex.open(index_file)  # Built with the BOI rates
+    changed_rates = dict(rates, **{"2023-05-02": rates["2023-05-02"] + 0.1})
+    monkeypatch.setattr(BankOfIsraelRates, "get_rates", classmethod(lambda cls, year, symbol: dict(changed_rates)))
+
+    assert PositionIndex.open(index_file).RATES_HASH == index.RATES_HASH  # The saved index, without fetching the rates
+    reopened = PositionIndex.open(index_file, revalidate_rates=True)
+    assert reopened.RATES_HASH != index.RATES_HASH
+    assert PositionIndex.open(index_file).RATES_HASH == reopened.RATES_HASH
+
+
+def test_positions_command(index_file, rates, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["app.py", Main.POSITIONS, index_file, "--end", "2023-12-31", "--open_lots"])
+    assert Main.positions()
+
+    summary, open_lots = capsys.readouterr().out.split("\n\n")
+    summary_lines = summary.splitlines()
+    assert summary_lines[0] == ",".join(["Symbol", *PositionIndex._SUM_COLUMNS])
+    assert [line.split(",")[0] for line in summary_lines[1:]] == ["BTU", "MARA", PositionIndex.TOTAL]
+    index = PositionIndex.open(index_file, rates)
+    assert float(summary_lines[-1].split(",")[1]) == pytest.approx(index.realized_pnl(), abs=0.01)
+    assert open_lots.splitlines()[1].startswith("BTU,B,2023-04-18")
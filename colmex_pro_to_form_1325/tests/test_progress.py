@@ -0,0 +1,135 @@
+import io
+import json
+import os
+import sys
+import time
+
+import pypdf
+import pytest
+from colmex_pro_orders_to_form_1325_df import ColmexProOrdersToForm1325DF
+from form_1325_generator import Form1325CSVGenerator, Form1325PDFGenerator
+from progress import Cancelled, CancellationToken, Progress, ProgressBar
+
+pytestmark = pytest.mark.usefixtures("rates")
+
+# A fake wkhtmltopdf that reports printing 2 pages and writes a blank PDF (to stdout or to the output file). It hangs
+# after the first page when FAKE_WKHTMLTOPDF_HANG is set, and writes its arguments to FAKE_WKHTMLTOPDF_ARGS if set
+FAKE_WKHTMLTOPDF = """#!{python}
+import json, os, sys, time
+source, output = sys.argv[-2:]
+if source == "-":
+    sys.stdin.buffer.read()
+if os.environ.get("FAKE_WKHTMLTOPDF_ARGS"):
+    with open(os.environ["FAKE_WKHTMLTOPDF_ARGS"], "w") as f:
+        json.dump(sys.argv[1:], f)
+sys.stderr.write("Printing pages (6/6)\\n[>    ] Page 1 of 2\\r")
+sys.stderr.flush()
+if os.environ.get("FAKE_WKHTMLTOPDF_HANG"):
+    time.sleep(60)
+sys.stderr.write("[=====] Page 2 of 2\\rDone\\n")
+with open({pdf!r}, "rb") as f, (sys.stdout.buffer if output == "-" else open(output, "wb")) as out:
+    out.write(f.read())
+"""
+
+
+@pytest.fixture()
+def wkhtmltopdf(tmpdir, monkeypatch):
+    blank_pdf, writer = str(tmpdir.join("blank.pdf")), pypdf.PdfWriter()
+    writer.add_blank_page(842, 595)
+    writer.write(blank_pdf)
+    bin_dir = tmpdir.mkdir("bin")
+    script = bin_dir.join("wkhtmltopdf")
+    script.write(FAKE_WKHTMLTOPDF.format(python=sys.executable, pdf=blank_pdf))
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_progress_events(tmpdir, monkeypatch, input_csv):
+    events = []
+    Form1325CSVGenerator(input_csv, str(tmpdir.join("output.csv")), no_cache=True,
+                         progress=lambda *event: events.append(event)).run()
+    assert events == [(Progress.PARSE, 8, None), (Progress.MATCH, 3, 3)]  # The symbols are matched in one batch
+
+    events.clear()
+    monkeypatch.setattr(ColmexProOrdersToForm1325DF, "BATCH_ORDERS", 1)  # A batch per symbol
+    Form1325CSVGenerator(input_csv, str(tmpdir.join("output.csv")), no_cache=True,
+                         progress=lambda *event: events.append(event)).run()
+    assert events == [(Progress.PARSE, 8, None), (Progress.MATCH, 1, 3), (Progress.MATCH, 2, 3), (Progress.MATCH, 3, 3)]
+
+
+def test_cancel_while_matching(tmpdir, input_csv):
+    output_csv, summary_csv, spill_dir = (str(tmpdir.join(name)) for name in ("output.csv", "summary.csv", "spill"))
+    with open(output_csv, "w") as f:
+        f.write("A previous output")
+    token = CancellationToken()
+
+    def progress(stage, done, total):
+        if stage == Progress.MATCH:
+            token.cancel()
+
+    with pytest.raises(Cancelled):
+        Form1325CSVGenerator(input_csv, output_csv, summary_file=summary_csv, spill_dir=spill_dir, no_cache=True,
+                             progress=progress, cancel_token=token).run()
+    assert os.listdir(spill_dir) == []  # The matched lots store was removed
+    assert not os.path.exists(summary_csv)
+    with open(output_csv) as f:
+        assert f.read() == "A previous output"  # Not written by the cancelled run
+
+
+def test_pdf_render_progress(tmpdir, input_csv, wkhtmltopdf):
+    events, output_pdf = [], str(tmpdir.join("output.pdf"))
+    Form1325PDFGenerator(input_csv, output_pdf, "ישראל ישראלי", "123456789", "True", no_cache=True,
+                         progress=lambda *event: events.append(event)).run()
+    assert [event for event in events if event[0] == Progress.RENDER] == [(Progress.RENDER, 1, 2),
+                                                                            (Progress.RENDER, 2, 2)]
+    assert len(pypdf.PdfReader(output_pdf).pages) > 1  # With the explanations pages
+
+
+def test_spill_dir_pdf_files(tmpdir, input_csv, wkhtmltopdf, monkeypatch):
+    args_file, spill_dir, output_pdf = (str(tmpdir.join(name)) for name in ("args.json", "spill", "output.pdf"))
+    monkeypatch.setenv("FAKE_WKHTMLTOPDF_ARGS", args_file)
+    Form1325PDFGenerator(input_csv, output_pdf, "ישראל ישראלי", "123456789", "True", spill_dir=spill_dir,
+                         no_cache=True).run()
+    with open(args_file) as f:
+        args = json.load(f)
+    # The HTML file in the spill folder is passed by path, the PDF is written to a file, and the css is a user style
+    # sheet (not added to the HTML)
+    source, output = args[-2:]
+    assert os.path.dirname(source) == spill_dir and source.endswith(".html")
+    assert output == f"{os.path.splitext(source)[0]}.pdf"
+    assert args[args.index("--user-style-sheet") + 1].endswith("form_1325.css")
+    assert len(pypdf.PdfReader(output_pdf).pages) > 1
+    assert os.listdir(spill_dir) == []  # The temp HTML and PDF files were removed
+
+
+def test_cancel_while_rendering(tmpdir, input_csv, wkhtmltopdf, monkeypatch):
+    monkeypatch.setenv("FAKE_WKHTMLTOPDF_HANG", "1")
+    token, output_pdf = CancellationToken(), str(tmpdir.join("output.pdf"))
+
+    def progress(stage, done, total):
+        if stage == Progress.RENDER:
+            token.cancel()
+
+    start = time.monotonic()
+    with pytest.raises(Cancelled):
+        Form1325PDFGenerator(input_csv, output_pdf, "ישראל ישראלי", "123456789", "True", no_cache=True,
+                             progress=progress, cancel_token=token).run()
+    assert time.monotonic() - start < 30  # wkhtmltopdf was killed
+    assert not os.path.exists(output_pdf)
+
+
+def test_progress_bar():
+    class Terminal(io.StringIO):
+        def isatty(self):
+            return True
+
+    stream = Terminal()
+    progress_bar = ProgressBar(stream)
+    progress_bar(Progress.PARSE, 1000)
+    progress_bar(Progress.MATCH, 1, 2)
+    progress_bar(Progress.MATCH, 2, 2)
+    progress_bar.close()
+    lines = stream.getvalue().split("\n")
+    assert lines[0] == "\rparse    1,000"
+    assert lines[1].endswith(f"\rmatch    [{'#' * ProgressBar.WIDTH}] 100% (2/2)")
+    assert lines[2] == ""